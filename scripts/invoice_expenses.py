@@ -10,36 +10,92 @@ Invoice Expense Tracker with Dashboard & Zip Export
 """
 
 import argparse
+import atexit
 import base64
+import cProfile
+import copy
 import csv
 import hashlib
+import importlib
+import importlib.util
+import io
 import json
 import logging
+import logging.handlers
 import os
+import queue
+import platform
+import pstats
+import random
 import re
+import shutil
+import sqlite3
+import struct
+import subprocess
 import sys
+import tempfile
+import threading
 import time
+import tracemalloc
 import zipfile
+import zlib
+from array import array
 from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from contextlib import contextmanager
-from datetime import date, timedelta, datetime
-from email.utils import parseaddr
+from datetime import date, timedelta, datetime, timezone
+from email import policy as email_policy
+from email.message import EmailMessage
+from email.parser import BytesHeaderParser, BytesParser
+from email.utils import parseaddr, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 from io import StringIO
+from urllib.parse import parse_qs, urljoin, urlsplit
 
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
+# Optional: peak-RSS fallback where /proc is unavailable (not on Windows)
+try:
+    import resource
+except ImportError:
+    resource = None
 
-# Text extraction / OCR
-import fitz  # PyMuPDF
-from PIL import Image
-import pytesseract
-from pdf2image import convert_from_path
-import docx
+
+class LazyModule:
+    """
+    Stand-in for a heavy module that imports it on first attribute access, so
+    --help, offline subcommands and mailbox ingest neither pay for nor require
+    it. After the import the module's namespace is copied onto the proxy, so
+    later lookups cost the same as on the module itself.
+    """
+
+    def __init__(self, name: str):
+        self.__dict__["_lazy_name"] = name
+
+    def __getattr__(self, attr: str):
+        module = importlib.import_module(self._lazy_name)
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attr)
+
+
+def module_available(name: str) -> bool:
+    """Whether an (optional) module is installed, without importing it."""
+    try:
+        return importlib.util.find_spec(name) is not None
+    except ImportError:
+        return False
+
+
+# Text extraction / OCR. The Gmail client libraries are imported inside the functions that talk to Gmail.
+fitz = LazyModule("fitz")  # PyMuPDF
+Image = LazyModule("PIL.Image")
+ImageFilter = LazyModule("PIL.ImageFilter")
+pytesseract = LazyModule("pytesseract")
+docx = LazyModule("docx")
+
+# Optional: columnar export (--parquet)
+pa = LazyModule("pyarrow")
+pq = LazyModule("pyarrow.parquet")
 
 # ============== LOGGING SETUP ==============
 
@@ -65,17 +121,18 @@ class ColoredFormatter(logging.Formatter):
         'CRITICAL': '🔥',
     }
 
-    def format(self, record):
-        color = self.COLORS.get(record.levelname, self.COLORS['RESET'])
-        reset = self.COLORS['RESET']
-        dim = self.COLORS['DIM']
-        icon = self.ICONS.get(record.levelname, '')
+    def __init__(self):
+        super().__init__()
+        # The colored "ICON LEVEL" block only depends on the level, so build it once
+        self._levels = {
+            name: f"{self.COLORS[name]}{icon} {name:<8}{self.COLORS['RESET']}" for name, icon in self.ICONS.items()
+        }
 
-        # Format timestamp
-        timestamp = datetime.fromtimestamp(record.created).strftime('%H:%M:%S.%f')[:-3]
+    def format(self, record):
+        level = self._levels.get(record.levelname) or f"{record.levelname:<8}"
+        timestamp = f"{time.strftime('%H:%M:%S', time.localtime(record.created))}.{int(record.msecs):03d}"
 
-        # Format the message
-        formatted = f"{dim}[{timestamp}]{reset} {color}{icon} {record.levelname:<8}{reset} {record.getMessage()}"
+        formatted = f"{self.COLORS['DIM']}[{timestamp}]{self.COLORS['RESET']} {level} {record.getMessage()}"
 
         if record.exc_info:
             formatted += f"\n{self.formatException(record.exc_info)}"
@@ -83,83 +140,847 @@ class ColoredFormatter(logging.Formatter):
         return formatted
 
 
-def setup_logging(verbose: bool = False, log_file: Optional[Path] = None) -> logging.Logger:
-    """Setup logging with colored console output and optional file output."""
+class JsonLinesFormatter(logging.Formatter):
+    """One JSON object per record (ts, level, thread, msg[, exc]) for log shippers and jq."""
+
+    def format(self, record):
+        entry = {
+            "ts": f"{time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created))}.{int(record.msecs):03d}",
+            "level": record.levelname,
+            "thread": record.threadName,
+            "msg": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class _LocalQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler for a listener in this same process. The stock prepare()
+    formats the record and folds the traceback into msg, which would leave the
+    listener's formatters (e.g. JsonLinesFormatter's "exc") without exc_info.
+    Here only the message arguments are resolved; exc_info travels as is.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+# The QueueListener of the current --log-async setup; its handlers do the formatting and I/O
+_log_listener: Optional[logging.handlers.QueueListener] = None
+_log_format = "text"
+
+
+def _file_log_formatter(log_format: str) -> logging.Formatter:
+    if log_format == "json":
+        return JsonLinesFormatter()
+    return logging.Formatter('%(asctime)s | %(levelname)-8s | %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+
+
+def _stop_log_listener() -> None:
+    global _log_listener
+    if _log_listener:
+        _log_listener.stop()  # drains the queue
+        _log_listener = None
+
+
+atexit.register(_stop_log_listener)
+
+
+def setup_logging(
+    verbose: bool = False,
+    log_file: Optional[Path] = None,
+    log_format: str = "text",
+    async_logging: bool = False,
+) -> logging.Logger:
+    """
+    Setup logging with colored console output and optional file output.
+    log_format="json" writes JSON lines to both. With async_logging the logger
+    only enqueues records; formatting and writes happen on a listener thread,
+    which is drained at exit.
+    """
+    global _log_listener, _log_format
+    _stop_log_listener()
+    _log_format = log_format
+
     logger = logging.getLogger('invoice_tracker')
     logger.setLevel(logging.DEBUG if verbose else logging.INFO)
     logger.handlers.clear()
+    handlers = []
 
     # Console handler with colors
     console_handler = logging.StreamHandler(sys.stdout)
     console_handler.setLevel(logging.DEBUG if verbose else logging.INFO)
-    console_handler.setFormatter(ColoredFormatter())
-    logger.addHandler(console_handler)
+    console_handler.setFormatter(JsonLinesFormatter() if log_format == "json" else ColoredFormatter())
+    handlers.append(console_handler)
 
     # File handler (no colors)
     if log_file:
         file_handler = logging.FileHandler(log_file, encoding='utf-8')
         file_handler.setLevel(logging.DEBUG)
-        file_handler.setFormatter(logging.Formatter(
-            '%(asctime)s | %(levelname)-8s | %(message)s',
-            datefmt='%Y-%m-%d %H:%M:%S'
-        ))
-        logger.addHandler(file_handler)
+        file_handler.setFormatter(_file_log_formatter(log_format))
+        handlers.append(file_handler)
+
+    if async_logging:
+        _log_listener = logging.handlers.QueueListener(
+            queue.SimpleQueue(), *handlers, respect_handler_level=True
+        )
+        _log_listener.start()
+        logger.addHandler(_LocalQueueHandler(_log_listener.queue))
+    else:
+        for handler in handlers:
+            logger.addHandler(handler)
 
     return logger
 
 
+def add_log_file(logger: logging.Logger, path: Path) -> logging.Handler:
+    """Also send everything (DEBUG and up) to `path`, through the async writer if one is running."""
+    handler = logging.FileHandler(path, encoding='utf-8')
+    handler.setLevel(logging.DEBUG)
+    handler.setFormatter(_file_log_formatter(_log_format))
+    if _log_listener:
+        _log_listener.handlers += (handler,)
+    else:
+        logger.addHandler(handler)
+    return handler
+
+
+def remove_log_file(logger: logging.Logger, handler: logging.Handler) -> None:
+    if _log_listener and handler in _log_listener.handlers:
+        # Let the writer thread finish what was queued for this file before closing it
+        _log_listener.stop()
+        _log_listener.handlers = tuple(h for h in _log_listener.handlers if h is not handler)
+        _log_listener.start()
+    else:
+        logger.removeHandler(handler)
+    handler.close()
+
+
 # ============== PERFORMANCE TRACKING ==============
 
+HISTOGRAM_SUB_BUCKET_BITS = 5  # 32 linear sub-buckets per power of two: <= ~3% relative error
+TRACE_MAX_EVENTS = 200_000  # cap on recorded timer spans (~30MB of trace JSON); later spans are counted, not kept
+METRICS_QUANTILES = (50, 90, 99)
+
+# --profile stages and the perf.timer operations each one covers
+PROFILE_STAGES = {
+    "fetch": ("list_messages", "fetch_batch", "fetch_message", "parse_message"),
+    "download": ("download_attachment",),
+    "prefilter": ("prefilter",),
+    "analyze": ("file_analysis",),
+    "ocr": ("pdf_ocr", "image_ocr"),
+    "write": ("write_outputs", "write_csvs"),
+    "dashboard": ("generate_dashboard",),
+    "zip": ("create_zip",),
+}
+PROFILE_TOP_N = 15
+
+MEMORY_SAMPLE_INTERVAL = 0.25  # seconds between background RSS samples
+MEMORY_MAX_SAMPLES = 2000  # RSS series is halved (every other sample dropped) when it reaches this
+MEMORY_TOP_ITEMS = 10  # largest files by peak memory kept for the summary
+
+# Cost attribution: timers and counters inside a perf.attribute() block are charged to its sender/file
+COST_TIMERS = {
+    "download_attachment": "download_seconds",
+    "prefilter": "extraction_seconds",
+    "file_analysis": "extraction_seconds",  # includes the OCR nested in it
+    "pdf_ocr": "ocr_seconds",
+    "image_ocr": "ocr_seconds",
+}
+COST_COUNTERS = {"bytes_downloaded": "download_bytes", "ocr_pages": "ocr_pages", "invoices_detected": "invoices"}
+COST_FIELDS = ["messages", "fetch_bytes", "fetch_seconds", "download_bytes", "download_seconds",
+               "extraction_seconds", "ocr_pages", "ocr_seconds", "invoices"]
+COST_OCR_HEAVY_SHARE = 0.5  # senders spending more of their time than this in OCR are worth a template
+# Whitelist only senders whose seconds and bytes per invoice are both at most this times the account's
+# median over senders with invoices; productive but costlier senders are left for review
+COST_WHITELIST_MEDIAN_RATIO = 1.0
+COST_DASHBOARD_ROWS = 15
+
+
+class LatencyHistogram:
+    """
+    HDR-style histogram of durations in microseconds. Values are bucketed by
+    power of two, each split into linear sub-buckets, so memory stays bounded
+    (a few hundred buckets at most) no matter how many samples are recorded.
+    count/total/min/max are exact; percentiles are accurate to one sub-bucket.
+    """
+
+    SUB = 1 << HISTOGRAM_SUB_BUCKET_BITS
+
+    def __init__(self):
+        self.buckets: Dict[int, int] = defaultdict(int)
+        self.count = 0
+        self.total = 0.0
+        self.min = float("inf")
+        self.max = 0.0
+
+    @classmethod
+    def _index(cls, micros: int) -> int:
+        if micros < cls.SUB:
+            return micros
+        shift = micros.bit_length() - HISTOGRAM_SUB_BUCKET_BITS - 1
+        return cls.SUB + shift * cls.SUB + ((micros >> shift) - cls.SUB)
+
+    @classmethod
+    def _upper_bound(cls, index: int) -> int:
+        """Largest microsecond value that lands in bucket `index`."""
+        if index < cls.SUB:
+            return index
+        shift, sub = divmod(index - cls.SUB, cls.SUB)
+        return ((cls.SUB + sub + 1) << shift) - 1
+
+    def record(self, seconds: float) -> None:
+        self.buckets[self._index(int(seconds * 1_000_000))] += 1
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+
+    def percentile(self, pct: float) -> float:
+        """Duration in seconds at or below which pct% of samples fall."""
+        if not self.count:
+            return 0.0
+        rank = max(1, int(round(pct / 100 * self.count)))
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                return min(max(self._upper_bound(index) / 1_000_000, self.min), self.max)
+        return self.max
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def merge(self, other: "LatencyHistogram") -> None:
+        for index, n in other.buckets.items():
+            self.buckets[index] += n
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"buckets": dict(self.buckets), "count": self.count, "total": self.total,
+                "min": self.min if self.count else 0.0, "max": self.max}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "LatencyHistogram":
+        hist = cls()
+        hist.buckets.update({int(k): v for k, v in data["buckets"].items()})
+        hist.count = data["count"]
+        hist.total = data["total"]
+        hist.min = data["min"] if data["count"] else float("inf")
+        hist.max = data["max"]
+        return hist
+
+
+def cost_action(row: Dict[str, Any], median_seconds: float, median_bytes: float) -> str:
+    """
+    What to do about a sender given its cost row and the account's median
+    seconds / bytes per invoice: "skip" if it never yielded an invoice,
+    "template" if OCR dominates its cost (a layout parser would pay off),
+    "whitelist" if it is cheap per invoice (safe to bypass the prefilter),
+    else "review" (productive, but costs more than most senders per invoice).
+    """
+    if not row["invoices"]:
+        return "skip"
+    if row["ocr_pages"] and row["ocr_seconds"] >= COST_OCR_HEAVY_SHARE * row["total_seconds"]:
+        return "template"
+    if (row["seconds_per_invoice"] <= COST_WHITELIST_MEDIAN_RATIO * median_seconds
+            and row["bytes_per_invoice"] <= COST_WHITELIST_MEDIAN_RATIO * median_bytes):
+        return "whitelist"
+    return "review"
+
+
+def _median(values: List[float]) -> float:
+    values = sorted(values)
+    if not values:
+        return 0.0
+    mid = len(values) // 2
+    return values[mid] if len(values) % 2 else (values[mid - 1] + values[mid]) / 2
+
+
+def write_cost_report(out_dir: Path, account_label: str, perf: "PerformanceTracker", logger: logging.Logger) -> None:
+    """cost_by_sender.csv and cost_by_file.csv: where this run's fetch, download and OCR budget went."""
+    sender_rows, file_rows = perf.cost_report(account_label)
+
+    def fmt(row: Dict[str, Any], fields: List[str]) -> Dict[str, Any]:
+        return {k: (f"{row[k]:.3f}" if isinstance(row[k], float) and "seconds" in k else
+                    int(row[k]) if isinstance(row[k], float) else row[k]) for k in fields}
+
+    sender_fields = ["sender", "action", "total_seconds", "seconds_per_invoice", "total_bytes", "bytes_per_invoice",
+                     "files"] + COST_FIELDS
+    with (out_dir / "cost_by_sender.csv").open("w", encoding="utf-8", newline="") as f:
+        w = csv.DictWriter(f, fieldnames=sender_fields)
+        w.writeheader()
+        for row in sender_rows:
+            w.writerow(fmt({k: "" if row[k] is None else row[k] for k in sender_fields}, sender_fields))
+
+    file_fields = ["sha256", "filename", "sender", "total_seconds", "total_bytes"] + COST_FIELDS[1:]
+    with (out_dir / "cost_by_file.csv").open("w", encoding="utf-8", newline="") as f:
+        w = csv.DictWriter(f, fieldnames=file_fields)
+        w.writeheader()
+        for row in file_rows:
+            w.writerow(fmt(row, file_fields))
+
+    logger.info(f"   ✅ cost_by_sender.csv ({len(sender_rows)} senders), cost_by_file.csv ({len(file_rows)} files)")
+
+
+def current_rss_bytes() -> Optional[int]:
+    """Resident set size of this process; falls back to the peak RSS where /proc is missing."""
+    try:
+        with open("/proc/self/statm", "rb") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+    return None
+
+
+class MemoryMonitor:
+    """
+    RSS samples from a background thread, plus per-block memory for perf.timer:
+    the RSS peak seen while the block ran and, if tracemalloc is on, the Python
+    heap peak above the block's starting point. Blocks timed with an `item`
+    (a file name) feed the "largest files by peak memory" table.
+    """
+
+    def __init__(self, interval: float = MEMORY_SAMPLE_INTERVAL, sampler: bool = True, trace_allocations: bool = False):
+        self.interval = interval
+        self.trace_allocations = trace_allocations
+        self.samples: List[Tuple[float, int]] = []  # (perf_counter, rss bytes)
+        self.rss_peak = 0
+        self.rss_peak_by_operation: Dict[str, int] = defaultdict(int)
+        self.rss_growth_by_operation: Dict[str, int] = defaultdict(int)
+        self.alloc_peak_by_operation: Dict[str, int] = defaultdict(int)
+        self.top_items: List[Dict[str, Any]] = []
+        self._active: Dict[int, Dict[str, Any]] = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        if trace_allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if sampler:
+            self._thread = threading.Thread(target=self._run, name="rss-sampler", daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def sample(self) -> Optional[int]:
+        rss = current_rss_bytes()
+        if rss is None:
+            return None
+        with self._lock:
+            self.samples.append((time.perf_counter(), rss))
+            if len(self.samples) >= MEMORY_MAX_SAMPLES:
+                self.samples = self.samples[::2]
+            self.rss_peak = max(self.rss_peak, rss)
+            for block in self._active.values():
+                block["rss_peak"] = max(block["rss_peak"], rss)
+        return rss
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=self.interval * 4)
+            self._thread = None
+
+    def block_start(self, operation: str, item: Optional[str]) -> Dict[str, Any]:
+        rss = current_rss_bytes() or 0
+        block = {"operation": operation, "item": item, "rss_start": rss, "rss_peak": rss}
+        if self.trace_allocations:
+            # reset_peak() is process-wide: the enclosing block keeps its own high-water mark on a stack
+            stack = self._local.__dict__.setdefault("stack", [])
+            block["heap_start"] = tracemalloc.get_traced_memory()[0]
+            block["heap_peak"] = 0
+            if stack:
+                stack[-1]["heap_peak"] = max(stack[-1]["heap_peak"], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+            stack.append(block)
+        with self._lock:
+            self._active[id(block)] = block
+            self.rss_peak = max(self.rss_peak, rss)
+        return block
+
+    def block_end(self, block: Dict[str, Any]) -> None:
+        rss = current_rss_bytes() or 0
+        alloc = 0
+        if self.trace_allocations:
+            stack = self._local.stack
+            stack.pop()
+            heap_peak = max(block["heap_peak"], tracemalloc.get_traced_memory()[1])
+            alloc = max(0, heap_peak - block["heap_start"])
+            if stack:
+                stack[-1]["heap_peak"] = max(stack[-1]["heap_peak"], heap_peak)
+
+        op = block["operation"]
+        with self._lock:
+            del self._active[id(block)]
+            peak = max(block["rss_peak"], rss)
+            growth = peak - block["rss_start"]
+            self.rss_peak = max(self.rss_peak, rss)
+            self.rss_peak_by_operation[op] = max(self.rss_peak_by_operation[op], peak)
+            self.rss_growth_by_operation[op] = max(self.rss_growth_by_operation[op], growth)
+            if self.trace_allocations:
+                self.alloc_peak_by_operation[op] = max(self.alloc_peak_by_operation[op], alloc)
+            if block["item"]:
+                self._add_item({"item": block["item"], "operation": op, "pid": os.getpid(),
+                                "rss_peak": peak, "rss_growth": growth, "alloc_peak": alloc})
+
+    def _add_item(self, entry: Dict[str, Any]) -> None:
+        self.top_items.append(entry)
+        self.top_items.sort(key=lambda e: (-e["rss_growth"], -e["alloc_peak"], -e["rss_peak"]))
+        del self.top_items[MEMORY_TOP_ITEMS:]
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "rss_peak": self.rss_peak,
+                "rss_peak_by_operation": dict(self.rss_peak_by_operation),
+                "rss_growth_by_operation": dict(self.rss_growth_by_operation),
+                "alloc_peak_by_operation": dict(self.alloc_peak_by_operation),
+                "top_items": list(self.top_items),
+            }
+
+    def merge(self, snapshot: Dict[str, Any]) -> None:
+        """Fold in a worker's memory stats (RSS figures stay per process; peaks are maxed, not summed)."""
+        with self._lock:
+            for attr in ("rss_peak_by_operation", "rss_growth_by_operation", "alloc_peak_by_operation"):
+                mine = getattr(self, attr)
+                for op, value in snapshot[attr].items():
+                    mine[op] = max(mine[op], value)
+            for entry in snapshot["top_items"]:
+                self._add_item(entry)
+
+    def to_dict(self, t0: float) -> Dict[str, Any]:
+        data = self.snapshot()
+        with self._lock:
+            data["rss_samples"] = [[round(t - t0, 3), rss] for t, rss in self.samples]
+        data["rss_last"] = data["rss_samples"][-1][1] if data["rss_samples"] else 0
+        data["tracemalloc"] = self.trace_allocations
+        return data
+
+
 class PerformanceTracker:
     """Track performance metrics throughout the script execution."""
 
     def __init__(self, logger: logging.Logger):
         self.logger = logger
         self.start_time = time.time()
-        self.metrics = defaultdict(list)
+        self._t0 = time.perf_counter()
+        self.metrics: Dict[str, LatencyHistogram] = defaultdict(LatencyHistogram)
         self.counters = defaultdict(int)
         self.current_timers = {}
+        # One (name, start, duration, pid, tid) per timer block, for the Chrome trace export
+        self.spans: List[Tuple[str, float, float, int, int]] = []
+        self.spans_dropped = 0
+        self.thread_names: Dict[Tuple[int, int], str] = {}
+        self._pid = os.getpid()
+        # Timers and counters are updated from download/OCR threads
+        self._lock = threading.Lock()
+        # --profile: operation -> stage, one cProfile.Profile per (stage, thread)
+        self._profile_ops: Dict[str, str] = {}
+        self._profile_rate = 1.0
+        self._profilers: Dict[Tuple[str, int], cProfile.Profile] = {}
+        self._profile_imports: Dict[str, List[Dict]] = defaultdict(list)
+        self.profile_counts: Dict[str, int] = defaultdict(int)
+        self._local = threading.local()
+        self.memory: Optional[MemoryMonitor] = None
+        # Cost attribution: (account, sender_key) / (account, sha256) -> COST_FIELDS totals
+        self.sender_costs: Dict[Tuple[str, str], Dict[str, float]] = {}
+        self.file_costs: Dict[Tuple[str, str], Dict[str, Any]] = {}
+
+    def enable_memory_tracking(self, interval: float = MEMORY_SAMPLE_INTERVAL, sampler: bool = True,
+                               trace_allocations: bool = False) -> None:
+        """Sample RSS in the background and record memory per perf.timer block (tracemalloc is opt-in)."""
+        self.memory = MemoryMonitor(interval, sampler=sampler, trace_allocations=trace_allocations)
+
+    def enable_profiling(self, stages: List[str], rate: float = 1.0) -> None:
+        """
+        Run cProfile inside the perf.timer blocks of the given PROFILE_STAGES.
+        rate < 1 profiles only that fraction of blocks, for low overhead on
+        production runs. A block nested inside one already being profiled on
+        the same thread is covered by the outer profile rather than its own.
+        """
+        self._profile_ops = {op: stage for stage in stages for op in PROFILE_STAGES[stage]}
+        self._profile_rate = rate
+
+    @property
+    def profiling(self) -> Optional[Tuple[List[str], float]]:
+        """(stages, rate) as passed to enable_profiling, or None when profiling is off."""
+        if not self._profile_ops:
+            return None
+        return sorted(set(self._profile_ops.values())), self._profile_rate
+
+    def _start_profile(self, operation: str) -> Optional[cProfile.Profile]:
+        stage = self._profile_ops.get(operation)
+        if stage is None or getattr(self._local, "profiling", False):
+            return None
+        if self._profile_rate < 1.0 and random.random() >= self._profile_rate:
+            return None
+        key = (stage, threading.get_ident())
+        with self._lock:
+            prof = self._profilers.setdefault(key, cProfile.Profile())
+            self.profile_counts[stage] += 1
+        try:
+            prof.enable()
+        except ValueError:
+            return None  # another profiler (e.g. an outer `python -m cProfile`) owns this thread
+        self._local.profiling = True
+        return prof
+
+    def _stop_profile(self, prof: cProfile.Profile) -> None:
+        prof.disable()
+        self._local.profiling = False
+
+    def profile_stats(self) -> Dict[str, pstats.Stats]:
+        """Per-stage stats merged over threads and worker snapshots."""
+        merged: Dict[str, pstats.Stats] = {}
+        with self._lock:
+            for (stage, _), prof in self._profilers.items():
+                prof.create_stats()
+                if stage in merged:
+                    merged[stage].add(prof)
+                else:
+                    merged[stage] = pstats.Stats(prof)
+            for stage, raw_stats in self._profile_imports.items():
+                for raw in raw_stats:
+                    stats = pstats.Stats()
+                    stats.stats = raw
+                    stats.get_top_level_stats()
+                    if stage in merged:
+                        merged[stage].add(stats)
+                    else:
+                        merged[stage] = stats
+        return merged
 
     @contextmanager
-    def timer(self, operation: str):
-        """Context manager to time an operation."""
-        start = time.time()
-        self.logger.debug(f"⏱️  Starting: {operation}")
+    def attribute(self, account: str, sender_key: str, sha256: Optional[str] = None, filename: Optional[str] = None):
+        """
+        Charge the COST_TIMERS / COST_COUNTERS recorded on this thread inside the
+        block to a sender, and to a file once its sha256 is known (set it on the
+        yielded dict). The totals are folded in when the block exits.
+        """
+        scope = {"sha256": sha256, "filename": filename, "amounts": defaultdict(float)}
+        outer = getattr(self._local, "cost", None)
+        self._local.cost = scope
+        try:
+            yield scope
+        finally:
+            self._local.cost = outer
+            self.charge(account, sender_key, scope["sha256"], scope["filename"], **scope["amounts"])
+
+    def charge(self, account: str, sender_key: str, sha256: Optional[str] = None, filename: Optional[str] = None,
+               **amounts: float) -> None:
+        """Add COST_FIELDS amounts to a sender's (and file's) totals."""
+        if not any(amounts.values()):
+            return
+        with self._lock:
+            sender = self.sender_costs.setdefault((account, sender_key), dict.fromkeys(COST_FIELDS, 0.0))
+            for field, value in amounts.items():
+                sender[field] += value
+            if sha256:
+                entry = self.file_costs.setdefault((account, sha256), {
+                    "sender": sender_key, "filename": filename, **dict.fromkeys(COST_FIELDS, 0.0)
+                })
+                for field, value in amounts.items():
+                    entry[field] += value
+
+    def cost_report(self, account: str) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+        """(sender rows, file rows) for one account, most expensive first."""
+        with self._lock:
+            senders = {s: dict(c) for (a, s), c in self.sender_costs.items() if a == account}
+            files = [dict(c, sha256=h) for (a, h), c in self.file_costs.items() if a == account]
+
+        files_per_sender: Dict[str, int] = defaultdict(int)
+        for entry in files:
+            files_per_sender[entry["sender"]] += 1
+        sender_rows = [
+            dict(costs, sender=sender, files=files_per_sender[sender]) for sender, costs in senders.items()
+        ]
+        for row in sender_rows + files:
+            row["total_seconds"] = row["fetch_seconds"] + row["download_seconds"] + row["extraction_seconds"]
+            row["total_bytes"] = row["fetch_bytes"] + row["download_bytes"]
+        for row in sender_rows:
+            row["seconds_per_invoice"] = row["total_seconds"] / row["invoices"] if row["invoices"] else None
+            row["bytes_per_invoice"] = row["total_bytes"] / row["invoices"] if row["invoices"] else None
+        productive = [row for row in sender_rows if row["invoices"]]
+        median_seconds = _median([row["seconds_per_invoice"] for row in productive])
+        median_bytes = _median([row["bytes_per_invoice"] for row in productive])
+        for row in sender_rows:
+            row["action"] = cost_action(row, median_seconds, median_bytes)
+
+        def rank(row):
+            return -row["total_seconds"], -row["total_bytes"]
+        return sorted(sender_rows, key=rank), sorted(files, key=rank)
+
+    def elapsed(self) -> float:
+        """Seconds since the tracker was created (monotonic)."""
+        return time.perf_counter() - self._t0
+
+    def record(self, operation: str, seconds: float, started: Optional[float] = None) -> None:
+        """Add one duration sample for an operation (and a trace span if its perf_counter start is known)."""
+        scope = getattr(self._local, "cost", None)
+        if scope is not None and operation in COST_TIMERS:
+            scope["amounts"][COST_TIMERS[operation]] += seconds
+        with self._lock:
+            self.metrics[operation].record(seconds)
+            if started is None:
+                return
+            if len(self.spans) >= TRACE_MAX_EVENTS:
+                self.spans_dropped += 1
+                return
+            tid = threading.get_ident()
+            self.spans.append((operation, started, seconds, self._pid, tid))
+            if (self._pid, tid) not in self.thread_names:
+                self.thread_names[(self._pid, tid)] = threading.current_thread().name
+
+    @contextmanager
+    def timer(self, operation: str, item: Optional[str] = None):
+        """Context manager to time an operation (item: file being processed, for memory attribution)."""
+        prof = self._start_profile(operation) if self._profile_ops else None
+        mem = self.memory.block_start(operation, item) if self.memory else None
+        start = time.perf_counter()
+        self.logger.debug("⏱️  Starting: %s", operation)
         try:
             yield
         finally:
-            elapsed = time.time() - start
-            self.metrics[operation].append(elapsed)
-            self.logger.debug(f"⏱️  Completed: {operation} in {elapsed:.3f}s")
+            elapsed = time.perf_counter() - start
+            if mem:
+                self.memory.block_end(mem)
+            if prof:
+                self._stop_profile(prof)
+            self.record(operation, elapsed, started=start)
+            self.logger.debug("⏱️  Completed: %s in %.3fs", operation, elapsed)
 
     def start_timer(self, name: str):
         """Start a named timer."""
-        self.current_timers[name] = time.time()
+        self.current_timers[name] = time.perf_counter()
 
     def stop_timer(self, name: str) -> float:
         """Stop a named timer and return elapsed time."""
-        if name in self.current_timers:
-            elapsed = time.time() - self.current_timers[name]
-            self.metrics[name].append(elapsed)
-            del self.current_timers[name]
-            return elapsed
-        return 0.0
+        started = self.current_timers.pop(name, None)
+        if started is None:
+            return 0.0
+        elapsed = time.perf_counter() - started
+        self.record(name, elapsed, started=started)
+        return elapsed
 
     def increment(self, counter: str, amount: int = 1):
         """Increment a counter."""
-        self.counters[counter] += amount
+        scope = getattr(self._local, "cost", None)
+        if scope is not None and counter in COST_COUNTERS:
+            scope["amounts"][COST_COUNTERS[counter]] += amount
+        with self._lock:
+            self.counters[counter] += amount
 
     def get_count(self, counter: str) -> int:
         """Get counter value."""
         return self.counters[counter]
 
+    def get_average(self, operation: str) -> Optional[float]:
+        """Average duration of an operation, or None if it has not run yet."""
+        hist = self.metrics.get(operation)
+        return hist.mean if hist and hist.count else None
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Picklable copy of counters and histograms (e.g. to ship back from a worker process)."""
+        profiles = {stage: stats.stats for stage, stats in self.profile_stats().items()}
+        with self._lock:
+            return {
+                "counters": dict(self.counters),
+                "metrics": {k: v.to_dict() for k, v in self.metrics.items()},
+                "spans": list(self.spans),
+                "spans_dropped": self.spans_dropped,
+                "thread_names": [[pid, tid, name] for (pid, tid), name in self.thread_names.items()],
+                "profiles": profiles,
+                "profile_counts": dict(self.profile_counts),
+                "memory": self.memory.snapshot() if self.memory else None,
+                "sender_costs": [[a, s, c] for (a, s), c in self.sender_costs.items()],
+                "file_costs": [[a, h, c] for (a, h), c in self.file_costs.items()],
+            }
+
+    def merge(self, snapshot: Dict[str, Any]) -> None:
+        """Fold a snapshot from another tracker (thread or process) into this one."""
+        with self._lock:
+            for name, value in snapshot["counters"].items():
+                self.counters[name] += value
+            for name, data in snapshot["metrics"].items():
+                self.metrics[name].merge(LatencyHistogram.from_dict(data))
+            # perf_counter is system-wide monotonic on Linux/macOS, so worker spans line up with ours
+            room = max(0, TRACE_MAX_EVENTS - len(self.spans))
+            spans = [tuple(span) for span in snapshot.get("spans", [])]
+            self.spans.extend(spans[:room])
+            self.spans_dropped += snapshot.get("spans_dropped", 0) + max(0, len(spans) - room)
+            for pid, tid, name in snapshot.get("thread_names", []):
+                self.thread_names.setdefault((pid, tid), name)
+            for stage, raw in snapshot.get("profiles", {}).items():
+                self._profile_imports[stage].append(raw)
+            for stage, n in snapshot.get("profile_counts", {}).items():
+                self.profile_counts[stage] += n
+        if snapshot.get("memory") and self.memory:
+            self.memory.merge(snapshot["memory"])
+        for account, sender_key, costs in snapshot.get("sender_costs", []):
+            self.charge(account, sender_key, **costs)
+        with self._lock:
+            for account, sha256, costs in snapshot.get("file_costs", []):
+                entry = self.file_costs.setdefault((account, sha256), {
+                    "sender": costs["sender"], "filename": costs["filename"], **dict.fromkeys(COST_FIELDS, 0.0)
+                })
+                for field in COST_FIELDS:
+                    entry[field] += costs[field]
+
+    def metrics_dict(self) -> Dict[str, Any]:
+        """Counters and per-operation latency stats (plus raw histograms, so runs can be merged later)."""
+        with self._lock:
+            operations = {
+                name: {
+                    "count": hist.count,
+                    "total_seconds": round(hist.total, 6),
+                    "mean_seconds": round(hist.mean, 6),
+                    "min_seconds": round(hist.min if hist.count else 0.0, 6),
+                    "max_seconds": round(hist.max, 6),
+                    **{f"p{q}_seconds": round(hist.percentile(q), 6) for q in METRICS_QUANTILES},
+                }
+                for name, hist in sorted(self.metrics.items())
+            }
+            return {
+                "started_at": datetime.fromtimestamp(self.start_time).isoformat(timespec="seconds"),
+                "duration_seconds": round(self.elapsed(), 3),
+                "command": sys.argv[1:],
+                "counters": dict(sorted(self.counters.items())),
+                "operations": operations,
+                "histograms": {name: hist.to_dict() for name, hist in sorted(self.metrics.items())},
+                "memory": self.memory.to_dict(self._t0) if self.memory else None,
+            }
+
+    def write_metrics_json(self, path: Path) -> None:
+        path.write_text(json.dumps(self.metrics_dict(), indent=2), encoding="utf-8")
+
+    def write_prometheus_textfile(self, path: Path, prefix: str = "invoice_tracker") -> None:
+        """
+        Node-exporter textfile-collector format. Written to a temp file and
+        renamed, so the collector never scrapes a half-written file.
+        """
+        def esc(value: str) -> str:
+            return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+        data = self.metrics_dict()
+        lines = [
+            f"# HELP {prefix}_last_run_timestamp_seconds Unix time the last run finished.",
+            f"# TYPE {prefix}_last_run_timestamp_seconds gauge",
+            f"{prefix}_last_run_timestamp_seconds {time.time():.3f}",
+            f"# HELP {prefix}_run_duration_seconds Wall time of the last run.",
+            f"# TYPE {prefix}_run_duration_seconds gauge",
+            f"{prefix}_run_duration_seconds {data['duration_seconds']}",
+            f"# HELP {prefix}_counter Pipeline counters from the last run.",
+            f"# TYPE {prefix}_counter gauge",
+        ]
+        lines += [f'{prefix}_counter{{name="{esc(name)}"}} {value}' for name, value in data["counters"].items()]
+        lines += [
+            f"# HELP {prefix}_operation_seconds Duration of timed operations in the last run.",
+            f"# TYPE {prefix}_operation_seconds summary",
+        ]
+        for name, op in data["operations"].items():
+            label = f'operation="{esc(name)}"'
+            for q in METRICS_QUANTILES:
+                lines.append(f'{prefix}_operation_seconds{{{label},quantile="{q / 100}"}} {op[f"p{q}_seconds"]}')
+            lines.append(f"{prefix}_operation_seconds_sum{{{label}}} {op['total_seconds']}")
+            lines.append(f"{prefix}_operation_seconds_count{{{label}}} {op['count']}")
+
+        if data["memory"]:
+            mem = data["memory"]
+            lines += [
+                f"# HELP {prefix}_rss_peak_bytes Peak resident set size of the last run.",
+                f"# TYPE {prefix}_rss_peak_bytes gauge",
+                f"{prefix}_rss_peak_bytes {mem['rss_peak']}",
+                f"# HELP {prefix}_operation_rss_growth_bytes Largest RSS growth during one block of an operation.",
+                f"# TYPE {prefix}_operation_rss_growth_bytes gauge",
+            ]
+            lines += [f'{prefix}_operation_rss_growth_bytes{{operation="{esc(op)}"}} {value}'
+                      for op, value in sorted(mem["rss_growth_by_operation"].items())]
+            if mem["tracemalloc"]:
+                lines += [
+                    f"# HELP {prefix}_operation_alloc_peak_bytes Largest Python heap peak during one block of an operation.",
+                    f"# TYPE {prefix}_operation_alloc_peak_bytes gauge",
+                ]
+                lines += [f'{prefix}_operation_alloc_peak_bytes{{operation="{esc(op)}"}} {value}'
+                          for op, value in sorted(mem["alloc_peak_by_operation"].items())]
+
+        ensure_dir(path.parent)
+        tmp = path.with_name(path.name + ".tmp")
+        tmp.write_text("\n".join(lines) + "\n", encoding="utf-8")
+        os.replace(tmp, path)
+
+    def write_chrome_trace(self, path: Path) -> None:
+        """Trace-event JSON (chrome://tracing, Perfetto): one complete event per timer block."""
+        with self._lock:
+            events: List[Dict[str, Any]] = [
+                {"ph": "M", "name": "thread_name", "pid": pid, "tid": tid, "args": {"name": name}}
+                for (pid, tid), name in self.thread_names.items()
+            ]
+            events += [
+                {"ph": "M", "name": "process_name", "pid": pid, "tid": 0,
+                 "args": {"name": "main" if pid == self._pid else f"worker {pid}"}}
+                for pid in sorted({pid for pid, _ in self.thread_names})
+            ]
+            events += [
+                {"ph": "X", "name": name, "cat": "perf", "pid": pid, "tid": tid,
+                 "ts": round((started - self._t0) * 1_000_000, 1), "dur": round(seconds * 1_000_000, 1)}
+                for name, started, seconds, pid, tid in self.spans
+            ]
+            dropped = self.spans_dropped
+        if self.memory:
+            events += [
+                {"ph": "C", "name": "rss_mb", "pid": self._pid, "tid": 0,
+                 "ts": round((t - self._t0) * 1_000_000, 1), "args": {"rss_mb": round(rss / 1e6, 1)}}
+                for t, rss in list(self.memory.samples)
+            ]
+        with path.open("w", encoding="utf-8") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms",
+                       "otherData": {"spans_dropped": dropped}}, f)
+
+    def write_profiles(self, out_dir: Path) -> List[Path]:
+        """One <stage>.pstats per profiled stage (open with `python -m pstats` or snakeviz)."""
+        paths = []
+        for stage, stats in sorted(self.profile_stats().items()):
+            ensure_dir(out_dir)
+            path = out_dir / f"{stage}.pstats"
+            stats.dump_stats(str(path))
+            paths.append(path)
+        return paths
+
+    def export(self, out_dir: Path, prometheus_textfile: Optional[Path] = None) -> None:
+        """Write metrics.json and trace.json for this run (and the Prometheus textfile / profiles, if enabled)."""
+        ensure_dir(out_dir)
+        self.write_metrics_json(out_dir / "metrics.json")
+        self.write_chrome_trace(out_dir / "trace.json")
+        if prometheus_textfile:
+            self.write_prometheus_textfile(prometheus_textfile)
+        self.logger.info(f"📈 Metrics: {out_dir / 'metrics.json'}, trace: {out_dir / 'trace.json'}"
+                         + (f", Prometheus: {prometheus_textfile}" if prometheus_textfile else ""))
+        if self._profile_ops:
+            profiles = self.write_profiles(out_dir / "profiles")
+            self.logger.info(f"🔬 Profiles: {', '.join(str(p) for p in profiles) or 'no profiled blocks ran'}")
+
     def log_progress(self, current: int, total: int, item_type: str = "items"):
         """Log progress with percentage and ETA."""
         if total == 0:
             return
 
         percent = (current / total) * 100
-        elapsed = time.time() - self.start_time
+        elapsed = self.elapsed()
 
         if current > 0:
             eta_seconds = (elapsed / current) * (total - current)
@@ -188,7 +1009,7 @@ class PerformanceTracker:
 
     def print_summary(self):
         """Print a comprehensive performance summary."""
-        total_time = time.time() - self.start_time
+        total_time = self.elapsed()
 
         self.logger.info("")
         self.logger.info("=" * 60)
@@ -201,24 +1022,58 @@ class PerformanceTracker:
         if self.counters:
             self.logger.info("📈 COUNTERS:")
             for name, value in sorted(self.counters.items()):
-                self.logger.info(f"   • {name}: {value:,}")
+                if isinstance(value, float):
+                    self.logger.info(f"   • {name}: {value:,.2f}")
+                else:
+                    self.logger.info(f"   • {name}: {value:,}")
             self.logger.info("")
 
         # Timing metrics
         if self.metrics:
             self.logger.info("⏱️  TIMING BREAKDOWN:")
-            for operation, times in sorted(self.metrics.items(), key=lambda x: -sum(x[1])):
-                total = sum(times)
-                avg = total / len(times) if times else 0
-                count = len(times)
+            for operation, hist in sorted(self.metrics.items(), key=lambda x: -x[1].total):
+                total = hist.total
+                count = hist.count
                 pct = (total / total_time) * 100 if total_time > 0 else 0
 
                 if count == 1:
                     self.logger.info(f"   • {operation}: {total:.3f}s ({pct:.1f}%)")
                 else:
-                    self.logger.info(f"   • {operation}: {total:.3f}s total, {avg:.3f}s avg, {count} calls ({pct:.1f}%)")
+                    self.logger.info(
+                        f"   • {operation}: {total:.3f}s total, {count} calls ({pct:.1f}%) | "
+                        f"avg {hist.mean:.3f}s p50 {hist.percentile(50):.3f}s p90 {hist.percentile(90):.3f}s "
+                        f"p99 {hist.percentile(99):.3f}s max {hist.max:.3f}s"
+                    )
+            self.logger.info("")
+
+        # Memory
+        if self.memory:
+            mem = self.memory.snapshot()
+            self.logger.info(f"🧠 MEMORY: peak RSS {format_bytes(mem['rss_peak'])}")
+            for op, peak in sorted(mem["rss_peak_by_operation"].items(), key=lambda x: -mem["rss_growth_by_operation"][x[0]]):
+                line = f"   • {op}: peak RSS {format_bytes(peak)}, max growth +{format_bytes(mem['rss_growth_by_operation'][op])}"
+                if self.memory.trace_allocations:
+                    line += f", heap peak {format_bytes(mem['alloc_peak_by_operation'][op])}"
+                self.logger.info(line)
+            if mem["top_items"]:
+                self.logger.info("   Largest files by peak memory:")
+                for e in mem["top_items"]:
+                    heap = f", heap +{format_bytes(e['alloc_peak'])}" if self.memory.trace_allocations else ""
+                    self.logger.info(f"      +{format_bytes(e['rss_growth'])} RSS{heap} ({e['operation']}) {e['item']}")
             self.logger.info("")
 
+        # Hot functions per profiled stage
+        if self._profile_ops:
+            for stage, stats in sorted(self.profile_stats().items()):
+                self.logger.info(f"🔥 HOT FUNCTIONS: {stage} ({self.profile_counts[stage]} blocks profiled, "
+                                 f"{stats.total_tt:.3f}s)")
+                self.logger.info(f"   {'self':>8} {'cumul':>8} {'calls':>9}  function")
+                hottest = sorted(stats.stats.items(), key=lambda kv: -kv[1][2])[:PROFILE_TOP_N]
+                for (filename, line, func), (_, ncalls, tottime, cumtime, _) in hottest:
+                    where = f"{Path(filename).name}:{line}" if line else filename
+                    self.logger.info(f"   {tottime:7.3f}s {cumtime:7.3f}s {ncalls:>9,}  {func} ({where})")
+                self.logger.info("")
+
         self.logger.info("=" * 60)
 
 
@@ -226,11 +1081,46 @@ class PerformanceTracker:
 
 SCOPES = ["https://www.googleapis.com/auth/gmail.readonly"]
 
+# googleapiclient retries 429/5xx responses this many times (exponential backoff)
+GMAIL_NUM_RETRIES = 3
+GMAIL_HTTP_TIMEOUT = 60  # seconds, per socket operation
+GMAIL_BATCH_SIZE = 25  # messages.get calls per batch request (the API allows 100; Gmail advises <= 50)
+GMAIL_RETRY_STATUSES = {429, 500, 502, 503, 504}  # batch parts refetched on their own (with retries)
+
 ALLOWED_EXTS = {
     ".pdf", ".docx",
     ".png", ".jpg", ".jpeg", ".tif", ".tiff", ".bmp", ".webp"
 }
 
+# Content sniffing: what the decoded bytes actually are, regardless of filename
+SNIFF_KIND_EXTS = {
+    "pdf": (".pdf",),
+    "docx": (".docx",),
+    "png": (".png",),
+    "jpeg": (".jpg", ".jpeg"),
+    "tiff": (".tif", ".tiff"),
+    "bmp": (".bmp",),
+    "webp": (".webp",),
+}
+
+IMAGE_KINDS = {"png", "jpeg", "tiff", "bmp", "webp"}
+
+# Attachments with these MIME types (or no useful extension) are downloaded and sniffed
+SNIFFABLE_MIME_TYPES = {
+    "application/pdf", "application/x-pdf", "application/octet-stream", "binary/octet-stream",
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    "image/png", "image/jpeg", "image/jpg", "image/pjpeg", "image/tiff", "image/bmp", "image/webp",
+}
+
+OCR_DEFAULT_DPI = 200  # rasterization DPI for scanned PDF pages
+OCR_FAST_CONFIG = "--psm 6"  # treat the page as one text block: skips most of tesseract's layout analysis
+OCR_FAST_MAX_SIDE = 2000  # fast mode also downscales images to this many pixels on the long side
+OCR_MAX_PDF_PAGES = 50  # hard cap on pages OCR-ed per PDF, whatever --ocr-max-pages says
+OCR_MEMORY_CEILING_MB = 256  # page rasters held at once (rendered or waiting for/under OCR) per PDF
+
+SNIFF_HEAD_BYTES = 4096
+SNIFF_TAIL_BYTES = 65536  # zip central directory lives at the end
+
 DEFAULT_KEYWORDS = [
     "invoice", "invoices", "receipt", "receipts", "tax invoice", "bill",
     "חשבונית", "חשבוניות", "קבלה", "קבלות", "חשבונית מס", "חשבונית מס קבלה", "סכום לתשלום"
@@ -243,6 +1133,28 @@ TOTAL_KEYWORDS = [
 
 TAX_WORDS = ["vat", "tax", "מע\"מ", "מעמ", "מס"]
 
+# Prefilter: cheap signals used to decide whether an attachment deserves full analysis
+PREFILTER_POSITIVE_NAME_WORDS = [
+    "invoice", "receipt", "bill", "statement", "payment", "order", "charge",
+    "חשבונית", "קבלה", "חשבון", "תשלום"
+]
+
+PREFILTER_NEGATIVE_NAME_WORDS = [
+    "newsletter", "terms", "privacy", "policy", "logo", "banner", "signature",
+    "unsubscribe", "brochure", "catalog", "flyer", "icon", "image00", "outlook"
+]
+
+PREFILTER_NEGATIVE_TEXT_WORDS = [
+    "unsubscribe", "terms of service", "terms and conditions", "privacy policy",
+    "newsletter", "view in browser", "תנאי שימוש", "מדיניות פרטיות", "להסרה"
+]
+
+PREFILTER_NEGATIVE_MIME = {"image/gif", "image/svg+xml", "image/x-icon", "application/pgp-signature"}
+
+PREFILTER_MIN_IMAGE_SIDE = 300       # smaller images are logos/icons
+PREFILTER_MAX_INVOICE_PAGES = 20     # longer PDFs are contracts, catalogs, manuals
+PREFILTER_DEFAULT_OCR_SECONDS = 2.5  # per page, used until real OCR timings exist
+
 URL_REGEX = re.compile(r"""(?xi)\b(https?://[^\s<>"'\]]+|www\.[^\s<>"'\]]+)\b""")
 
 AMOUNT_REGEX = re.compile(
@@ -308,7 +1220,11 @@ def format_bytes(size: int) -> str:
 
 # ============== GMAIL AUTH ==============
 
-def load_or_auth(creds_path: Path, token_path: Path, logger: logging.Logger, perf: PerformanceTracker) -> Credentials:
+def load_or_auth(creds_path: Path, token_path: Path, logger: logging.Logger, perf: PerformanceTracker) -> "Credentials":
+    from google.auth.transport.requests import Request
+    from google.oauth2.credentials import Credentials
+    from google_auth_oauthlib.flow import InstalledAppFlow
+
     logger.info(f"🔐 Checking authentication...")
     logger.debug(f"   Credentials file: {creds_path}")
     logger.debug(f"   Token file: {token_path}")
@@ -342,8 +1258,93 @@ def load_or_auth(creds_path: Path, token_path: Path, logger: logging.Logger, per
     return creds
 
 
-def gmail_service(creds: Credentials):
-    return build("gmail", "v1", credentials=creds, cache_discovery=False)
+_gmail_discovery_doc: Optional[Dict[str, Any]] = None
+# Per-thread transports: httplib2.Http is not thread-safe, so each thread keeps its own connections
+_gmail_http_local = threading.local()
+
+
+def gmail_discovery_doc() -> Dict[str, Any]:
+    """The Gmail v1 discovery document bundled with googleapiclient, parsed once per process."""
+    global _gmail_discovery_doc
+    if _gmail_discovery_doc is None:
+        from googleapiclient.discovery_cache import get_static_doc
+
+        doc = get_static_doc("gmail", "v1")
+        if doc is None:
+            raise RuntimeError("googleapiclient has no bundled Gmail discovery document (upgrade google-api-python-client)")
+        _gmail_discovery_doc = json.loads(doc)
+    return _gmail_discovery_doc
+
+
+def timed_http(perf: Optional[PerformanceTracker], timeout: int = GMAIL_HTTP_TIMEOUT) -> "httplib2.Http":
+    """
+    httplib2.Http (persistent connections, one per host) that reports into perf:
+    http_request / http_connect timers, and http_requests / http_connections
+    counters. The connect timer covers TCP and TLS setup, so
+    http_connections / http_requests is the share of requests that paid it.
+    """
+    import httplib2
+
+    def timed(base):
+        class TimedConnection(base):
+            def connect(self):
+                with perf.timer("http_connect"):
+                    super().connect()
+                perf.increment("http_connections")
+        return TimedConnection
+
+    connection_types = {"http": timed(httplib2.HTTPConnectionWithTimeout),
+                        "https": timed(httplib2.HTTPSConnectionWithTimeout)}
+
+    class TimedHttp(httplib2.Http):
+        def request(self, uri, *args, connection_type=None, **kwargs):
+            connection_type = connection_type or connection_types.get(urlsplit(uri).scheme)
+            perf.increment("http_requests")
+            with perf.timer("http_request"):
+                return super().request(uri, *args, connection_type=connection_type, **kwargs)
+
+    return TimedHttp(timeout=timeout) if perf else httplib2.Http(timeout=timeout)
+
+
+def gmail_http(creds: "Credentials", perf: Optional[PerformanceTracker] = None) -> "AuthorizedHttp":
+    """This thread's keep-alive transport for `creds`, created on first use."""
+    cached = getattr(_gmail_http_local, "transport", None)
+    if cached and cached[0] is creds:
+        return cached[1]
+    from google_auth_httplib2 import AuthorizedHttp
+
+    http = AuthorizedHttp(creds, http=timed_http(perf))
+    _gmail_http_local.transport = (creds, http)
+    return http
+
+
+def gmail_service(creds: "Credentials", api_endpoint: Optional[str] = None, perf: Optional[PerformanceTracker] = None):
+    """
+    Gmail API client for the calling thread: built from the cached discovery
+    document (no discovery fetch) on that thread's keep-alive transport.
+    """
+    from googleapiclient.discovery import build_from_document
+
+    # api_endpoint: e.g. a local FakeGmailServer
+    return build_from_document(gmail_discovery_doc(), http=gmail_http(creds, perf),
+                               client_options={"api_endpoint": api_endpoint} if api_endpoint else None)
+
+
+def gmail_batch(service, callback=None, api_endpoint: Optional[str] = None) -> "BatchHttpRequest":
+    """Batch request for `service`, posted to api_endpoint's batch path when one is given."""
+    if not api_endpoint:
+        return service.new_batch_http_request(callback=callback)
+    from googleapiclient.http import BatchHttpRequest
+
+    # new_batch_http_request() builds its URL from the discovery rootUrl and ignores api_endpoint
+    batch_uri = urljoin(api_endpoint.rstrip("/") + "/", gmail_discovery_doc()["batchPath"])
+    return BatchHttpRequest(callback=callback, batch_uri=batch_uri)
+
+
+def is_http_error(e: BaseException) -> bool:
+    """isinstance(e, HttpError) without importing googleapiclient (nothing raised one if it isn't loaded)."""
+    errors = sys.modules.get("googleapiclient.errors")
+    return errors is not None and isinstance(e, errors.HttpError)
 
 
 # ============== GMAIL OPERATIONS ==============
@@ -366,16 +1367,16 @@ def list_messages(service, query: str, max_messages: int, logger: logging.Logger
     with perf.timer("list_messages"):
         while True:
             page_count += 1
-            logger.debug(f"   Fetching page {page_count}...")
+            logger.debug("   Fetching page %s...", page_count)
 
             resp = service.users().messages().list(
                 userId="me", q=query, pageToken=page_token, maxResults=min(500, max_messages - len(ids))
-            ).execute()
+            ).execute(num_retries=GMAIL_NUM_RETRIES)
 
             msgs = resp.get("messages", [])
             ids.extend([m["id"] for m in msgs])
 
-            logger.debug(f"   Page {page_count}: got {len(msgs)} messages (total: {len(ids)})")
+            logger.debug("   Page %s: got %s messages (total: %s)", page_count, len(msgs), len(ids))
 
             page_token = resp.get("nextPageToken")
             if not page_token or len(ids) >= max_messages:
@@ -455,14 +1456,122 @@ def iter_attachments(payload: Dict[str, Any]) -> List[Dict[str, Any]]:
 def download_attachment(service, msg_id: str, attachment_id: str) -> bytes:
     att = service.users().messages().attachments().get(
         userId="me", messageId=msg_id, id=attachment_id
-    ).execute()
+    ).execute(num_retries=GMAIL_NUM_RETRIES)
     return decode_b64(att.get("data", ""))
 
 
+def download_attachment_to(service, msg_id: str, attachment_id: str, directory: Path) -> Dict[str, Any]:
+    """
+    download_attachment into a temp file (see write_stream). The response body
+    is the only full-size copy held: it is decoded straight from its bytes a
+    slice at a time instead of going through a dict, a str and a padded str.
+    """
+    request = service.users().messages().attachments().get(userId="me", messageId=msg_id, id=attachment_id)
+    request.postproc = lambda resp, content: content  # raw JSON bytes instead of JsonModel's parsed dict
+    raw = request.execute(num_retries=GMAIL_NUM_RETRIES)
+    return write_stream(iter_b64_chunks(json_string_field(raw, "data")), directory)
+
+
+def sniff_kind(head: bytes, tail: bytes = b"") -> Optional[str]:
+    """
+    Classify a blob by its magic bytes.
+    Returns a key of SNIFF_KIND_EXTS, or None if no extractor can handle it.
+    """
+    if b"%PDF-" in head[:1024]:
+        return "pdf"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if head.startswith(b"\xff\xd8\xff"):
+        return "jpeg"
+    if head.startswith((b"II*\x00", b"MM\x00*")):
+        return "tiff"
+    if head.startswith(b"BM") and len(head) >= 14:
+        return "bmp"
+    if head.startswith(b"RIFF") and head[8:12] == b"WEBP":
+        return "webp"
+    if head.startswith(b"PK\x03\x04"):
+        # OOXML: Word documents carry word/document.xml in the central directory
+        if b"word/document.xml" in tail or b"word/document.xml" in head:
+            return "docx"
+    return None
+
+
+def sniff_file(path: Path) -> Optional[str]:
+    """Sniff a file on disk reading only its head and tail."""
+    try:
+        with path.open("rb") as f:
+            head = f.read(SNIFF_HEAD_BYTES)
+            size = f.seek(0, os.SEEK_END)
+            f.seek(max(0, size - SNIFF_TAIL_BYTES))
+            tail = f.read()
+        return sniff_kind(head, tail)
+    except OSError:
+        return None
+
+
+def kind_for_ext(ext: str) -> Optional[str]:
+    for kind, exts in SNIFF_KIND_EXTS.items():
+        if ext in exts:
+            return kind
+    return None
+
+
 def sha256_bytes(b: bytes) -> str:
     return hashlib.sha256(b).hexdigest()
 
 
+B64_DECODE_CHUNK = 1024 * 1024  # base64 characters decoded per step (a multiple of 4)
+
+
+def iter_b64_chunks(encoded, chunk_chars: int = B64_DECODE_CHUNK):
+    """decode_b64 a slice at a time: yields decoded bytes without copying the whole input."""
+    view = memoryview(encoded)
+    for start in range(0, len(view), chunk_chars):
+        piece = view[start:start + chunk_chars].tobytes()
+        if len(piece) % 4:
+            piece += b"=" * (4 - len(piece) % 4)
+        yield base64.urlsafe_b64decode(piece)
+
+
+def json_string_field(raw: bytes, key: str) -> memoryview:
+    """
+    View of a string value in raw JSON without parsing the document. Only for
+    values without escapes (e.g. base64) and keys that appear nowhere else.
+    """
+    marker = raw.find(b'"' + key.encode("ascii") + b'"')
+    if marker < 0:
+        return memoryview(b"")
+    start = raw.index(b'"', raw.index(b":", marker)) + 1
+    return memoryview(raw)[start:raw.index(b'"', start)]
+
+
+def write_stream(chunks, directory: Path) -> Dict[str, Any]:
+    """
+    Write chunks to a temp file in `directory`, hashing as they pass, so the
+    content is walked once and never held whole. Returns its path, size,
+    sha256 and the head/tail bytes sniff_kind needs; the caller moves the file
+    into place or unlinks it.
+    """
+    digest = hashlib.sha256()
+    head = b""
+    tail = b""
+    size = 0
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+                digest.update(chunk)
+                size += len(chunk)
+                if len(head) < SNIFF_HEAD_BYTES:
+                    head += chunk[:SNIFF_HEAD_BYTES - len(head)]
+                tail = (tail + chunk[-SNIFF_TAIL_BYTES:])[-SNIFF_TAIL_BYTES:]
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return {"path": Path(tmp), "size": size, "sha256": digest.hexdigest(), "head": head, "tail": tail}
+
+
 def parse_gmail_internal_date(ms: str) -> str:
     try:
         dt = datetime.utcfromtimestamp(int(ms) / 1000)
@@ -723,53 +1832,318 @@ def extract_best_total(text: str, logger: logging.Logger) -> Optional[Dict[str,
         add_candidate(m.group(2), ctx, 60, "global_pattern")
 
     if not candidates:
-        logger.debug(f"      No amount candidates found in text ({len(text)} chars)")
+        logger.debug("      No amount candidates found in text (%s chars)", len(text))
         return None
 
     candidates.sort(key=lambda c: (c["currency"] != "UNK", c["score"], c["amount"]), reverse=True)
     best = candidates[0]
-    logger.debug(f"      Found {len(candidates)} candidates, best: {best['currency']} {best['amount']:.2f} (score: {best['score']}, method: {best['source']})")
+    logger.debug("      Found %s candidates, best: %s %.2f (score: %s, method: %s)",
+                 len(candidates), best['currency'], best['amount'], best['score'], best['source'])
     return best
 
 
+# ============== INVOICE PREFILTER ==============
+
+def prefilter_attachment(
+    path: Path,
+    filename: str,
+    mime_type: str,
+    threshold: float,
+    enable_ocr: bool,
+    ocr_max_pages: int,
+    logger: logging.Logger,
+    perf: PerformanceTracker,
+    kind: Optional[str] = None,
+    native: Optional[Tuple[str, int]] = None,
+) -> Dict[str, Any]:
+    """
+    Score an attachment with cheap signals (name, MIME type, page count,
+    native text, image size) before it is OCR-ed. Only the OCR path is gated:
+    files that would need OCR and score below `threshold` are not worth it,
+    everything else is always kept. `native` is pdf_native_text's result
+    when the caller already has it (it is passed on to analyze_file too).
+    """
+    kind = kind or sniff_file(path) or kind_for_ext(path.suffix.lower())
+    name = (filename or path.name).lower()
+    score = 0.0
+    reasons: List[str] = []
+    pages = 0
+    needs_ocr = False
+
+    with perf.timer("prefilter"):
+        if any(w in name for w in PREFILTER_POSITIVE_NAME_WORDS):
+            score += 2.0
+            reasons.append("name:invoice-like")
+        if any(w in name for w in PREFILTER_NEGATIVE_NAME_WORDS):
+            score -= 2.0
+            reasons.append("name:non-invoice")
+
+        if (mime_type or "").lower() in PREFILTER_NEGATIVE_MIME:
+            score -= 2.0
+            reasons.append(f"mime:{mime_type}")
+
+        if kind == "pdf":
+            text, pages = native if native is not None else pdf_native_text(path, logger, perf)
+
+            if 0 < pages <= PREFILTER_MAX_INVOICE_PAGES:
+                score += 0.5
+            elif pages > PREFILTER_MAX_INVOICE_PAGES:
+                score -= 1.5
+                reasons.append(f"pages:{pages}")
+
+            low = text.lower()
+            # Same test as extract_text_from_pdf: only short native text leads to OCR
+            needs_ocr = enable_ocr and len(text) < 200
+            if any(k in low for k in DEFAULT_KEYWORDS + TOTAL_KEYWORDS):
+                score += 2.0
+                reasons.append("text:invoice-keywords")
+            if any(w in low for w in PREFILTER_NEGATIVE_TEXT_WORDS):
+                score -= 1.5
+                reasons.append("text:non-invoice")
+
+        elif kind in IMAGE_KINDS:
+            pages = 1
+            needs_ocr = enable_ocr
+            try:
+                with Image.open(path) as img:
+                    width, height = img.size
+                if max(width, height) < PREFILTER_MIN_IMAGE_SIDE:
+                    score -= 2.0
+                    reasons.append(f"image:{width}x{height}")
+                elif width > 4 * height:
+                    score -= 1.0
+                    reasons.append("image:banner")
+            except Exception as e:
+                logger.debug("      Prefilter could not read image: %s", e)
+
+    estimated_ocr_seconds = 0.0
+    if needs_ocr:
+        op = "pdf_ocr" if kind == "pdf" else "image_ocr"
+        ocr_pages = min(pages, ocr_max_pages) if kind == "pdf" else 1
+        estimated_ocr_seconds = perf.get_average(op) or PREFILTER_DEFAULT_OCR_SECONDS * max(ocr_pages, 1)
+
+    keep = not needs_ocr or score >= threshold
+    logger.debug("      Prefilter score %+.1f (threshold %+.1f): %s %s", score, threshold, 'keep' if keep else 'skip', reasons)
+
+    return {
+        "keep": keep,
+        "score": round(score, 2),
+        "reasons": reasons,
+        "pages": pages,
+        "estimated_ocr_seconds": round(estimated_ocr_seconds, 3),
+    }
+
+
 # ============== OCR & TEXT EXTRACTION ==============
 
-def extract_text_from_pdf(pdf_path: Path, ocr: bool, ocr_max_pages: int, logger: logging.Logger, perf: PerformanceTracker) -> str:
-    txt = ""
+def _ocr_image(img: "Image.Image", fast: bool) -> str:
+    if fast:
+        img = img.convert("L")
+        if max(img.size) > OCR_FAST_MAX_SIDE:
+            img.thumbnail((OCR_FAST_MAX_SIDE, OCR_FAST_MAX_SIDE))
+        return pytesseract.image_to_string(img, config=OCR_FAST_CONFIG)
+    return pytesseract.image_to_string(img)
+
+
+def _has_confident_total(text: str, logger: logging.Logger) -> bool:
+    best = extract_best_total(text, logger)
+    return bool(best) and best["currency"] != "UNK" and best["score"] >= 100
+
+
+class RasterBudget:
+    """
+    Bytes and page slots for page rasters in flight. The rasterizer acquires
+    before rendering a page and the OCR worker releases once the page is done,
+    so a slow OCR pool throttles rendering instead of letting pages pile up.
+    A page larger than the whole budget is still let through when nothing
+    else is in flight.
+    """
+
+    def __init__(self, limit_bytes: int, max_pages: int):
+        self.limit_bytes = limit_bytes
+        self.max_pages = max(1, max_pages)
+        self.in_use = 0
+        self.pages = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, nbytes: int) -> None:
+        with self._cond:
+            while self.pages and (self.pages >= self.max_pages or self.in_use + nbytes > self.limit_bytes):
+                self._cond.wait()
+            self.in_use += nbytes
+            self.pages += 1
+
+    def release(self, nbytes: int) -> None:
+        with self._cond:
+            self.in_use -= nbytes
+            self.pages -= 1
+            self._cond.notify_all()
+
+
+def rasterize_pdf_pages(
+    pdf_path: Path,
+    last_page: int,
+    dpi: int,
+    grayscale: bool,
+    budget: RasterBudget,
+    logger: logging.Logger,
+    perf: PerformanceTracker,
+    max_side: Optional[int] = None,
+):
+    """
+    Yield (page_no, image, nbytes) one page at a time, rendered with PyMuPDF.
+    Each page is charged to `budget` before it is rendered; the consumer must
+    release nbytes once done with the image. A page whose raster would not fit
+    the budget on its own is rendered at a lower DPI instead, as is any page
+    longer than `max_side` pixels.
+    """
+    channels = 1 if grayscale else 3
+    colorspace = fitz.csGRAY if grayscale else fitz.csRGB
+    mode = "L" if grayscale else "RGB"
+    with fitz.open(str(pdf_path)) as doc:
+        for page_no in range(1, min(last_page, len(doc)) + 1):
+            page = doc[page_no - 1]
+            width_in, height_in = page.rect.width / 72, page.rect.height / 72
+            page_dpi = dpi
+            if max_side:
+                page_dpi = min(page_dpi, int(max_side / max(width_in, height_in, 1e-6)))
+            nbytes = int(width_in * page_dpi) * int(height_in * page_dpi) * channels
+            if nbytes > budget.limit_bytes:
+                page_dpi = max(1, int(page_dpi * (budget.limit_bytes / nbytes) ** 0.5))
+                nbytes = int(width_in * page_dpi) * int(height_in * page_dpi) * channels
+                perf.increment("ocr_pages_downscaled")
+                logger.debug("      Page %s rendered at %s DPI to stay under the OCR memory ceiling", page_no, page_dpi)
+
+            budget.acquire(nbytes)
+            try:
+                with perf.timer("pdf_rasterize"):
+                    pix = page.get_pixmap(dpi=page_dpi, colorspace=colorspace, alpha=False)
+                    img = Image.frombytes(mode, (pix.width, pix.height), pix.samples_mv)
+                    del pix
+            except BaseException:
+                budget.release(nbytes)
+                raise
+            yield page_no, img, nbytes
+
+
+def ocr_pdf_pages(
+    pdf_path: Path,
+    last_page: int,
+    logger: logging.Logger,
+    perf: PerformanceTracker,
+    dpi: int = OCR_DEFAULT_DPI,
+    fast: bool = False,
+    early_exit: bool = False,
+    workers: int = 1,
+    memory_mb: int = OCR_MEMORY_CEILING_MB,
+) -> List[str]:
+    """
+    OCR a PDF's first `last_page` pages, streaming them from rasterize_pdf_pages.
+    With workers > 1 a thread pool OCRs pages while later ones are rendered;
+    at most workers + 1 rasters, and no more than memory_mb of them, are alive
+    at once. Returns the page texts in page order. With early_exit, no more
+    pages are rendered once the pages so far contain a confident total.
+    """
+    budget = RasterBudget(memory_mb * 1024 * 1024, workers + 1)
+    pages = rasterize_pdf_pages(pdf_path, last_page, dpi, fast, budget, logger, perf,
+                                max_side=OCR_FAST_MAX_SIDE if fast else None)
+
+    def ocr_page(img: "Image.Image", nbytes: int) -> str:
+        try:
+            return _ocr_image(img, fast)
+        finally:
+            img.close()
+            budget.release(nbytes)
+
+    texts: Dict[int, str] = {}
+    checked = 0
+
+    def found_total() -> bool:
+        # Only look at the contiguous prefix of finished pages, like a sequential run would
+        nonlocal checked
+        while checked + 1 in texts:
+            checked += 1
+            if checked < last_page and _has_confident_total("\n".join(texts[i] for i in range(1, checked + 1)), logger):
+                logger.debug("      Total found on page %s, skipping remaining pages", checked)
+                perf.increment("ocr_early_exits")
+                return True
+        return False
 
-    # Try native text first
+    try:
+        if workers <= 1:
+            for page_no, img, nbytes in pages:
+                logger.debug("      OCR processing page %s/%s...", page_no, last_page)
+                texts[page_no] = ocr_page(img, nbytes)
+                perf.increment("ocr_pages")
+                if early_exit and found_total():
+                    break
+        else:
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ocr") as pool:
+                pending: Dict[Any, int] = {}
+
+                def collect(block: bool) -> None:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED) if block else (
+                        [fut for fut in pending if fut.done()], None)
+                    for fut in done:
+                        texts[pending.pop(fut)] = fut.result()
+                        perf.increment("ocr_pages")
+
+                for page_no, img, nbytes in pages:
+                    logger.debug("      OCR processing page %s/%s...", page_no, last_page)
+                    pending[pool.submit(ocr_page, img, nbytes)] = page_no
+                    collect(block=False)
+                    if early_exit and found_total():
+                        break
+                while pending:
+                    collect(block=True)
+    finally:
+        pages.close()
+    return [texts[i] for i in sorted(texts)]
+
+
+def pdf_native_text(pdf_path: Path, logger: logging.Logger, perf: PerformanceTracker) -> Tuple[str, int]:
+    """Embedded text of every page and the page count ("", 0 if the PDF cannot be read)."""
     with perf.timer("pdf_native_extraction"):
         try:
-            doc = fitz.open(str(pdf_path))
-            chunks = []
-            page_count = len(doc)
-            for page in doc:
-                chunks.append(page.get_text("text"))
-            txt = "\n".join(chunks).strip()
-            doc.close()
-            logger.debug(f"      PDF native text: {len(txt)} chars from {page_count} pages")
+            with fitz.open(str(pdf_path)) as doc:
+                page_count = len(doc)
+                txt = "\n".join(page.get_text("text") for page in doc).strip()
+            logger.debug("      PDF native text: %s chars from %s pages", len(txt), page_count)
+            return txt, page_count
         except Exception as e:
             logger.warning(f"      PDF native extraction failed: {e}")
-            txt = ""
+            return "", 0
+
+
+def extract_text_from_pdf(
+    pdf_path: Path,
+    ocr: bool,
+    ocr_max_pages: int,
+    logger: logging.Logger,
+    perf: PerformanceTracker,
+    dpi: int = OCR_DEFAULT_DPI,
+    fast: bool = False,
+    early_exit: bool = False,
+    workers: int = 1,
+    memory_mb: int = OCR_MEMORY_CEILING_MB,
+    native: Optional[Tuple[str, int]] = None,
+) -> str:
+    # Try native text first (unless the prefilter already read it)
+    txt, page_count = native if native is not None else pdf_native_text(pdf_path, logger, perf)
 
     # If text is too small, OCR it (scanned pdf)
     if ocr and len(txt) < 200:
-        logger.debug(f"      Text too short ({len(txt)} chars), attempting OCR...")
+        logger.debug("      Text too short (%s chars), attempting OCR...", len(txt))
         perf.increment("ocr_attempts")
 
-        with perf.timer("pdf_ocr"):
+        with perf.timer("pdf_ocr", item=pdf_path.name):
             try:
-                images = convert_from_path(str(pdf_path), first_page=1, last_page=min(ocr_max_pages, 50))
-                logger.debug(f"      Converted {len(images)} pages to images for OCR")
-
-                ocr_chunks = []
-                for i, img in enumerate(images[:ocr_max_pages]):
-                    logger.debug(f"      OCR processing page {i+1}/{len(images)}...")
-                    ocr_chunks.append(pytesseract.image_to_string(img))
-
+                last_page = min(ocr_max_pages, OCR_MAX_PDF_PAGES, page_count or OCR_MAX_PDF_PAGES)
+                ocr_chunks = ocr_pdf_pages(pdf_path, last_page, logger, perf, dpi=dpi, fast=fast,
+                                           early_exit=early_exit, workers=workers, memory_mb=memory_mb)
                 ocr_text = "\n".join(ocr_chunks)
                 txt = (txt + "\n\n" + ocr_text).strip()
-                logger.debug(f"      OCR extracted: {len(ocr_text)} chars")
+                logger.debug("      OCR extracted: %s chars", len(ocr_text))
                 perf.increment("ocr_success")
             except Exception as e:
                 logger.warning(f"      OCR failed: {e}")
@@ -778,15 +2152,16 @@ def extract_text_from_pdf(pdf_path: Path, ocr: bool, ocr_max_pages: int, logger:
     return txt
 
 
-def extract_text_from_image(img_path: Path, logger: logging.Logger, perf: PerformanceTracker) -> str:
-    logger.debug(f"      Extracting text from image via OCR...")
+def extract_text_from_image(img_path: Path, logger: logging.Logger, perf: PerformanceTracker, fast: bool = False) -> str:
+    logger.debug("      Extracting text from image via OCR...")
     perf.increment("image_ocr_attempts")
 
-    with perf.timer("image_ocr"):
+    with perf.timer("image_ocr", item=img_path.name):
         try:
             img = Image.open(img_path)
-            text = pytesseract.image_to_string(img).strip()
-            logger.debug(f"      Image OCR extracted: {len(text)} chars")
+            text = _ocr_image(img, fast).strip()
+            perf.increment("ocr_pages")
+            logger.debug("      Image OCR extracted: %s chars", len(text))
             perf.increment("image_ocr_success")
             return text
         except Exception as e:
@@ -796,35 +2171,52 @@ def extract_text_from_image(img_path: Path, logger: logging.Logger, perf: Perfor
 
 
 def extract_text_from_docx(docx_path: Path, logger: logging.Logger, perf: PerformanceTracker) -> str:
-    logger.debug(f"      Extracting text from DOCX...")
+    logger.debug("      Extracting text from DOCX...")
 
     with perf.timer("docx_extraction"):
         try:
             d = docx.Document(str(docx_path))
             text = "\n".join(p.text for p in d.paragraphs).strip()
-            logger.debug(f"      DOCX extracted: {len(text)} chars from {len(d.paragraphs)} paragraphs")
+            logger.debug("      DOCX extracted: %s chars from %s paragraphs", len(text), len(d.paragraphs))
             return text
         except Exception as e:
             logger.warning(f"      DOCX extraction failed: {e}")
             return ""
 
 
-def analyze_file(path: Path, enable_ocr: bool, ocr_max_pages: int, logger: logging.Logger, perf: PerformanceTracker) -> Dict[str, Any]:
+def analyze_file(
+    path: Path,
+    enable_ocr: bool,
+    ocr_max_pages: int,
+    logger: logging.Logger,
+    perf: PerformanceTracker,
+    kind: Optional[str] = None,
+    ocr_dpi: int = OCR_DEFAULT_DPI,
+    ocr_fast: bool = False,
+    ocr_early_exit: bool = False,
+    ocr_workers: int = 1,
+    ocr_memory_mb: int = OCR_MEMORY_CEILING_MB,
+    native: Optional[Tuple[str, int]] = None,
+) -> Dict[str, Any]:
     ext = path.suffix.lower()
     text = ""
 
-    logger.debug(f"      Analyzing file: {path.name} ({ext})")
+    # Route on content, not on the (possibly wrong) extension
+    kind = kind or sniff_file(path) or kind_for_ext(ext)
+    logger.debug("      Analyzing file: %s (%s)", path.name, kind or ext)
 
-    with perf.timer("file_analysis"):
-        if ext == ".pdf":
-            text = extract_text_from_pdf(path, enable_ocr, ocr_max_pages, logger, perf)
+    with perf.timer("file_analysis", item=path.name):
+        if kind == "pdf":
+            text = extract_text_from_pdf(path, enable_ocr, ocr_max_pages, logger, perf,
+                                         dpi=ocr_dpi, fast=ocr_fast, early_exit=ocr_early_exit,
+                                         workers=ocr_workers, memory_mb=ocr_memory_mb, native=native)
             perf.increment("pdfs_processed")
-        elif ext == ".docx":
+        elif kind == "docx":
             text = extract_text_from_docx(path, logger, perf)
             perf.increment("docx_processed")
-        elif ext in {".png", ".jpg", ".jpeg", ".tif", ".tiff", ".bmp", ".webp"}:
+        elif kind in IMAGE_KINDS:
             if enable_ocr:
-                text = extract_text_from_image(path, logger, perf)
+                text = extract_text_from_image(path, logger, perf, fast=ocr_fast)
             perf.increment("images_processed")
 
         best = extract_best_total(text, logger)
@@ -837,46 +2229,288 @@ def analyze_file(path: Path, enable_ocr: bool, ocr_max_pages: int, logger: loggi
 
 # ============== DASHBOARD GENERATION ==============
 
-def generate_dashboard_html(
-    account_label: str,
-    file_rows: List[Dict],
-    total_by_currency: Dict[str, float],
-    total_by_sender_currency: Dict[Tuple[str, str], float],
-    generated_at: str,
-    perf_summary: Dict[str, Any]
-) -> str:
-    """Generate an interactive HTML dashboard."""
+DASHBOARD_INLINE_MAX_ROWS = 500  # "auto" mode switches to the paged dashboard above this
 
-    # Prepare data for charts
-    currency_data = [{"currency": k, "amount": v} for k, v in sorted(total_by_currency.items(), key=lambda x: -x[1])]
+INLINE_TABLE_JS = '''
+        function filterTable() {
+            const input = document.getElementById('searchInput').value.toLowerCase();
+            const rows = document.querySelectorAll('#invoicesTable tbody tr');
+            rows.forEach(row => {
+                const text = row.textContent.toLowerCase();
+                row.style.display = text.includes(input) ? '' : 'none';
+            });
+        }
 
-    # Top 10 senders by total amount
-    sender_totals = defaultdict(float)
-    for (sender, curr), amt in total_by_sender_currency.items():
-        sender_totals[sender] += amt
-    top_senders = sorted(sender_totals.items(), key=lambda x: -x[1])[:10]
+        let sortDir = {};
+        function sortTable(col) {
+            const table = document.getElementById('invoicesTable');
+            const tbody = table.querySelector('tbody');
+            const rows = Array.from(tbody.querySelectorAll('tr'));
 
-    # Monthly breakdown
-    monthly_totals = defaultdict(lambda: defaultdict(float))
-    for row in file_rows:
-        try:
-            dt = datetime.fromisoformat(row["date_utc"].replace("Z", "+00:00"))
-            month_key = dt.strftime("%Y-%m")
-            monthly_totals[month_key][row["currency"]] += float(row["amount"])
-        except:
-            pass
+            sortDir[col] = !sortDir[col];
 
-    months_sorted = sorted(monthly_totals.keys())
+            rows.sort((a, b) => {
+                let aVal = a.cells[col]?.textContent || '';
+                let bVal = b.cells[col]?.textContent || '';
 
-    html = f'''<!DOCTYPE html>
-<html lang="en">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>Invoice Expenses Dashboard - {account_label}</title>
-    <script src="https://cdn.jsdelivr.net/npm/chart.js@4.4.1/dist/chart.umd.min.js"></script>
-    <style>
-        :root {{
+                if (col === 3) {
+                    aVal = parseFloat(aVal.replace(/[^0-9.-]/g, '')) || 0;
+                    bVal = parseFloat(bVal.replace(/[^0-9.-]/g, '')) || 0;
+                    return sortDir[col] ? aVal - bVal : bVal - aVal;
+                }
+
+                return sortDir[col] ? aVal.localeCompare(bVal) : bVal.localeCompare(aVal);
+            });
+
+            rows.forEach(row => tbody.appendChild(row));
+        }
+
+        function exportCSV() {
+            const headers = ['Date', 'Sender', 'Subject', 'Amount', 'Currency', 'Evidence'];
+            const csvContent = [
+                headers.join(','),
+                ...allRows.map(row => [
+                    row.date_utc || '',
+                    '"' + (row.sender || '').replace(/"/g, '""') + '"',
+                    '"' + (row.subject || '').replace(/"/g, '""') + '"',
+                    row.amount || '',
+                    row.currency || '',
+                    '"' + (row.evidence || '').replace(/"/g, '""') + '"'
+                ].join(','))
+            ].join('\\n');
+
+            const blob = new Blob([csvContent], { type: 'text/csv;charset=utf-8;' });
+            const link = document.createElement('a');
+            link.href = URL.createObjectURL(blob);
+            link.download = 'invoices_export.csv';
+            link.click();
+        }'''
+
+PAGED_TABLE_JS = r'''
+        // Paged table: rows live in a data array (dashboard_data.js); only the
+        // current page is ever materialized as DOM rows.
+        const PAGE_SIZE = 100;
+        const SYMBOLS = __SYMBOLS__;
+        const DATA = window.DASHBOARD_DATA || { rows: [] };
+        const allRows = DATA.rows;  // [date, sender, subject, amount, currency, evidence]
+        const searchIndex = allRows.map(r => (r[0] + ' ' + r[1] + ' ' + r[2] + ' ' + r[4] + ' ' + r[5]).toLowerCase());
+        let view = allRows.map((_, i) => i);
+        let page = 0;
+        let sortCol = 0;
+        let sortAsc = false;
+        let filterTimer = null;
+
+        function cell(text, cls, title) {
+            const td = document.createElement('td');
+            if (cls) td.className = cls;
+            if (title) td.title = title;
+            td.textContent = text;
+            return td;
+        }
+
+        function renderPage() {
+            const tbody = document.querySelector('#invoicesTable tbody');
+            const pages = Math.max(1, Math.ceil(view.length / PAGE_SIZE));
+            page = Math.min(Math.max(page, 0), pages - 1);
+            const frag = document.createDocumentFragment();
+            for (const i of view.slice(page * PAGE_SIZE, (page + 1) * PAGE_SIZE)) {
+                const r = allRows[i];
+                const tr = document.createElement('tr');
+                tr.appendChild(cell(r[0]));
+                tr.appendChild(cell(r[1].slice(0, 30), 'truncate', r[1]));
+                tr.appendChild(cell(r[2].slice(0, 40), 'truncate', r[2]));
+                tr.appendChild(cell((SYMBOLS[r[4]] || '') + r[3].toLocaleString('en-US', { minimumFractionDigits: 2, maximumFractionDigits: 2 }), 'amount'));
+                const badge = document.createElement('span');
+                badge.className = 'currency-badge ' + r[4];
+                badge.textContent = r[4];
+                const ctd = document.createElement('td');
+                ctd.appendChild(badge);
+                tr.appendChild(ctd);
+                tr.appendChild(cell(r[5].slice(0, 50), 'truncate', r[5]));
+                frag.appendChild(tr);
+            }
+            if (!view.length) {
+                const tr = document.createElement('tr');
+                const td = cell('No invoices found', 'empty-state');
+                td.colSpan = 6;
+                tr.appendChild(td);
+                frag.appendChild(tr);
+            }
+            tbody.replaceChildren(frag);
+            document.getElementById('pageInfo').textContent =
+                `Page ${page + 1} of ${pages} (${view.length.toLocaleString()} rows)`;
+        }
+
+        function sortView() {
+            const dir = sortAsc ? 1 : -1;
+            view.sort((a, b) => {
+                const x = allRows[a][sortCol];
+                const y = allRows[b][sortCol];
+                if (sortCol === 3) return (x - y) * dir;
+                return x < y ? -dir : x > y ? dir : 0;
+            });
+        }
+
+        function filterTable() {
+            clearTimeout(filterTimer);
+            filterTimer = setTimeout(() => {
+                const q = document.getElementById('searchInput').value.toLowerCase();
+                view = [];
+                for (let i = 0; i < allRows.length; i++) {
+                    if (!q || searchIndex[i].includes(q)) view.push(i);
+                }
+                sortView();
+                page = 0;
+                renderPage();
+            }, 150);
+        }
+
+        function sortTable(col) {
+            sortAsc = sortCol === col ? !sortAsc : true;
+            sortCol = col;
+            sortView();
+            page = 0;
+            renderPage();
+        }
+
+        function gotoPage(delta) {
+            page += delta;
+            renderPage();
+        }
+
+        function exportCSV() {
+            const headers = ['Date', 'Sender', 'Subject', 'Amount', 'Currency', 'Evidence'];
+            const q = v => '"' + String(v).replace(/"/g, '""') + '"';
+            const lines = [headers.join(',')];
+            for (const i of view) {
+                const r = allRows[i];
+                lines.push([r[0], q(r[1]), q(r[2]), r[3].toFixed(2), r[4], q(r[5])].join(','));
+            }
+            const blob = new Blob([lines.join('\n')], { type: 'text/csv;charset=utf-8;' });
+            const link = document.createElement('a');
+            link.href = URL.createObjectURL(blob);
+            link.download = 'invoices_export.csv';
+            link.click();
+        }
+
+        sortView();
+        renderPage();'''
+
+
+def generate_dashboard_html(
+    account_label: str,
+    file_rows: "InvoiceTable",
+    total_by_currency: Dict[str, float],
+    total_by_sender_currency: "SenderCurrencyTotals",
+    generated_at: str,
+    perf_summary: Dict[str, Any],
+    data_src: Optional[str] = None,
+    cost_rows: Optional[List[Dict[str, Any]]] = None,
+) -> str:
+    """
+    Generate an interactive HTML dashboard.
+    With `data_src` the invoice rows are not inlined: the page loads them from
+    that sidecar script (see write_dashboard_data) and pages through them.
+    `cost_rows` (from PerformanceTracker.cost_report) adds a processing-cost panel.
+    """
+
+    # Prepare data for charts
+    currency_data = [{"currency": k, "amount": v} for k, v in sorted(total_by_currency.items(), key=lambda x: -x[1])]
+
+    # Top 10 senders by total amount
+    sender_totals = defaultdict(float)
+    for (sender, curr), amt in total_by_sender_currency.items():
+        sender_totals[sender] += amt
+    top_senders = sorted(sender_totals.items(), key=lambda x: -x[1])[:10]
+
+    # Monthly breakdown
+    monthly_totals = defaultdict(lambda: defaultdict(float))
+    currencies = file_rows.pool.values
+    for date_utc, curr, amount in zip(file_rows.date_utc, file_rows.currency, file_rows.amount):
+        try:
+            dt = datetime.fromisoformat(date_utc.replace("Z", "+00:00"))
+            month_key = dt.strftime("%Y-%m")
+            monthly_totals[month_key][currencies[curr]] += amount
+        except:
+            pass
+
+    months_sorted = sorted(monthly_totals.keys())
+
+    if data_src:
+        # Paged mode: rows are loaded from the sidecar file, never inlined
+        invoice_rows_html = ""
+        rows_script = ""
+        data_script_tag = f'<script src="{data_src}"></script>'
+        pager_html = (
+            '<div class="pager"><button class="page-btn" onclick="gotoPage(-1)">&lsaquo; Prev</button>'
+            '<span id="pageInfo" class="meta"></span>'
+            '<button class="page-btn" onclick="gotoPage(1)">Next &rsaquo;</button></div>'
+        )
+        table_js = PAGED_TABLE_JS.replace("__SYMBOLS__", json.dumps(CURRENCY_SYMBOLS, ensure_ascii=False))
+    else:
+        invoice_rows_html = ''.join(f"""
+                        <tr>
+                            <td>{row.get('date_utc', '')[:10]}</td>
+                            <td class="truncate" title="{row.get('sender', '')}">{row.get('sender', '')[:30]}</td>
+                            <td class="truncate" title="{row.get('subject', '')}">{row.get('subject', '')[:40]}</td>
+                            <td class="amount">{CURRENCY_SYMBOLS.get(row.get('currency', 'UNK'), '')}{float(row.get('amount', 0)):,.2f}</td>
+                            <td><span class="currency-badge {row.get('currency', 'UNK')}">{row.get('currency', 'UNK')}</span></td>
+                            <td class="truncate" title="{row.get('evidence', '').replace('"', '&quot;')}">{row.get('evidence', '')[:50]}</td>
+                        </tr>
+                        """ for row in map(file_rows.row, file_rows.order_by_date(reverse=True))) if file_rows else '<tr><td colspan="6" class="empty-state">No invoices found</td></tr>'
+        rows_script = f"const allRows = {json.dumps(list(file_rows))};"
+        data_script_tag = ""
+        pager_html = ""
+        table_js = INLINE_TABLE_JS
+
+    cost_section_html = ""
+    if cost_rows:
+        cost_rows_html = ''.join(f"""
+                        <tr>
+                            <td class="truncate" title="{row['sender']}">{row['sender'][:40]}</td>
+                            <td><span class="action-badge {row['action']}">{row['action']}</span></td>
+                            <td class="amount">{row['total_seconds']:.1f}s</td>
+                            <td>{format_bytes(int(row['total_bytes']))}</td>
+                            <td>{int(row['ocr_pages'])} ({row['ocr_seconds']:.1f}s)</td>
+                            <td>{int(row['messages'])} / {row['files']}</td>
+                            <td>{int(row['invoices'])}</td>
+                        </tr>
+                        """ for row in cost_rows)
+        cost_section_html = f"""
+        <div class="table-section">
+            <div class="table-header">
+                <h3 class="table-title">Processing Cost by Sender (top {len(cost_rows)}, full list in cost_by_sender.csv)</h3>
+            </div>
+            <div class="table-wrapper">
+                <table>
+                    <thead>
+                        <tr>
+                            <th>Sender</th>
+                            <th>Suggested</th>
+                            <th>Time</th>
+                            <th>Data</th>
+                            <th>OCR Pages</th>
+                            <th>Emails / Files</th>
+                            <th>Invoices</th>
+                        </tr>
+                    </thead>
+                    <tbody>
+                        {cost_rows_html}
+                    </tbody>
+                </table>
+            </div>
+        </div>
+"""
+
+    html = f'''<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>Invoice Expenses Dashboard - {account_label}</title>
+    <script src="https://cdn.jsdelivr.net/npm/chart.js@4.4.1/dist/chart.umd.min.js"></script>
+    <style>
+        :root {{
             --bg-primary: #0a0a0f;
             --bg-secondary: #12121a;
             --bg-card: #1a1a24;
@@ -1125,6 +2759,40 @@ def generate_dashboard_html(
             white-space: nowrap;
         }}
 
+        .pager {{
+            display: flex;
+            justify-content: flex-end;
+            align-items: center;
+            gap: 1rem;
+            padding: 0.75rem 1.5rem;
+        }}
+
+        .page-btn {{
+            background: var(--bg-secondary);
+            border: 1px solid var(--border);
+            border-radius: 6px;
+            color: var(--text-primary);
+            padding: 0.375rem 0.875rem;
+            cursor: pointer;
+        }}
+
+        .page-btn:hover {{
+            border-color: var(--accent);
+        }}
+
+        .action-badge {{
+            display: inline-block;
+            padding: 0.25rem 0.5rem;
+            border-radius: 4px;
+            font-size: 0.75rem;
+            font-weight: 600;
+        }}
+
+        .action-badge.skip {{ background: rgba(236, 72, 153, 0.2); color: #ec4899; }}
+        .action-badge.template {{ background: rgba(245, 158, 11, 0.2); color: #f59e0b; }}
+        .action-badge.whitelist {{ background: rgba(34, 197, 94, 0.2); color: #22c55e; }}
+        .action-badge.review {{ background: rgba(99, 102, 241, 0.2); color: #818cf8; }}
+
         .perf-section {{
             background: var(--bg-card);
             border: 1px solid var(--border);
@@ -1283,19 +2951,11 @@ def generate_dashboard_html(
                         </tr>
                     </thead>
                     <tbody>
-                        {''.join(f"""
-                        <tr>
-                            <td>{row.get('date_utc', '')[:10]}</td>
-                            <td class="truncate" title="{row.get('sender', '')}">{row.get('sender', '')[:30]}</td>
-                            <td class="truncate" title="{row.get('subject', '')}">{row.get('subject', '')[:40]}</td>
-                            <td class="amount">{CURRENCY_SYMBOLS.get(row.get('currency', 'UNK'), '')}{float(row.get('amount', 0)):,.2f}</td>
-                            <td><span class="currency-badge {row.get('currency', 'UNK')}">{row.get('currency', 'UNK')}</span></td>
-                            <td class="truncate" title="{row.get('evidence', '').replace('"', '&quot;')}">{row.get('evidence', '')[:50]}</td>
-                        </tr>
-                        """ for row in sorted(file_rows, key=lambda x: x.get('date_utc', ''), reverse=True)) if file_rows else '<tr><td colspan="6" class="empty-state">No invoices found</td></tr>'}
+                        {invoice_rows_html}
                     </tbody>
                 </table>
             </div>
+            {pager_html}
         </div>
 
         <div class="table-section">
@@ -1323,13 +2983,15 @@ def generate_dashboard_html(
                 </table>
             </div>
         </div>
+        {cost_section_html}
     </div>
 
+    {data_script_tag}
     <script>
         const currencyData = {json.dumps(currency_data)};
         const topSenders = {json.dumps([{"sender": s[:25], "amount": a} for s, a in top_senders])};
         const monthlyData = {json.dumps({m: dict(d) for m, d in monthly_totals.items()})};
-        const allRows = {json.dumps(file_rows)};
+        {rows_script}
 
         // Currency Chart
         if (currencyData.length > 0) {{
@@ -1431,407 +3093,3341 @@ def generate_dashboard_html(
             }});
         }}
 
-        function filterTable() {{
-            const input = document.getElementById('searchInput').value.toLowerCase();
-            const rows = document.querySelectorAll('#invoicesTable tbody tr');
-            rows.forEach(row => {{
-                const text = row.textContent.toLowerCase();
-                row.style.display = text.includes(input) ? '' : 'none';
-            }});
-        }}
+{table_js}
+    </script>
+</body>
+</html>'''
 
-        let sortDir = {{}};
-        function sortTable(col) {{
-            const table = document.getElementById('invoicesTable');
-            const tbody = table.querySelector('tbody');
-            const rows = Array.from(tbody.querySelectorAll('tr'));
+    return html
 
-            sortDir[col] = !sortDir[col];
 
-            rows.sort((a, b) => {{
-                let aVal = a.cells[col]?.textContent || '';
-                let bVal = b.cells[col]?.textContent || '';
+def write_dashboard_data(path: Path, file_rows: "InvoiceTable") -> None:
+    """
+    Write invoice rows once, as compact arrays, to a sidecar for the paged dashboard.
+    It is a JSON document wrapped in a single assignment so the dashboard can load it
+    with a <script> tag straight from disk (fetch() is blocked for file:// pages).
+    """
+    v = file_rows.pool.values
+    rows = sorted(
+        ([file_rows.date_utc[i][:10], v[file_rows.sender[i]], file_rows.subject[i],
+          round(file_rows.amount[i], 2), v[file_rows.currency[i]], file_rows.evidence[i]]
+         for i in range(len(file_rows))),
+        key=lambda r: r[0], reverse=True,
+    )
+    payload = json.dumps({"rows": rows}, ensure_ascii=False, separators=(",", ":"))
+    # Keep "</script>" in subjects/evidence from terminating anything downstream
+    payload = payload.replace("</", "<\\/")
+    path.write_text(f"window.DASHBOARD_DATA = {payload};\n", encoding="utf-8")
 
-                if (col === 3) {{
-                    aVal = parseFloat(aVal.replace(/[^0-9.-]/g, '')) || 0;
-                    bVal = parseFloat(bVal.replace(/[^0-9.-]/g, '')) || 0;
-                    return sortDir[col] ? aVal - bVal : bVal - aVal;
-                }}
 
-                return sortDir[col] ? aVal.localeCompare(bVal) : bVal.localeCompare(aVal);
-            }});
+# Already-compressed formats are stored as-is; deflating them again only burns CPU
+ZIP_STORED_EXTS = {
+    ".pdf", ".jpg", ".jpeg", ".png", ".webp", ".gif", ".docx", ".xlsx",
+    ".zip", ".gz", ".bz2", ".xz", ".zst", ".parquet",
+}
 
-            rows.forEach(row => tbody.appendChild(row));
-        }}
+ZIP_PARALLEL_MAX_BYTES = 64 * 1024 * 1024  # bigger files are deflated by zipfile itself, streaming
+# _zip_write_raw/_zip_read_raw lean on CPython zipfile internals (3.8+); elsewhere only the public API is used
+ZIP_RAW_IO = (
+    platform.python_implementation() == "CPython" and sys.version_info >= (3, 8)
+    and all(hasattr(zipfile, a) for a in ("_FH_FILENAME_LENGTH", "_FH_EXTRA_FIELD_LENGTH"))
+    and hasattr(zipfile.ZipFile, "_writecheck")
+)
 
-        function exportCSV() {{
-            const headers = ['Date', 'Sender', 'Subject', 'Amount', 'Currency', 'Evidence'];
-            const csvContent = [
-                headers.join(','),
-                ...allRows.map(row => [
-                    row.date_utc || '',
-                    '"' + (row.sender || '').replace(/"/g, '""') + '"',
-                    '"' + (row.subject || '').replace(/"/g, '""') + '"',
-                    row.amount || '',
-                    row.currency || '',
-                    '"' + (row.evidence || '').replace(/"/g, '""') + '"'
-                ].join(','))
-            ].join('\\n');
 
-            const blob = new Blob([csvContent], {{ type: 'text/csv;charset=utf-8;' }});
-            const link = document.createElement('a');
-            link.href = URL.createObjectURL(blob);
-            link.download = 'invoices_export.csv';
-            link.click();
-        }}
-    </script>
-</body>
-</html>'''
+def _deflate_file(path: Path) -> Tuple[bytes, int, int, str]:
+    """Raw-deflate a file for the zip writer (zlib releases the GIL, so this runs in parallel)."""
+    data = path.read_bytes()
+    comp = zlib.compressobj(6, zlib.DEFLATED, -15)
+    payload = comp.compress(data) + comp.flush()
+    return payload, zlib.crc32(data), len(data), hashlib.sha256(data).hexdigest()
+
+
+def sha256_file(path: Path, chunk_size: int = 1024 * 1024) -> str:
+    h = hashlib.sha256()
+    with path.open("rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _zip_raw_ok(zf: zipfile.ZipFile) -> bool:
+    return ZIP_RAW_IO and all(hasattr(zf, a) for a in ("_lock", "_seekable", "_didModify", "start_dir", "fp"))
 
-    return html
+
+def _zip_write_raw(zf: zipfile.ZipFile, zinfo: zipfile.ZipInfo, payload: bytes) -> None:
+    """
+    Append an entry whose data is already compressed (or copied verbatim from
+    another archive). zipfile has no public API for this, so it mirrors what
+    ZipFile.open(mode="w") does internally; only call it when _zip_raw_ok(zf).
+    """
+    zinfo.compress_size = len(payload)
+    zinfo.flag_bits &= ~0x08  # sizes are in the local header, no data descriptor
+    with zf._lock:
+        if zf._seekable:
+            zf.fp.seek(zf.start_dir)
+        zinfo.header_offset = zf.fp.tell()
+        zf._writecheck(zinfo)
+        zf._didModify = True
+        zip64 = zinfo.file_size > zipfile.ZIP64_LIMIT or zinfo.compress_size > zipfile.ZIP64_LIMIT
+        zf.fp.write(zinfo.FileHeader(zip64))
+        zf.fp.write(payload)
+        zf.filelist.append(zinfo)
+        zf.NameToInfo[zinfo.filename] = zinfo
+        zf.start_dir = zf.fp.tell()
+
+
+def _zip_read_raw(fp, zinfo: zipfile.ZipInfo) -> bytes:
+    """Read an entry's compressed bytes straight from the archive, without inflating."""
+    fp.seek(zinfo.header_offset)
+    header = struct.unpack(zipfile.structFileHeader, fp.read(zipfile.sizeFileHeader))
+    name_len = header[zipfile._FH_FILENAME_LENGTH]
+    extra_len = header[zipfile._FH_EXTRA_FIELD_LENGTH]
+    fp.seek(name_len + extra_len, os.SEEK_CUR)
+    return fp.read(zinfo.compress_size)
 
 
 def create_zip_archive(out_dir: Path, account_label: str, logger: logging.Logger, perf: PerformanceTracker) -> Path:
-    """Create a zip file containing all outputs."""
-    logger.info(f"📦 Creating zip archive...")
+    """
+    Create or incrementally update a zip file containing all outputs.
+    A manifest next to the archive remembers size/mtime/sha256 per entry:
+    unchanged files are skipped (or copied raw from the previous archive),
+    new files are appended, and text outputs are deflated in parallel.
+    """
+    logger.info(f"📦 Updating zip archive...")
     zip_path = out_dir / f"{sanitize_filename(account_label)}_expenses_export.zip"
+    manifest_path = zip_path.with_name(zip_path.name + ".manifest.json")
+    tmp_zip_path = zip_path.with_name(zip_path.name + ".tmp")
 
     with perf.timer("create_zip"):
-        file_count = 0
-        total_size = 0
-
-        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zf:
-            for root, dirs, files in os.walk(out_dir):
-                for file in files:
-                    file_path = Path(root) / file
-                    if file_path == zip_path:
-                        continue
-                    arcname = file_path.relative_to(out_dir)
-                    zf.write(file_path, arcname)
-                    file_count += 1
-                    total_size += file_path.stat().st_size
+        start = time.time()
+        manifest: Dict[str, Dict[str, Any]] = {}
+        manifest_loaded = False
+        if zip_path.exists() and manifest_path.exists():
+            try:
+                manifest = json.loads(manifest_path.read_text(encoding="utf-8"))
+                manifest_loaded = isinstance(manifest, dict)
+            except (OSError, ValueError):
+                pass
+            if not manifest_loaded:
+                manifest = {}
+
+        current: Dict[str, Tuple[Path, os.stat_result]] = {}
+        for root, dirs, files in os.walk(out_dir):
+            for file in files:
+                file_path = Path(root) / file
+                if file_path in (zip_path, manifest_path, tmp_zip_path):
+                    continue
+                current[str(file_path.relative_to(out_dir).as_posix())] = (file_path, file_path.stat())
+
+        unchanged, changed, added = [], [], []
+        new_manifest: Dict[str, Dict[str, Any]] = {}
+        for arcname, (file_path, st) in sorted(current.items()):
+            old = manifest.get(arcname)
+            entry = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha256": old.get("sha256") if old else None}
+            if old and old["size"] == st.st_size and old["mtime_ns"] == st.st_mtime_ns:
+                unchanged.append(arcname)
+            elif old and old["size"] == st.st_size and old.get("sha256"):
+                # Touched but maybe not modified: only now pay for hashing
+                entry["sha256"] = sha256_file(file_path)
+                (unchanged if entry["sha256"] == old["sha256"] else changed).append(arcname)
+            else:
+                (changed if old else added).append(arcname)
+            new_manifest[arcname] = entry
+        removed = [a for a in manifest if a not in current]
+
+        to_write = changed + added
+        # Without a manifest the archive's contents are unknown: appending could duplicate entries
+        rebuild = bool(changed or removed) or not manifest_loaded
+        def save_manifest() -> None:
+            tmp_manifest = manifest_path.with_name(manifest_path.name + ".tmp")
+            tmp_manifest.write_text(json.dumps(new_manifest), encoding="utf-8")
+            os.replace(tmp_manifest, manifest_path)
+
+        if not rebuild and not to_write:
+            if new_manifest != manifest:
+                save_manifest()  # remember new mtimes of touched-but-identical files
+            logger.info(f"   Archive up to date ({len(unchanged)} files)")
+            return zip_path
+
+        bytes_in = 0
+
+        def write_entries(zf: zipfile.ZipFile, arcnames: List[str]) -> None:
+            nonlocal bytes_in
+            parallel = []
+            raw_ok = _zip_raw_ok(zf)
+            for arcname in arcnames:
+                file_path, st = current[arcname]
+                bytes_in += st.st_size
+                if file_path.suffix.lower() in ZIP_STORED_EXTS:
+                    zf.write(file_path, arcname, compress_type=zipfile.ZIP_STORED)
+                    new_manifest[arcname]["sha256"] = sha256_file(file_path)
+                    perf.increment("zip_files_stored")
+                elif st.st_size > ZIP_PARALLEL_MAX_BYTES or not raw_ok:
+                    zf.write(file_path, arcname, compress_type=zipfile.ZIP_DEFLATED)
+                    new_manifest[arcname]["sha256"] = sha256_file(file_path)
+                    perf.increment("zip_files_deflated")
+                else:
+                    parallel.append(arcname)
+
+            workers = min(8, os.cpu_count() or 1)
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                # Bounded window so only a few compressed payloads are held at once
+                for i in range(0, len(parallel), workers * 2):
+                    batch = parallel[i:i + workers * 2]
+                    for arcname, (payload, crc, size, digest) in zip(batch, pool.map(lambda a: _deflate_file(current[a][0]), batch)):
+                        new_manifest[arcname]["sha256"] = digest
+                        zinfo = zipfile.ZipInfo.from_file(current[arcname][0], arcname)
+                        zinfo.compress_type = zipfile.ZIP_DEFLATED
+                        zinfo.CRC = crc
+                        zinfo.file_size = size
+                        _zip_write_raw(zf, zinfo, payload)
+                        perf.increment("zip_files_deflated")
+
+        if rebuild:
+            reused = 0
+            with zipfile.ZipFile(tmp_zip_path, "w", zipfile.ZIP_DEFLATED) as zf:
+                if zip_path.exists() and unchanged:
+                    raw_ok = _zip_raw_ok(zf)
+                    with zipfile.ZipFile(zip_path, "r") as old_zf, zip_path.open("rb") as old_fp:
+                        for arcname in unchanged:
+                            try:
+                                info = old_zf.getinfo(arcname)
+                            except KeyError:
+                                to_write.append(arcname)
+                                continue
+                            if raw_ok:
+                                _zip_write_raw(zf, info, _zip_read_raw(old_fp, info))
+                            else:
+                                zf.writestr(info, old_zf.read(info))
+                            reused += 1
+                else:
+                    to_write = unchanged + to_write
+                write_entries(zf, to_write)
+            os.replace(tmp_zip_path, zip_path)
+        else:
+            reused = len(unchanged)
+            with zipfile.ZipFile(zip_path, "a", zipfile.ZIP_DEFLATED) as zf:
+                write_entries(zf, to_write)
+
+        save_manifest()
 
+        elapsed = time.time() - start
         zip_size = zip_path.stat().st_size
-        logger.info(f"   Archived {file_count} files ({format_bytes(total_size)} -> {format_bytes(zip_size)})")
+        perf.increment("zip_files_written", len(to_write))
+        perf.increment("zip_files_reused", reused)
+        perf.increment("zip_bytes_in", bytes_in)
+        throughput = bytes_in / elapsed if elapsed > 0 else 0
+        logger.info(
+            f"   Archived {len(current)} files: {len(to_write)} written, {reused} reused, {len(removed)} removed "
+            f"({format_bytes(bytes_in)} in {elapsed:.2f}s, {format_bytes(throughput)}/s) -> {format_bytes(zip_size)}"
+        )
 
     return zip_path
 
 
-# ============== MAIN PROCESSING ==============
+# ============== COMPACT RECORDS ==============
 
-def run_account(
-    account_label: str,
-    creds_path: Path,
-    token_path: Path,
-    out_dir: Path,
-    keywords: List[str],
-    after_yyyy_mm_dd: str,
-    max_messages: int,
-    max_attachment_mb: int,
-    enable_ocr: bool,
-    ocr_max_pages: int,
-    allow_duplicates: bool,
-    create_zip: bool,
-    logger: logging.Logger,
-    perf: PerformanceTracker,
-) -> None:
-    logger.info("")
-    logger.info("=" * 60)
-    logger.info(f"🚀 STARTING ACCOUNT: {account_label}")
-    logger.info("=" * 60)
-    logger.info("")
+class StringPool:
+    """Interns repeated strings (accounts, senders, currencies, methods) as small int ids."""
 
-    # Auth
-    creds = load_or_auth(creds_path, token_path, logger, perf)
-    service = gmail_service(creds)
+    __slots__ = ("ids", "values")
 
-    # Build query
-    query = build_gmail_query(keywords, after_yyyy_mm_dd)
-    logger.info(f"🔍 Search parameters:")
-    logger.info(f"   Keywords: {len(keywords)} terms")
-    logger.info(f"   Date filter: after {after_yyyy_mm_dd}")
-    logger.info(f"   Max messages: {max_messages}")
-    logger.info(f"   OCR enabled: {enable_ocr}")
-    logger.debug(f"   Full query: {query}")
+    def __init__(self):
+        self.ids: Dict[str, int] = {}
+        self.values: List[str] = []
 
-    # Get messages
-    msg_ids = list_messages(service, query, max_messages, logger, perf)
+    def id(self, value: str) -> int:
+        i = self.ids.get(value)
+        if i is None:
+            i = self.ids[value] = len(self.values)
+            self.values.append(value)
+        return i
 
-    if not msg_ids:
-        logger.warning("No messages found matching criteria!")
-        return
+    def __getitem__(self, i: int) -> str:
+        return self.values[i]
 
-    # Setup directories
-    ensure_dir(out_dir)
-    downloads_dir = out_dir / "downloads"
-    ensure_dir(downloads_dir)
+    def __len__(self) -> int:
+        return len(self.values)
 
-    log_file = out_dir / "processing.log"
 
-    # Add file handler for this account
-    file_handler = logging.FileHandler(log_file, encoding='utf-8')
-    file_handler.setLevel(logging.DEBUG)
-    file_handler.setFormatter(logging.Formatter(
-        '%(asctime)s | %(levelname)-8s | %(message)s',
-        datefmt='%Y-%m-%d %H:%M:%S'
-    ))
-    logger.addHandler(file_handler)
+class DigestSet:
+    """
+    Set of SHA-256 digests kept as 32-byte binary values. Takes and yields the
+    usual hex strings, in about 30% less memory than a set of them.
+    """
 
-    results_path = out_dir / "results.jsonl"
+    __slots__ = ("_digests",)
+
+    def __init__(self, hex_digests=()):
+        self._digests = {bytes.fromhex(h) for h in hex_digests}
+
+    def add(self, hex_digest: str) -> None:
+        self._digests.add(bytes.fromhex(hex_digest))
+
+    def update(self, hex_digests) -> None:
+        self._digests.update(bytes.fromhex(h) for h in hex_digests)
+
+    def __contains__(self, hex_digest: str) -> bool:
+        return bytes.fromhex(hex_digest) in self._digests
+
+    def __iter__(self):
+        return (d.hex() for d in self._digests)
+
+    def __len__(self) -> int:
+        return len(self._digests)
+
+
+class SenderCurrencyTotals:
+    """
+    Running sums per (sender, currency), keyed by the packed pair of interned
+    ids rather than by a tuple of strings. items() yields the usual
+    ((sender, currency), amount) pairs.
+    """
+
+    __slots__ = ("pool", "_sums", "count")
+
+    def __init__(self, pool: Optional[StringPool] = None):
+        self.pool = pool if pool is not None else StringPool()
+        self._sums: Dict[int, float] = defaultdict(float)
+        self.count = 0
+
+    def add_ids(self, sender_id: int, currency_id: int, amount: float) -> None:
+        self._sums[(sender_id << 32) | currency_id] += amount
+        self.count += 1
+
+    def add(self, sender: str, currency: str, amount: float) -> None:
+        self.add_ids(self.pool.id(sender), self.pool.id(currency), amount)
+
+    def merge(self, other: "SenderCurrencyTotals") -> None:
+        for (sender, currency), amount in other.items():
+            self._sums[(self.pool.id(sender) << 32) | self.pool.id(currency)] += amount
+        self.count += other.count
+
+    def items(self):
+        values = self.pool.values
+        return (((values[key >> 32], values[key & 0xFFFFFFFF]), amount) for key, amount in self._sums.items())
+
+    def by_currency(self) -> Dict[str, float]:
+        totals: Dict[str, float] = defaultdict(float)
+        for (_, currency), amount in self.items():
+            totals[currency] += amount
+        return dict(totals)
+
+    def __len__(self) -> int:
+        return len(self._sums)
+
+
+class InvoiceTable:
+    """
+    Invoice rows in the expenses_totals.csv shape, stored by column: account,
+    sender, currency and method as interned ids in int arrays, amounts as a
+    float array, the free-text fields as plain lists. The CSV export, the
+    totals and the dashboard read the columns directly; iterating yields
+    per-row dicts for the few callers that want them.
+    """
+
+    __slots__ = ("pool", "account", "sender", "currency", "method", "amount",
+                 "date_utc", "subject", "file", "evidence")
+
+    def __init__(self, pool: Optional[StringPool] = None):
+        self.pool = pool if pool is not None else StringPool()
+        self.account = array("I")
+        self.sender = array("I")
+        self.currency = array("I")
+        self.method = array("I")
+        self.amount = array("d")
+        self.date_utc: List[str] = []
+        self.subject: List[str] = []
+        self.file: List[str] = []
+        self.evidence: List[str] = []
+
+    def append(self, account: str, date_utc: str, sender: str, subject: str, file: str,
+               currency: str, amount: float, evidence: str, method: str) -> None:
+        intern = self.pool.id
+        self.account.append(intern(account))
+        self.sender.append(intern(sender))
+        self.currency.append(intern(currency))
+        self.method.append(intern(method))
+        self.amount.append(amount)
+        self.date_utc.append(date_utc or "")
+        self.subject.append(subject or "")
+        self.file.append(file or "")
+        self.evidence.append(evidence or "")
+
+    def __len__(self) -> int:
+        return len(self.amount)
+
+    def row_tuple(self, i: int) -> Tuple[str, ...]:
+        """Row i as a tuple in TOTALS_CSV_FIELDS order."""
+        v = self.pool.values
+        return (v[self.account[i]], self.date_utc[i], v[self.sender[i]], self.subject[i], self.file[i],
+                v[self.currency[i]], f"{self.amount[i]:.2f}", self.evidence[i], v[self.method[i]])
+
+    def row(self, i: int) -> Dict[str, str]:
+        return dict(zip(TOTALS_CSV_FIELDS, self.row_tuple(i)))
+
+    def __iter__(self):
+        return map(self.row, range(len(self)))
+
+    def order_by_date(self, reverse: bool = False) -> List[int]:
+        return sorted(range(len(self)), key=self.date_utc.__getitem__, reverse=reverse)
+
+    def write_csv(self, f) -> None:
+        w = csv.writer(f)
+        w.writerow(TOTALS_CSV_FIELDS)
+        w.writerows(self.row_tuple(i) for i in range(len(self)))
+
+    def totals_by_sender_currency(self) -> SenderCurrencyTotals:
+        totals = SenderCurrencyTotals(self.pool)
+        for s, c, amount in zip(self.sender, self.currency, self.amount):
+            totals.add_ids(s, c, amount)
+        return totals
+
+    def totals_by_currency(self) -> Dict[str, float]:
+        sums: Dict[int, float] = defaultdict(float)
+        for c, amount in zip(self.currency, self.amount):
+            sums[c] += amount
+        return {self.pool[c]: amount for c, amount in sums.items()}
+
+
+def synthetic_invoice_records(n: int, seed: int = 0, senders: int = 500) -> List[Tuple[Any, ...]]:
+    """Realistic-looking invoice row tuples (TOTALS_CSV_FIELDS order, float amount) for memory benchmarks."""
+    rng = random.Random(seed)
+    currencies = ["ILS", "USD", "EUR", "GBP"]
+    start = datetime(2024, 1, 1)
+    records = []
+    for i in range(n):
+        s = rng.randrange(senders)
+        records.append((
+            "me@example.com",
+            (start + timedelta(minutes=rng.randrange(525600))).isoformat() + "Z",
+            f"billing@vendor{s}.com",
+            f"Your invoice #{rng.randrange(10 ** 6):06d} from Vendor {s}",
+            f"invoice_{i:07d}.pdf",
+            currencies[s % len(currencies)],
+            round(rng.uniform(5, 5000), 2),
+            f"Total due {rng.uniform(5, 5000):,.2f} payable within 30 days of the invoice date",
+            "regex",
+        ))
+    return records
+
+
+def measure_record_memory(n: int) -> Dict[str, Any]:
+    """
+    Traced memory of n invoice rows as dicts of strings vs an InvoiceTable, and
+    of n hashes as a set of hex strings vs a DigestSet.
+    """
+    def traced(build):
+        tracemalloc.start()
+        try:
+            keep = build()
+            size = tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+        del keep
+        return size
+
+    def fresh(r: Tuple[Any, ...]) -> Tuple[Any, ...]:
+        # New string objects per row, like values read back from SQLite: nothing is shared unless interned
+        return tuple(v.encode().decode() if isinstance(v, str) else v for v in r)
+
+    records = synthetic_invoice_records(n)
+
+    def as_dicts():
+        return [dict(zip(TOTALS_CSV_FIELDS, r[:6] + (f"{r[6]:.2f}",) + r[7:])) for r in map(fresh, records)]
+
+    def as_table():
+        table = InvoiceTable()
+        for r in map(fresh, records):
+            table.append(*r)
+        return table
+
+    rng = random.Random(0)
+    hashes = [f"{rng.getrandbits(256):064x}" for _ in range(n)]
+    dict_bytes = traced(as_dicts)
+    table_bytes = traced(as_table)
+    hex_bytes = traced(lambda: {h.encode().decode() for h in hashes})
+    digest_bytes = traced(lambda: DigestSet(hashes))
+    per_100k = 100_000 / n
+    return {
+        "rows": n,
+        "peak_kb": round((table_bytes + digest_bytes) / 1024, 1),
+        "dict_rows_mb_per_100k": round(dict_bytes * per_100k / 2 ** 20, 1),
+        "table_mb_per_100k": round(table_bytes * per_100k / 2 ** 20, 1),
+        "hex_hashes_mb_per_100k": round(hex_bytes * per_100k / 2 ** 20, 1),
+        "digests_mb_per_100k": round(digest_bytes * per_100k / 2 ** 20, 1),
+    }
+
+
+# ============== OUTPUT WRITERS ==============
+
+TOTALS_CSV_FIELDS = [
+    "account", "date_utc", "sender", "subject", "file",
+    "currency", "amount", "evidence", "method"
+]
+
+
+class StreamingExpenseWriter:
+    """
+    Append invoice rows to expenses_totals.csv as they are detected and keep
+    per-sender / per-currency totals as running accumulators. The small
+    aggregate CSVs are rewritten atomically on every flush, so an interrupted
+    run still leaves consistent partial results on disk.
+    """
+
+    def __init__(
+        self,
+        out_dir: Path,
+        logger: logging.Logger,
+        flush_every: int = 25,
+        flush_interval: float = 10.0,
+        append: bool = False,
+    ):
+        self.logger = logger
+        self.totals_csv = out_dir / "expenses_totals.csv"
+        self.by_sender_csv = out_dir / "expenses_by_sender.csv"
+        self.by_currency_csv = out_dir / "expenses_by_currency.csv"
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+
+        self.total_by_currency: Dict[str, float] = defaultdict(float)
+        self.total_by_sender_currency = SenderCurrencyTotals()
+        self.row_count = 0
+
+        self._pending = 0
+        self._last_flush = time.time()
+        append = append and self.totals_csv.exists()
+        self._f = self.totals_csv.open("a" if append else "w", encoding="utf-8", newline="")
+        self._writer = csv.DictWriter(self._f, fieldnames=TOTALS_CSV_FIELDS)
+        if not append:
+            self._writer.writeheader()
+
+    def restore_totals(self, totals: SenderCurrencyTotals) -> None:
+        """Seed the running totals with the invoice totals replayed from a checkpoint."""
+        self.total_by_sender_currency.merge(totals)
+        for currency, amount in totals.by_currency().items():
+            self.total_by_currency[currency] += amount
+        self.row_count += totals.count
+
+    def add(self, row: Dict[str, str], sender: str, currency: str, amount: float) -> None:
+        """Append one invoice row and update the running totals."""
+        self._writer.writerow(row)
+        self.total_by_currency[currency] += amount
+        self.total_by_sender_currency.add(sender, currency, amount)
+        self.row_count += 1
+        self._pending += 1
+
+    def maybe_flush(self) -> bool:
+        """Flush if enough rows or time have accumulated. Returns True if flushed."""
+        if self._pending >= self.flush_every or (
+            self._pending and time.time() - self._last_flush >= self.flush_interval
+        ):
+            self.flush()
+            return True
+        return False
+
+    def flush(self) -> None:
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self._write_aggregates()
+        self._pending = 0
+        self._last_flush = time.time()
+
+    def _write_aggregates(self) -> None:
+        tmp = self.by_sender_csv.with_suffix(".csv.tmp")
+        with tmp.open("w", encoding="utf-8", newline="") as f:
+            w = csv.writer(f)
+            w.writerow(["sender", "currency", "sum_amount"])
+            for (sender, curr), amt in sorted(self.total_by_sender_currency.items(), key=lambda x: (-x[1], x[0][0], x[0][1])):
+                w.writerow([sender, curr, f"{amt:.2f}"])
+        os.replace(tmp, self.by_sender_csv)
+
+        tmp = self.by_currency_csv.with_suffix(".csv.tmp")
+        with tmp.open("w", encoding="utf-8", newline="") as f:
+            w = csv.writer(f)
+            w.writerow(["currency", "sum_amount"])
+            for curr, amt in sorted(self.total_by_currency.items(), key=lambda x: -x[1]):
+                w.writerow([curr, f"{amt:.2f}"])
+        os.replace(tmp, self.by_currency_csv)
+
+    def close(self) -> None:
+        if self._f.closed:
+            return
+        self.flush()
+        self._f.close()
+
+    def __enter__(self) -> "StreamingExpenseWriter":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
+
+
+# ============== RESULTS STORE ==============
+
+RESULTS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    account TEXT NOT NULL,
+    message_id TEXT NOT NULL,
+    date_utc TEXT,
+    from_raw TEXT,
+    sender_email TEXT,
+    sender_name TEXT,
+    sender_key TEXT,
+    subject TEXT,
+    links TEXT,
+    processed_at TEXT,
+    PRIMARY KEY (account, message_id)
+);
+CREATE TABLE IF NOT EXISTS attachments (
+    id INTEGER PRIMARY KEY,
+    account TEXT NOT NULL,
+    message_id TEXT NOT NULL,
+    filename TEXT,
+    saved_as TEXT,
+    mime_type TEXT,
+    size INTEGER,
+    sha256 TEXT,
+    kind TEXT
+);
+CREATE TABLE IF NOT EXISTS analyses (
+    id INTEGER PRIMARY KEY,
+    account TEXT NOT NULL,
+    message_id TEXT NOT NULL,
+    file TEXT,
+    extracted_text_len INTEGER,
+    best_total TEXT,
+    prefilter TEXT
+);
+CREATE TABLE IF NOT EXISTS invoices (
+    id INTEGER PRIMARY KEY,
+    account TEXT NOT NULL,
+    message_id TEXT NOT NULL,
+    date_utc TEXT,
+    sender TEXT,
+    subject TEXT,
+    file TEXT,
+    sha256 TEXT,
+    currency TEXT,
+    amount REAL,
+    evidence TEXT,
+    method TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_messages_sender ON messages (sender_key);
+CREATE INDEX IF NOT EXISTS idx_messages_date ON messages (date_utc);
+CREATE INDEX IF NOT EXISTS idx_attachments_message ON attachments (account, message_id);
+CREATE INDEX IF NOT EXISTS idx_attachments_sha256 ON attachments (sha256);
+CREATE INDEX IF NOT EXISTS idx_analyses_message ON analyses (account, message_id);
+CREATE INDEX IF NOT EXISTS idx_invoices_message ON invoices (account, message_id);
+CREATE INDEX IF NOT EXISTS idx_invoices_sender ON invoices (sender, currency);
+CREATE INDEX IF NOT EXISTS idx_invoices_date ON invoices (date_utc);
+CREATE INDEX IF NOT EXISTS idx_invoices_currency ON invoices (currency, date_utc);
+CREATE INDEX IF NOT EXISTS idx_invoices_sha256 ON invoices (sha256);
+"""
+
+
+class ResultsStore:
+    """
+    SQLite store holding every processed message, attachment, analysis and
+    detected invoice. This is the canonical output: the CSVs and dashboard
+    are generated from it, and reopening it lets a later run skip messages
+    that were already processed.
+    """
+
+    def __init__(self, path: Path, logger: logging.Logger, batch_size: int = 50):
+        self.path = path
+        self.logger = logger
+        self.batch_size = batch_size
+        self._pending = 0
+        self.conn = sqlite3.connect(str(path))
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(RESULTS_SCHEMA)
+        self.conn.commit()
+
+    def reset_account(self, account: str) -> None:
+        """Drop everything stored for an account (fresh, non-incremental run)."""
+        for table in ("messages", "attachments", "analyses", "invoices"):
+            self.conn.execute(f"DELETE FROM {table} WHERE account = ?", (account,))
+        self.conn.commit()
+
+    def known_message_ids(self, account: str) -> set:
+        return {r[0] for r in self.conn.execute(
+            "SELECT message_id FROM messages WHERE account = ?", (account,)
+        )}
+
+    def known_hashes(self, account: str) -> DigestSet:
+        return DigestSet(r[0] for r in self.conn.execute(
+            "SELECT DISTINCT sha256 FROM attachments WHERE account = ? AND sha256 IS NOT NULL", (account,)
+        ))
+
+    def add_message(self, record: Dict[str, Any], invoices: List[Dict[str, Any]]) -> None:
+        """Insert one message with its attachments, analyses and invoices."""
+        account = record["account"]
+        msg_id = record["message_id"]
+        c = self.conn
+        for table in ("attachments", "analyses", "invoices"):
+            c.execute(f"DELETE FROM {table} WHERE account = ? AND message_id = ?", (account, msg_id))
+
+        c.execute(
+            "INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (account, msg_id, record["date_utc"], record["from_raw"], record["sender_email"],
+             record["sender_name"], record["sender_key"], record["subject"],
+             json.dumps(record["links"], ensure_ascii=False), datetime.now().isoformat(timespec="seconds")),
+        )
+        c.executemany(
+            "INSERT INTO attachments (account, message_id, filename, saved_as, mime_type, size, sha256, kind) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [(account, msg_id, d["filename"], d["saved_as"], d["mimeType"], d["size"], d["sha256"], d.get("kind"))
+             for d in record["attachments_downloaded"]],
+        )
+        c.executemany(
+            "INSERT INTO analyses (account, message_id, file, extracted_text_len, best_total, prefilter) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            [(account, msg_id, a["file"],
+              (a["analysis"] or {}).get("extracted_text_len"),
+              json.dumps((a["analysis"] or {}).get("best_total"), ensure_ascii=False),
+              json.dumps(a.get("prefilter"), ensure_ascii=False) if a.get("prefilter") else None)
+             for a in record["attachments_analyzed"]],
+        )
+        c.executemany(
+            "INSERT INTO invoices (account, message_id, date_utc, sender, subject, file, sha256, currency, amount, evidence, method) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [(account, msg_id, r["date_utc"], r["sender"], r["subject"], r["file"], r.get("sha256"),
+              r["currency"], float(r["amount"]), r["evidence"], r["method"])
+             for r in invoices],
+        )
+
+        self._pending += 1
+        if self._pending >= self.batch_size:
+            self.commit()
+
+    def commit(self) -> None:
+        self.conn.commit()
+        self._pending = 0
+
+    def invoice_rows(self, account: str, message_ids: Optional[set] = None) -> InvoiceTable:
+        """Invoice rows in the expenses_totals.csv shape, optionally limited to some messages."""
+        cur = self.conn.execute(
+            "SELECT account, date_utc, sender, subject, file, currency, amount, evidence, method, message_id "
+            "FROM invoices WHERE account = ? ORDER BY date_utc, id", (account,)
+        )
+        table = InvoiceTable()
+        for row in cur:
+            if message_ids is None or row[9] in message_ids:
+                table.append(*row[:9])
+        return table
+
+    def invoice_records(self, account: str):
+        """Every stored invoice column (message_id, sha256 and float amount included), in date order."""
+        cur = self.conn.execute(
+            "SELECT account, message_id, date_utc, sender, subject, file, sha256, currency, amount, evidence, method "
+            "FROM invoices WHERE account = ? ORDER BY date_utc, id", (account,)
+        )
+        names = [d[0] for d in cur.description]
+        return (dict(zip(names, row)) for row in cur)
+
+    def message_summaries(self, account: str):
+        """One row per stored message with its link, attachment, byte and invoice counts."""
+        cur = self.conn.execute(
+            "SELECT m.account, m.message_id, m.date_utc, m.sender_key, m.sender_email, m.subject, m.links, "
+            "(SELECT COUNT(*) FROM attachments a WHERE a.account = m.account AND a.message_id = m.message_id), "
+            "(SELECT COUNT(*) FROM analyses n WHERE n.account = m.account AND n.message_id = m.message_id), "
+            "(SELECT COALESCE(SUM(size), 0) FROM attachments a WHERE a.account = m.account AND a.message_id = m.message_id), "
+            "(SELECT COUNT(*) FROM invoices i WHERE i.account = m.account AND i.message_id = m.message_id) "
+            "FROM messages m WHERE m.account = ? ORDER BY m.date_utc, m.message_id", (account,)
+        )
+        for row in cur:
+            yield {
+                "account": row[0], "message_id": row[1], "date_utc": row[2], "sender_key": row[3],
+                "sender_email": row[4], "subject": row[5], "link_count": len(json.loads(row[6] or "[]")),
+                "attachments_downloaded": row[7], "attachments_analyzed": row[8],
+                "bytes_downloaded": row[9], "invoices": row[10],
+            }
+
+    def close(self) -> None:
+        self.commit()
+        self.conn.close()
+
+    def __enter__(self) -> "ResultsStore":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
+
+
+# ============== BLOB STORE ==============
+
+BLOB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS blobs (
+    sha256 TEXT PRIMARY KEY,
+    size INTEGER,
+    kind TEXT,
+    first_seen TEXT
+);
+CREATE TABLE IF NOT EXISTS attachment_keys (
+    message_key TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    PRIMARY KEY (message_key, filename, size)
+);
+CREATE TABLE IF NOT EXISTS analyses (
+    sha256 TEXT NOT NULL,
+    config TEXT NOT NULL,
+    analysis TEXT,
+    PRIMARY KEY (sha256, config)
+);
+"""
+
+ANALYSIS_CACHE_VERSION = 2  # bump when text extraction or amount detection changes, to drop cached analyses
+FICLONE = 0x40049409  # Linux ioctl: copy-on-write clone (btrfs, XFS)
+
+
+def link_or_copy(src: Path, dst: Path) -> str:
+    """Make dst a hardlink of src, else a reflink, else a copy. Returns which one it got."""
+    if dst.exists():
+        dst.unlink()
+    try:
+        os.link(src, dst)
+        return "hardlink"
+    except OSError:
+        pass
+    try:
+        import fcntl
+        with open(src, "rb") as s, open(dst, "wb") as d:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        return "reflink"
+    except (ImportError, OSError):
+        shutil.copyfile(src, dst)
+        return "copy"
+
+
+class BlobStore:
+    """
+    Content-addressed attachment store shared by every account under one
+    output directory: blobs/<aa>/<sha256>, with the per-account download paths
+    linked to it (see link_or_copy).
+
+    index.sqlite remembers the hash of each attachment by (RFC 822 Message-ID,
+    filename, size), so a message seen by an earlier run or another mailbox is
+    not downloaded again, and caches analyze_file results per hash and
+    analysis settings, so identical files are analyzed once.
+    """
+
+    def __init__(self, root: Path, logger: logging.Logger):
+        self.root = root
+        self.logger = logger
+        self.tmp_dir = root / "tmp"
+        ensure_dir(self.tmp_dir)
+        self.conn = sqlite3.connect(str(root / "index.sqlite"))
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(BLOB_SCHEMA)
+        self.conn.commit()
+
+    def blob_path(self, sha256: str) -> Path:
+        return self.root / sha256[:2] / sha256
+
+    def lookup(self, message_key: str, filename: str, size: int) -> Optional[Tuple[str, str]]:
+        """(sha256, kind) of an attachment seen before, if its blob is still on disk."""
+        row = self.conn.execute(
+            "SELECT k.sha256, b.kind FROM attachment_keys k JOIN blobs b ON b.sha256 = k.sha256 "
+            "WHERE k.message_key = ? AND k.filename = ? AND k.size = ?", (message_key, filename, size)
+        ).fetchone()
+        if row and self.blob_path(row[0]).exists():
+            return row[0], row[1]
+        return None
+
+    def put(self, blob: Dict[str, Any], kind: str) -> None:
+        """Move a write_stream temp file into the store (or drop it if the content is already there)."""
+        path = self.blob_path(blob["sha256"])
+        if path.exists():
+            blob["path"].unlink()
+        else:
+            ensure_dir(path.parent)
+            os.replace(blob["path"], path)
+        self.conn.execute(
+            "INSERT OR IGNORE INTO blobs (sha256, size, kind, first_seen) VALUES (?, ?, ?, ?)",
+            (blob["sha256"], blob["size"], kind, datetime.now(timezone.utc).isoformat(timespec="seconds")),
+        )
+
+    def remember(self, message_key: str, filename: str, size: int, sha256: str) -> None:
+        self.conn.execute(
+            "INSERT OR REPLACE INTO attachment_keys (message_key, filename, size, sha256) VALUES (?, ?, ?, ?)",
+            (message_key, filename, size, sha256),
+        )
+
+    def link(self, sha256: str, target: Path) -> str:
+        return link_or_copy(self.blob_path(sha256), target)
+
+    def get_analysis(self, sha256: str, config: str) -> Optional[Dict[str, Any]]:
+        row = self.conn.execute(
+            "SELECT analysis FROM analyses WHERE sha256 = ? AND config = ?", (sha256, config)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put_analysis(self, sha256: str, config: str, analysis: Dict[str, Any]) -> None:
+        self.conn.execute(
+            "INSERT OR REPLACE INTO analyses (sha256, config, analysis) VALUES (?, ?, ?)",
+            (sha256, config, json.dumps(analysis, ensure_ascii=False)),
+        )
+
+    def commit(self) -> None:
+        self.conn.commit()
+
+    def close(self) -> None:
+        self.conn.commit()
+        self.conn.close()
+
+
+def analysis_cache_key(enable_ocr: bool, ocr_max_pages: int, ocr_options: Optional[Dict[str, Any]]) -> str:
+    """BlobStore analysis cache key: the settings that change what analyze_file returns."""
+    options = {k: v for k, v in (ocr_options or {}).items() if k != "ocr_workers"}
+    return json.dumps({"version": ANALYSIS_CACHE_VERSION, "ocr": enable_ocr, "ocr_max_pages": ocr_max_pages,
+                       **options}, sort_keys=True)
+
+
+# ============== COLUMNAR EXPORT ==============
+
+def parse_iso_utc(value: str) -> Optional[datetime]:
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+
+
+class ColumnarExporter:
+    """
+    Typed Parquet export of invoice rows and per-message records for the
+    finance warehouse: float amounts, UTC timestamps and dictionary-encoded
+    sender/currency columns. Rows are buffered and written one row group at
+    a time into temporary files that replace invoices.parquet and
+    messages.parquet only on close(), so a failed export keeps the old ones.
+    Requires pyarrow.
+    """
+
+    def __init__(self, out_dir: Path, logger: logging.Logger, row_group_size: int = 1000):
+        if not module_available("pyarrow"):
+            raise RuntimeError("Parquet export requires pyarrow (pip install pyarrow)")
+        self.logger = logger
+        self.row_group_size = row_group_size
+        dict_str = pa.dictionary(pa.int32(), pa.string())
+        ts = pa.timestamp("ms", tz="UTC")
+
+        self.invoice_schema = pa.schema([
+            ("account", dict_str),
+            ("message_id", pa.string()),
+            ("date_utc", ts),
+            ("sender", dict_str),
+            ("subject", pa.string()),
+            ("file", pa.string()),
+            ("sha256", pa.string()),
+            ("currency", dict_str),
+            ("amount", pa.float64()),
+            ("evidence", pa.string()),
+            ("method", dict_str),
+        ])
+        self.message_schema = pa.schema([
+            ("account", dict_str),
+            ("message_id", pa.string()),
+            ("date_utc", ts),
+            ("sender_key", dict_str),
+            ("sender_email", pa.string()),
+            ("subject", pa.string()),
+            ("link_count", pa.int32()),
+            ("attachments_downloaded", pa.int32()),
+            ("attachments_analyzed", pa.int32()),
+            ("bytes_downloaded", pa.int64()),
+            ("invoices", pa.int32()),
+        ])
+
+        self.invoices_path = out_dir / "invoices.parquet"
+        self.messages_path = out_dir / "messages.parquet"
+        self._tmp_paths = [p.with_name(p.name + ".tmp") for p in (self.invoices_path, self.messages_path)]
+        self._invoice_writer = pq.ParquetWriter(str(self._tmp_paths[0]), self.invoice_schema, compression="zstd")
+        try:
+            self._message_writer = pq.ParquetWriter(str(self._tmp_paths[1]), self.message_schema, compression="zstd")
+        except BaseException:
+            self._invoice_writer.close()
+            self._tmp_paths[0].unlink(missing_ok=True)
+            raise
+        self._invoice_buf: List[Dict[str, Any]] = []
+        self._message_buf: List[Dict[str, Any]] = []
+        self.invoice_count = 0
+        self.message_count = 0
+
+    def add_invoice(self, row: Dict[str, Any]) -> None:
+        self._invoice_buf.append(dict(row, date_utc=parse_iso_utc(row["date_utc"])))
+        if len(self._invoice_buf) >= self.row_group_size:
+            self._flush_invoices()
+
+    def add_message(self, row: Dict[str, Any]) -> None:
+        self._message_buf.append(dict(row, date_utc=parse_iso_utc(row["date_utc"])))
+        if len(self._message_buf) >= self.row_group_size:
+            self._flush_messages()
+
+    def _flush_invoices(self) -> None:
+        if self._invoice_buf:
+            self._invoice_writer.write_table(pa.Table.from_pylist(self._invoice_buf, schema=self.invoice_schema))
+            self.invoice_count += len(self._invoice_buf)
+            self._invoice_buf = []
+
+    def _flush_messages(self) -> None:
+        if self._message_buf:
+            self._message_writer.write_table(pa.Table.from_pylist(self._message_buf, schema=self.message_schema))
+            self.message_count += len(self._message_buf)
+            self._message_buf = []
+
+    def _close_writers(self) -> None:
+        try:
+            self._invoice_writer.close()
+        finally:
+            self._message_writer.close()
+
+    def close(self) -> None:
+        """Flush, finish both files (writing their footers) and move them into place."""
+        try:
+            self._flush_invoices()
+            self._flush_messages()
+        finally:
+            self._close_writers()
+        os.replace(self._tmp_paths[0], self.invoices_path)
+        os.replace(self._tmp_paths[1], self.messages_path)
+        self.logger.info(f"   ✅ {self.invoices_path.name}: {self.invoice_count} rows")
+        self.logger.info(f"   ✅ {self.messages_path.name}: {self.message_count} rows")
+
+    def discard(self) -> None:
+        """Close and delete the partial files, leaving any previous export untouched."""
+        try:
+            self._close_writers()
+        finally:
+            for tmp in self._tmp_paths:
+                tmp.unlink(missing_ok=True)
+
+
+def export_parquet_from_store(store: ResultsStore, account: str, out_dir: Path, logger: logging.Logger) -> None:
+    """Regenerate invoices.parquet / messages.parquet from the results store, like the CSVs."""
+    exporter = ColumnarExporter(out_dir, logger)
+    try:
+        for row in store.invoice_records(account):
+            exporter.add_invoice(row)
+        for row in store.message_summaries(account):
+            exporter.add_message(row)
+        exporter.close()
+    except BaseException:
+        exporter.discard()
+        raise
+
+
+def export_csvs_from_store(store: ResultsStore, account: str, out_dir: Path, logger: logging.Logger) -> InvoiceTable:
+    """Regenerate the three expense CSVs from the results store. Returns the invoice rows."""
+    rows = store.invoice_rows(account)
     totals_csv = out_dir / "expenses_totals.csv"
+    with totals_csv.open("w", encoding="utf-8", newline="") as f:
+        rows.write_csv(f)
+    logger.info(f"   ✅ {totals_csv.name}: {len(rows)} rows")
+
+    by_sender = rows.totals_by_sender_currency()
     by_sender_csv = out_dir / "expenses_by_sender.csv"
+    with by_sender_csv.open("w", encoding="utf-8", newline="") as f:
+        w = csv.writer(f)
+        w.writerow(["sender", "currency", "sum_amount"])
+        for (sender, curr), amt in sorted(by_sender.items(), key=lambda x: (-x[1], x[0][0], x[0][1])):
+            w.writerow([sender, curr, f"{amt:.2f}"])
+    logger.info(f"   ✅ {by_sender_csv.name}: {len(by_sender)} rows")
+
+    by_currency = rows.totals_by_currency()
     by_currency_csv = out_dir / "expenses_by_currency.csv"
+    with by_currency_csv.open("w", encoding="utf-8", newline="") as f:
+        w = csv.writer(f)
+        w.writerow(["currency", "sum_amount"])
+        for curr, amt in sorted(by_currency.items(), key=lambda x: -x[1]):
+            w.writerow([curr, f"{amt:.2f}"])
+    logger.info(f"   ✅ {by_currency_csv.name}: {len(by_currency)} rows")
+    return rows
+
+
+def invoice_row(account: str, date_utc: str, sender_key: str, subject: str, file: str, best: Dict[str, Any]) -> Dict[str, str]:
+    """One expenses_totals.csv row for a detected total."""
+    return {
+        "account": account,
+        "date_utc": date_utc,
+        "sender": sender_key,
+        "subject": subject,
+        "file": file,
+        "currency": best["currency"],
+        "amount": f"{float(best['amount']):.2f}",
+        "evidence": best["context"].replace("\n", " ")[:180],
+        "method": best["source"],
+    }
+
+
+def write_account_dashboard(
+    out_dir: Path,
+    account_label: str,
+    invoice_rows: InvoiceTable,
+    dashboard_mode: str,
+    logger: logging.Logger,
+    perf: PerformanceTracker,
+) -> Path:
+    """Generate dashboard.html (and its data sidecar in paged mode) from the account's invoice rows."""
+    logger.info("   Generating dashboard...")
     dashboard_path = out_dir / "dashboard.html"
 
-    total_by_currency = defaultdict(float)
-    total_by_sender_currency = defaultdict(float)
-    file_rows = []
-    total_bytes_downloaded = 0
+    with perf.timer("generate_dashboard"):
+        generated_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+        # Prepare perf summary for dashboard
+        total_time = perf.elapsed()
+        perf_summary = {
+            "messages_processed": perf.get_count("messages_processed"),
+            "attachments_downloaded": perf.get_count("attachments_downloaded"),
+            "total_bytes": format_bytes(perf.get_count("bytes_downloaded")),
+            "ocr_performed": perf.get_count("ocr_attempts"),
+            "processing_time": perf._format_duration(total_time),
+        }
+
+        paged = dashboard_mode == "paged" or (
+            dashboard_mode == "auto" and len(invoice_rows) > DASHBOARD_INLINE_MAX_ROWS
+        )
+        data_src = None
+        if paged:
+            data_path = out_dir / "dashboard_data.js"
+            write_dashboard_data(data_path, invoice_rows)
+            data_src = data_path.name
+
+        dashboard_html = generate_dashboard_html(
+            account_label,
+            invoice_rows,
+            invoice_rows.totals_by_currency(),
+            invoice_rows.totals_by_sender_currency(),
+            generated_at,
+            perf_summary,
+            data_src=data_src,
+            cost_rows=perf.cost_report(account_label)[0][:COST_DASHBOARD_ROWS],
+        )
+        dashboard_path.write_text(dashboard_html, encoding="utf-8")
+    logger.info(f"   ✅ {dashboard_path.name}" + (f" (paged, rows in {data_src})" if data_src else ""))
+    return dashboard_path
+
+
+# ============== CHECKPOINT / RESUME ==============
+
+CHECKPOINT_EVERY_MESSAGES = 25
+
+class CheckpointJournal:
+    """
+    Write-ahead journal of finished messages for crash-safe --resume.
+
+    One JSON line per message carries its id, the attachment hashes it added to
+    seen_hashes and its invoices as (sender, currency, amount). A commit marker
+    is appended (and fsynced) only after results.jsonl, the totals CSV and the
+    results store have been flushed, so on resume every entry before the last
+    marker is known to be fully on disk; anything after it is redone.
+    """
+
+    def __init__(self, path: Path, resume: bool):
+        self.path = path
+        self._f = path.open("a" if resume else "w", encoding="utf-8")
+        self.pending = 0
+
+    @staticmethod
+    def load(path: Path) -> Dict[str, Any]:
+        """Replay the journal up to its last commit marker."""
+        completed: List[str] = []
+        hashes = DigestSet()
+        invoices = SenderCurrencyTotals()
+        pending: List[Dict[str, Any]] = []
+        if path.exists():
+            with path.open("r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break  # torn last line
+                    if entry.get("commit"):
+                        for e in pending:
+                            completed.append(e["id"])
+                            hashes.update(e["hashes"])
+                            for sender, currency, amount in e["invoices"]:
+                                invoices.add(sender, currency, amount)
+                        pending = []
+                    else:
+                        pending.append(entry)
+        return {"completed": set(completed), "hashes": hashes, "invoices": invoices}
+
+    def record(self, msg_id: str, hashes: List[str], invoices: List[Tuple[str, str, float]]) -> None:
+        self._f.write(json.dumps({"id": msg_id, "hashes": hashes, "invoices": invoices}, ensure_ascii=False) + "\n")
+        self.pending += 1
+
+    def commit(self) -> None:
+        """Call after every other output has been flushed."""
+        if not self.pending:
+            return
+        self._f.write(json.dumps({"commit": True}) + "\n")
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self.pending = 0
+
+    def close(self) -> None:
+        self.commit()
+        self._f.close()
+
+
+def repair_results_jsonl(path: Path, completed: set) -> int:
+    """Drop results.jsonl lines written after the last checkpoint (and duplicates)."""
+    if not path.exists():
+        return 0
+    tmp = path.with_suffix(".jsonl.tmp")
+    kept = set()
+    with path.open("r", encoding="utf-8") as src, tmp.open("w", encoding="utf-8") as dst:
+        for line in src:
+            try:
+                msg_id = json.loads(line).get("message_id")
+            except ValueError:
+                continue
+            if msg_id in completed and msg_id not in kept:
+                dst.write(line)
+                kept.add(msg_id)
+    os.replace(tmp, path)
+    return len(kept)
+
+
+# ============== MAILBOX SOURCES ==============
+# A source yields messages already reduced to what the pipeline needs
+# (headers, the (plain, html) pair from extract_text_parts and the
+# attachment list from iter_attachments) and serves attachment bytes by id.
+
+MBOX_SUFFIXES = {".mbox", ".mbx"}
+EML_SUFFIXES = {".eml"}
+
+
+class GmailSource:
+    """Messages from the Gmail API matching a search query, fetched GMAIL_BATCH_SIZE per batch request."""
+
+    name = "gmail"
+
+    def __init__(self, service, query: str, max_messages: int, logger: logging.Logger, perf: PerformanceTracker,
+                 api_endpoint: Optional[str] = None):
+        self.service = service
+        self.api_endpoint = api_endpoint
+        self.logger = logger
+        self.perf = perf
+        self.msg_ids = list_messages(service, query, max_messages, logger, perf)
+        self.total = len(self.msg_ids)
+
+    def _fetch_one(self, msg_id: str) -> Optional[Dict[str, Any]]:
+        from googleapiclient.errors import HttpError
+
+        with self.perf.timer("fetch_message"):
+            try:
+                return self.service.users().messages().get(userId="me", id=msg_id, format="full").execute(
+                    num_retries=GMAIL_NUM_RETRIES)
+            except HttpError as e:
+                self.logger.error(f"   Failed to fetch message {msg_id}: {e}")
+                self.perf.increment("messages_failed")
+                return None
+
+    def _fetch_batch(self, msg_ids: List[str]) -> Iterator[Tuple[str, Optional[Dict[str, Any]], float]]:
+        """
+        Yield (id, message or None, fetch seconds) for `msg_ids` in order. Batch
+        parts answered 429/5xx are refetched one by one with the usual retries;
+        the batch round trip is shared evenly between the messages it returned.
+        """
+        from googleapiclient.errors import HttpError
+
+        results: Dict[str, Any] = {}
+
+        def collect(request_id, response, exception):
+            results[request_id] = exception if exception is not None else response
+
+        batch = gmail_batch(self.service, collect, self.api_endpoint)
+        for msg_id in msg_ids:
+            batch.add(self.service.users().messages().get(userId="me", id=msg_id, format="full"), request_id=msg_id)
+        started = time.perf_counter()
+        try:
+            with self.perf.timer("fetch_batch"):
+                batch.execute()
+            self.perf.increment("fetch_batches")
+        except HttpError as e:
+            self.logger.warning(f"   Batch of {len(msg_ids)} messages failed ({e}); fetching them one by one")
+            self.perf.increment("fetch_batches_failed")
+            results.clear()
+        share = (time.perf_counter() - started) / len(msg_ids)
+
+        for msg_id in msg_ids:
+            result = results.get(msg_id)
+            if isinstance(result, dict):
+                yield msg_id, result, share
+                continue
+            if isinstance(result, HttpError) and result.resp.status not in GMAIL_RETRY_STATUSES:
+                self.logger.error(f"   Failed to fetch message {msg_id}: {result}")
+                self.perf.increment("messages_failed")
+                yield msg_id, None, share
+                continue
+            if result is not None:
+                self.perf.increment("fetch_batch_retries")
+            started = time.perf_counter()
+            msg = self._fetch_one(msg_id)
+            yield msg_id, msg, time.perf_counter() - started
+
+    def messages(self, skip: set):
+        pending = []
+        for msg_id in self.msg_ids:
+            if msg_id in skip:
+                self.perf.increment("messages_skipped_known")
+            else:
+                pending.append(msg_id)
+
+        done = self.total - len(pending)
+        for start in range(0, len(pending), GMAIL_BATCH_SIZE):
+            for msg_id, msg, fetch_seconds in self._fetch_batch(pending[start:start + GMAIL_BATCH_SIZE]):
+                done += 1
+                if done == 1 or done % 25 == 0 or done == self.total:
+                    self.perf.log_progress(done, self.total, "messages")
+                if msg is None:
+                    continue
+
+                payload = msg.get("payload", {}) or {}
+                headers = payload.get("headers", []) or []
+                plain, html = extract_text_parts(payload)
+                yield {
+                    "id": msg_id,
+                    "rfc822_id": get_header(headers, "Message-ID"),
+                    "from_raw": get_header(headers, "From"),
+                    "subject": get_header(headers, "Subject"),
+                    "date_utc": parse_gmail_internal_date(msg.get("internalDate", "")),
+                    "plain": plain,
+                    "html": html,
+                    "attachments": iter_attachments(payload),
+                    "fetch_bytes": int(msg.get("sizeEstimate") or 0),
+                    "fetch_seconds": fetch_seconds,
+                }
+
+    def download_attachment(self, msg_id: str, attachment_id: str) -> bytes:
+        return download_attachment(self.service, msg_id, attachment_id)
+
+    def download_to(self, msg_id: str, attachment_id: str, directory: Path) -> Dict[str, Any]:
+        return download_attachment_to(self.service, msg_id, attachment_id, directory)
+
+
+def iter_mbox(path: Path):
+    """
+    Yield (raw message bytes, bytes read so far) from an mbox file, one message
+    at a time, so memory is bounded by the largest message rather than the file.
+    """
+    lines: List[bytes] = []
+    offset = 0
+    with path.open("rb") as f:
+        for line in f:
+            if line.startswith(b"From ") and lines:
+                yield b"".join(lines), offset
+                lines = []
+            offset += len(line)
+            if not lines and line.startswith(b"From "):
+                continue  # envelope line, not part of the message
+            lines.append(line)
+    if lines:
+        yield b"".join(lines), offset
+
+
+def mailbox_message_id(headers: EmailMessage, raw: bytes) -> str:
+    """Stable 16-hex id (Gmail-id shaped) from the Message-ID header, else from the content."""
+    key = (headers.get("Message-ID") or "").strip().encode("utf-8", errors="replace") or raw
+    return hashlib.sha256(key).hexdigest()[:16]
+
+
+def parse_mail_date(value: str) -> str:
+    try:
+        dt = parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return ""
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt.isoformat() + "Z"
+
+
+class MailboxSource:
+    """
+    Messages from mbox files (e.g. Google Takeout exports) and .eml files.
+    Gmail's server-side query is applied locally: a message must have an
+    attachment, mention one of the keywords, and (optionally) be newer than `after`.
+    """
+
+    name = "mailbox"
+
+    def __init__(
+        self,
+        paths: List[Path],
+        keywords: List[str],
+        after: Optional[date],
+        max_messages: Optional[int],
+        logger: logging.Logger,
+        perf: PerformanceTracker,
+    ):
+        self.logger = logger
+        self.perf = perf
+        self.keywords = [k.lower() for k in keywords]
+        self.after = after.isoformat() if after else ""
+        self.max_messages = max_messages
+        self.files: List[Path] = []
+        for path in paths:
+            if path.is_dir():
+                self.files.extend(sorted(
+                    f for f in path.rglob("*") if f.is_file() and f.suffix.lower() in MBOX_SUFFIXES | EML_SUFFIXES
+                ))
+            else:
+                self.files.append(path)
+        self.total_bytes = sum(f.stat().st_size for f in self.files)
+        self.total = None  # unknown until the files have been read
+        self._parts: Dict[str, EmailMessage] = {}
+
+    def _raw_messages(self):
+        done = 0
+        for path in self.files:
+            self.logger.info(f"📂 Reading {path.name} ({format_bytes(path.stat().st_size)})")
+            if path.suffix.lower() in EML_SUFFIXES:
+                yield path.read_bytes(), done + path.stat().st_size
+            else:
+                for raw, offset in iter_mbox(path):
+                    yield raw, done + offset
+            done += path.stat().st_size
+
+    def _matches(self, message: Dict[str, Any]) -> bool:
+        if not message["attachments"]:
+            return False
+        if self.after and message["date_utc"] and message["date_utc"] < self.after:
+            return False
+        if not self.keywords:
+            return True
+        haystack = " ".join([message["subject"], message["plain"], message["html"]] +
+                            [a["filename"] for a in message["attachments"]]).lower()
+        return any(k in haystack for k in self.keywords)
+
+    def messages(self, skip: set):
+        header_parser = BytesHeaderParser(policy=email_policy.default)
+        parser = BytesParser(policy=email_policy.default)
+        seen = set()
+        matched = 0
+        scanned = 0
+
+        for raw, offset in self._raw_messages():
+            scanned += 1
+            if scanned % 500 == 0:
+                self.perf.log_progress(offset, self.total_bytes, "bytes")
+
+            msg_id = mailbox_message_id(header_parser.parsebytes(raw), raw)
+            if msg_id in skip:
+                self.perf.increment("messages_skipped_known")
+                continue
+            if msg_id in seen:
+                self.perf.increment("messages_skipped_duplicate")  # same message in several files
+                continue
+            seen.add(msg_id)
+
+            started = time.perf_counter()
+            with self.perf.timer("parse_message"):
+                try:
+                    message = self._convert(msg_id, parser.parsebytes(raw))
+                except Exception as e:
+                    self.logger.error(f"   Failed to parse message {msg_id}: {e}")
+                    self.perf.increment("messages_failed")
+                    continue
+            message["fetch_bytes"] = len(raw)
+            message["fetch_seconds"] = time.perf_counter() - started
+
+            if not self._matches(message):
+                self.perf.increment("messages_filtered")
+                continue
+
+            yield message
+            matched += 1
+            if self.max_messages and matched >= self.max_messages:
+                break
+
+        self.perf.log_progress(self.total_bytes, self.total_bytes, "bytes")
+
+    def _convert(self, msg_id: str, msg: EmailMessage) -> Dict[str, Any]:
+        plain_chunks: List[str] = []
+        html_chunks: List[str] = []
+        attachments: List[Dict[str, Any]] = []
+        self._parts = {}
+
+        for part in msg.walk():
+            if part.is_multipart():
+                continue
+            mime = part.get_content_type()
+            filename = part.get_filename()
+            if filename:
+                att_id = f"{msg_id}.{len(self._parts)}"
+                self._parts[att_id] = part
+                encoded = part.get_payload()
+                size = len(encoded) if isinstance(encoded, (str, bytes)) else 0
+                if part.get("Content-Transfer-Encoding", "").strip().lower() == "base64":
+                    size = size * 3 // 4
+                attachments.append({
+                    "filename": filename,
+                    "mimeType": mime,
+                    "attachmentId": att_id,
+                    "size": size,
+                })
+            elif mime in ("text/plain", "text/html"):
+                try:
+                    txt = part.get_content()
+                except (LookupError, UnicodeError):
+                    txt = (part.get_payload(decode=True) or b"").decode("utf-8", errors="replace")
+                (plain_chunks if mime == "text/plain" else html_chunks).append(txt)
+
+        return {
+            "id": msg_id,
+            "rfc822_id": str(msg.get("Message-ID") or "").strip(),
+            "from_raw": str(msg.get("From") or ""),
+            "subject": str(msg.get("Subject") or ""),
+            "date_utc": parse_mail_date(str(msg.get("Date") or "")),
+            "plain": "\n".join(plain_chunks),
+            "html": "\n".join(html_chunks),
+            "attachments": attachments,
+        }
+
+    def download_attachment(self, msg_id: str, attachment_id: str) -> bytes:
+        # Parts of the current message only; decoded on demand so skipped attachments cost nothing
+        return self._parts[attachment_id].get_payload(decode=True) or b""
+
+    def download_to(self, msg_id: str, attachment_id: str, directory: Path) -> Dict[str, Any]:
+        return write_stream([self.download_attachment(msg_id, attachment_id)], directory)
+
+
+# ============== MAIN PROCESSING ==============
+
+def run_account(
+    account_label: str,
+    creds_path: Path,
+    token_path: Path,
+    out_dir: Path,
+    keywords: List[str],
+    after_yyyy_mm_dd: str,
+    max_messages: int,
+    max_attachment_mb: int,
+    enable_ocr: bool,
+    ocr_max_pages: int,
+    allow_duplicates: bool,
+    create_zip: bool,
+    logger: logging.Logger,
+    perf: PerformanceTracker,
+    prefilter_threshold: Optional[float] = None,
+    incremental: bool = False,
+    parquet: bool = False,
+    dashboard_mode: str = "auto",
+    resume: bool = False,
+    api_endpoint: Optional[str] = None,
+    ocr_options: Optional[Dict[str, Any]] = None,
+    blob_store: Optional[BlobStore] = None,
+) -> None:
+    logger.info("")
+    logger.info("=" * 60)
+    logger.info(f"🚀 STARTING ACCOUNT: {account_label}")
+    logger.info("=" * 60)
+    logger.info("")
+
+    # Auth
+    if api_endpoint:
+        logger.info(f"🔌 Using Gmail endpoint {api_endpoint} (no OAuth)")
+        from google.auth.credentials import AnonymousCredentials
+        creds = AnonymousCredentials()
+    else:
+        creds = load_or_auth(creds_path, token_path, logger, perf)
+    service = gmail_service(creds, api_endpoint, perf)
+
+    # Build query
+    query = build_gmail_query(keywords, after_yyyy_mm_dd)
+    logger.info(f"🔍 Search parameters:")
+    logger.info(f"   Keywords: {len(keywords)} terms")
+    logger.info(f"   Date filter: after {after_yyyy_mm_dd}")
+    logger.info(f"   Max messages: {max_messages}")
+    logger.info(f"   OCR enabled: {enable_ocr}")
+    logger.info(f"   Prefilter: {'off' if prefilter_threshold is None else f'threshold {prefilter_threshold:+.1f}'}")
+    logger.debug(f"   Full query: {query}")
+
+    # Get messages
+    source = GmailSource(service, query, max_messages, logger, perf, api_endpoint)
+
+    if not source.total:
+        logger.warning("No messages found matching criteria!")
+        return
+
+    process_source(
+        source, account_label, out_dir, max_attachment_mb, enable_ocr, ocr_max_pages,
+        allow_duplicates, create_zip, logger, perf,
+        prefilter_threshold=prefilter_threshold, incremental=incremental, parquet=parquet,
+        dashboard_mode=dashboard_mode, resume=resume, ocr_options=ocr_options, blob_store=blob_store,
+    )
+
+
+def process_source(
+    source,
+    account_label: str,
+    out_dir: Path,
+    max_attachment_mb: int,
+    enable_ocr: bool,
+    ocr_max_pages: int,
+    allow_duplicates: bool,
+    create_zip: bool,
+    logger: logging.Logger,
+    perf: PerformanceTracker,
+    prefilter_threshold: Optional[float] = None,
+    incremental: bool = False,
+    parquet: bool = False,
+    dashboard_mode: str = "auto",
+    resume: bool = False,
+    ocr_options: Optional[Dict[str, Any]] = None,
+    blob_store: Optional[BlobStore] = None,
+) -> None:
+    """
+    Download, analyze and record every message a source yields, then write the account outputs.
+    ocr_options are passed through to analyze_file (ocr_dpi, ocr_fast, ocr_early_exit,
+    ocr_workers, ocr_memory_mb).
+    With a blob_store, attachments are stored once by content and linked into
+    downloads/, known attachments are not downloaded again and analyses are cached.
+    """
+
+    # Setup directories
+    ensure_dir(out_dir)
+    downloads_dir = out_dir / "downloads"
+    ensure_dir(downloads_dir)
+
+    # Add file handler for this account
+    file_handler = add_log_file(logger, out_dir / "processing.log")
+
+    results_path = out_dir / "results.jsonl"
+
+    store = ResultsStore(out_dir / "results.sqlite", logger)
+    try:
+        if incremental:
+            known_ids = store.known_message_ids(account_label)
+            seen_hashes = store.known_hashes(account_label)
+            logger.info(f"   Incremental run: {len(known_ids)} messages already in {store.path.name}")
+        elif not resume:
+            store.reset_account(account_label)
+            known_ids = set()
+            seen_hashes = DigestSet()
+        else:
+            known_ids = set()
+            seen_hashes = DigestSet()
+
+        journal_path = out_dir / "checkpoint.journal"
+        checkpoint = CheckpointJournal.load(journal_path) if resume else None
+        if checkpoint:
+            known_ids |= checkpoint["completed"]
+            seen_hashes.update(checkpoint["hashes"])
+            kept = repair_results_jsonl(results_path, checkpoint["completed"])
+            # Rebuild the streamed totals CSV from what the checkpoint vouches for, then append to it
+            with (out_dir / "expenses_totals.csv").open("w", encoding="utf-8", newline="") as f:
+                store.invoice_rows(account_label, checkpoint["completed"]).write_csv(f)
+            logger.info(f"   Resuming: {len(checkpoint['completed'])} messages already done "
+                        f"({kept} in {results_path.name}, {checkpoint['invoices'].count} invoices)")
+            restored = checkpoint["invoices"]
+        elif incremental:
+            # Start the streamed totals CSV from everything already stored, then append to it,
+            # so a crash mid-run still leaves earlier runs' rows in it
+            stored_rows = store.invoice_rows(account_label)
+            with (out_dir / "expenses_totals.csv").open("w", encoding="utf-8", newline="") as f:
+                stored_rows.write_csv(f)
+            restored = stored_rows.totals_by_sender_currency()
+            del stored_rows
+        else:
+            restored = None
+        journal = CheckpointJournal(journal_path, resume=resume)
+
+        analysis_config = analysis_cache_key(enable_ocr, ocr_max_pages, ocr_options)
+
+        total_bytes_downloaded = 0
+
+        logger.info("")
+        logger.info(f"📧 Processing {source.total if source.total is not None else 'all'} messages ({source.name})...")
+        logger.info("")
+
+        with results_path.open("a" if (incremental or resume) else "w", encoding="utf-8") as f_out, \
+                StreamingExpenseWriter(out_dir, logger, append=restored is not None) as writer:
+            if restored is not None:
+                writer.restore_totals(restored)
+
+            for message in source.messages(known_ids):
+                msg_id = message["id"]
+                perf.increment("messages_processed")
+
+                logger.debug("")
+                logger.debug("--- Message %s: %s ---", perf.get_count('messages_processed'), msg_id)
+
+                from_raw = message["from_raw"]
+                sender_name, sender_email = parseaddr(from_raw)
+                sender_email = (sender_email or "").lower().strip()
+                sender_key = sender_email or sanitize_filename(from_raw or "unknown_sender")
+
+                subject = message["subject"]
+                date_utc = message["date_utc"]
+                perf.charge(account_label, sender_key, messages=1,
+                            fetch_bytes=message.get("fetch_bytes", 0), fetch_seconds=message.get("fetch_seconds", 0.0))
+
+                logger.debug("   From: %s", sender_email or from_raw[:50])
+                logger.debug("   Subject: %s...", subject[:60])
+                logger.debug("   Date: %s", date_utc[:10] if date_utc else 'unknown')
+
+                plain, html = message["plain"], message["html"]
+                links = list(dict.fromkeys(extract_links(plain) + extract_links(html)))
+
+                attachments_meta = message["attachments"]
+                logger.debug("   Attachments found: %s", len(attachments_meta))
+
+                downloaded = []
+                analyzed = []
+                invoices = []
+                msg_hashes = []
+
+                sender_folder = downloads_dir / sanitize_filename(sender_key)
+                ensure_dir(sender_folder)
+
+                for att in attachments_meta:
+                    filename = att["filename"]
+                    ext = Path(filename).suffix.lower()
+
+                    mime_type = (att.get("mimeType") or "").lower()
+                    if ext not in ALLOWED_EXTS and mime_type not in SNIFFABLE_MIME_TYPES:
+                        logger.debug("      Skipping %s (unsupported extension: %s, type: %s)", filename, ext, mime_type or 'n/a')
+                        perf.increment("attachments_skipped_ext")
+                        continue
+
+                    size = int(att.get("size") or 0)
+                    if size > max_attachment_mb * 1024 * 1024:
+                        logger.debug("      Skipping %s (too large: %s)", filename, format_bytes(size))
+                        perf.increment("attachments_skipped_size")
+                        continue
+
+                    safe_name = sanitize_filename(filename)
+                    target = sender_folder / f"{msg_id}_{safe_name}"
+
+                    with perf.attribute(account_label, sender_key, filename=filename) as cost:
+                        try:
+                            known = None
+                            if blob_store and message.get("rfc822_id"):
+                                known = blob_store.lookup(message["rfc822_id"], filename, size)
+                            if known:
+                                logger.debug("      Already stored: %s (sha256: %s...)", filename, known[0][:16])
+                                perf.increment("attachments_known")
+                                blob = None
+                                h, kind = known
+                            else:
+                                logger.debug("      Downloading: %s (%s)", filename, format_bytes(size))
+
+                                with perf.timer("download_attachment", item=filename):
+                                    blob = source.download_to(msg_id, att["attachmentId"],
+                                                              blob_store.tmp_dir if blob_store else sender_folder)
+
+                                kind = sniff_kind(blob["head"], blob["tail"])
+                                if kind is None:
+                                    logger.debug("      Skipping %s (content is not a PDF, DOCX or image)", filename)
+                                    perf.increment("attachments_rejected_sniff")
+                                    blob["path"].unlink()
+                                    continue
+                                h = blob["sha256"]
+                            if ext not in SNIFF_KIND_EXTS[kind]:
+                                logger.debug("      %s is really %s, saving as %s", filename, kind, SNIFF_KIND_EXTS[kind][0])
+                                target = target.with_name(target.name + SNIFF_KIND_EXTS[kind][0])
+                                perf.increment("attachments_relabelled")
+
+                            cost["sha256"] = h
+                            if (not allow_duplicates) and (h in seen_hashes):
+                                logger.debug("      Skipping duplicate (sha256: %s...)", h[:16])
+                                perf.increment("attachments_skipped_duplicate")
+                                if blob:
+                                    blob["path"].unlink()
+                                continue
+                            seen_hashes.add(h)
+                            msg_hashes.append(h)
+
+                            if blob_store:
+                                if blob:
+                                    blob_store.put(blob, kind)
+                                    if message.get("rfc822_id"):
+                                        blob_store.remember(message["rfc822_id"], filename, size, h)
+                                perf.increment(f"blob_{blob_store.link(h, target)}s")
+                            else:
+                                os.replace(blob["path"], target)
+                            if blob:
+                                total_bytes_downloaded += blob["size"]
+                                perf.increment("bytes_downloaded", blob["size"])
+                                perf.increment("attachments_downloaded")
+
+                            logger.debug("      Saved: %s", target.relative_to(out_dir))
+
+                            downloaded.append({
+                                "filename": filename,
+                                "saved_as": str(target.relative_to(out_dir)),
+                                "mimeType": att.get("mimeType", ""),
+                                "size": blob["size"] if blob else target.stat().st_size,
+                                "sha256": h,
+                                "kind": kind,
+                            })
+
+                            # Analyze the file; content analyzed before skips both the prefilter and analysis
+                            analysis = blob_store.get_analysis(h, analysis_config) if blob_store else None
+                            if analysis:
+                                perf.increment("analysis_cache_hits")
+                            else:
+                                native = None
+                                if prefilter_threshold is not None:
+                                    if kind == "pdf":
+                                        native = pdf_native_text(target, logger, perf)
+                                    verdict = prefilter_attachment(
+                                        target, filename, att.get("mimeType", ""), prefilter_threshold,
+                                        enable_ocr, ocr_max_pages, logger, perf, kind=kind, native=native
+                                    )
+                                    if not verdict["keep"]:
+                                        logger.debug("      Skipping analysis (prefilter score %+.1f)", verdict['score'])
+                                        perf.increment("prefilter_skipped")
+                                        perf.increment("prefilter_ocr_seconds_saved", verdict["estimated_ocr_seconds"])
+                                        analyzed.append({
+                                            "file": str(target.relative_to(out_dir)),
+                                            "analysis": None,
+                                            "prefilter": verdict,
+                                        })
+                                        continue
+                                    perf.increment("prefilter_passed")
+
+                                logger.debug("      Analyzing content...")
+                                analysis = analyze_file(target, enable_ocr, ocr_max_pages, logger, perf, kind=kind,
+                                                        native=native, **(ocr_options or {}))
+                                if blob_store:
+                                    blob_store.put_analysis(h, analysis_config, analysis)
+                            best = analysis["best_total"]
+
+                            analyzed_item = {
+                                "file": str(target.relative_to(out_dir)),
+                                "analysis": analysis,
+                            }
+                            analyzed.append(analyzed_item)
+
+                            if best:
+                                amt = float(best["amount"])
+                                curr = best["currency"]
+                                perf.increment("invoices_detected")
+
+                                row = invoice_row(account_label, date_utc, sender_key, subject,
+                                                  str(target.relative_to(out_dir)), best)
+                                writer.add(row, sender_key, curr, amt)
+                                invoices.append(dict(row, sha256=h))
+
+                                logger.info(f"   💰 Found: {CURRENCY_SYMBOLS.get(curr, '')}{amt:,.2f} {curr} from {sender_key[:30]}")
+
+                        except Exception as e:
+                            logger.error(f"      {'Download' if is_http_error(e) else 'Processing'} failed: {e}")
+                            perf.increment("attachments_failed")
+
+                record = {
+                    "account": account_label,
+                    "message_id": msg_id,
+                    "date_utc": date_utc,
+                    "from_raw": from_raw,
+                    "sender_email": sender_email,
+                    "sender_name": sender_name,
+                    "sender_key": sender_key,
+                    "subject": subject,
+                    "links": links,
+                    "attachments_downloaded": downloaded,
+                    "attachments_analyzed": analyzed,
+                }
+                f_out.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+                with perf.timer("write_outputs"):
+                    store.add_message(record, invoices)
+                    journal.record(msg_id, msg_hashes, [
+                        (r["sender"], r["currency"], float(r["amount"])) for r in invoices
+                    ])
+                    flushed = writer.maybe_flush()
+                    if flushed or journal.pending >= CHECKPOINT_EVERY_MESSAGES:
+                        if not flushed:
+                            writer.flush()
+                        f_out.flush()
+                        store.commit()
+                        if blob_store:
+                            blob_store.commit()
+                        journal.commit()
+
+            writer.flush()
+            f_out.flush()
+            store.commit()
+            if blob_store:
+                blob_store.commit()
+            journal.close()
+
+        # Write CSVs (the store is canonical: it also holds earlier incremental runs)
+        logger.info("")
+        logger.info("📝 Writing output files...")
+
+        with perf.timer("write_csvs"):
+            invoice_rows = export_csvs_from_store(store, account_label, out_dir, logger)
+            if parquet:
+                export_parquet_from_store(store, account_label, out_dir, logger)
+            total_by_currency = invoice_rows.totals_by_currency()
+            write_cost_report(out_dir, account_label, perf, logger)
+
+        # Generate dashboard
+        write_account_dashboard(out_dir, account_label, invoice_rows, dashboard_mode, logger, perf)
+    finally:
+        store.close()
+
+    # Create zip archive
+    if create_zip:
+        zip_path = create_zip_archive(out_dir, account_label, logger, perf)
+        logger.info(f"   ✅ {zip_path.name}")
+
+    # Summary
+    logger.info("")
+    logger.info("=" * 60)
+    logger.info(f"📊 ACCOUNT SUMMARY: {account_label}")
+    logger.info("=" * 60)
+    logger.info(f"   Messages processed: {perf.get_count('messages_processed')}")
+    logger.info(f"   Attachments downloaded: {perf.get_count('attachments_downloaded')}")
+    logger.info(f"   Data downloaded: {format_bytes(total_bytes_downloaded)}")
+    logger.info(f"   Invoices detected: {perf.get_count('invoices_detected')}")
+    logger.info("")
+    logger.info("   💰 TOTALS BY CURRENCY:")
+    for curr, amt in sorted(total_by_currency.items(), key=lambda x: -x[1]):
+        logger.info(f"      {curr}: {CURRENCY_SYMBOLS.get(curr, '')}{amt:,.2f}")
+    logger.info("")
+    logger.info(f"   📁 Output directory: {out_dir}")
+    logger.info("=" * 60)
+
+    # Remove file handler
+    remove_log_file(logger, file_handler)
+
+
+# ============== OFFLINE REPROCESSING ==============
+
+def _reprocess_worker(task: Dict[str, Any]) -> Tuple[int, Dict[str, Any], Dict[str, Any]]:
+    """Analyze one downloaded file in a worker process (no network, no credentials)."""
+    logger = logging.getLogger("invoice_tracker.reprocess")
+    if not logger.handlers:
+        logger.addHandler(logging.NullHandler())
+        logger.propagate = False
+    perf = PerformanceTracker(logger)
+    if task["profile"]:
+        perf.enable_profiling(*task["profile"])
+    if task["memory"]:
+        perf.enable_memory_tracking(sampler=False, trace_allocations=task["memory"] == "tracemalloc")
+    path = Path(task["path"])
+
+    with perf.attribute(*task["cost_key"], filename=task["filename"]):
+        verdict = native = None
+        if task["prefilter_threshold"] is not None:
+            if task["kind"] == "pdf":
+                native = pdf_native_text(path, logger, perf)
+            verdict = prefilter_attachment(
+                path, task["filename"], task["mime_type"], task["prefilter_threshold"],
+                task["enable_ocr"], task["ocr_max_pages"], logger, perf,
+                kind=task["kind"], native=native
+            )
+        if verdict and not verdict["keep"]:
+            perf.increment("prefilter_skipped")
+            perf.increment("prefilter_ocr_seconds_saved", verdict["estimated_ocr_seconds"])
+            result = {"analysis": None, "prefilter": verdict}
+        else:
+            result = {"analysis": analyze_file(path, task["enable_ocr"], task["ocr_max_pages"], logger, perf,
+                                               kind=task["kind"], native=native, **task["ocr_options"])}
+    return task["index"], result, perf.snapshot()
+
+
+def reprocess_account(
+    account_label: str,
+    out_dir: Path,
+    enable_ocr: bool,
+    ocr_max_pages: int,
+    prefilter_threshold: Optional[float],
+    workers: int,
+    dashboard_mode: str,
+    create_zip: bool,
+    logger: logging.Logger,
+    perf: PerformanceTracker,
+    ocr_options: Optional[Dict[str, Any]] = None,
+    parquet: bool = False,
+) -> None:
+    """
+    Re-run analyze_file over an account's already-downloaded attachments and
+    regenerate results.jsonl, the results store, CSVs and dashboard (and the
+    Parquet files, with `parquet` or when an earlier run wrote them). Local I/O only.
+    """
+    logger.info("")
+    logger.info("=" * 60)
+    logger.info(f"♻️  REPROCESSING ACCOUNT: {account_label}")
+    logger.info("=" * 60)
+
+    results_path = out_dir / "results.jsonl"
+    if not results_path.exists():
+        logger.error(f"❌ No {results_path} - run the Gmail pipeline for this account first")
+        return
+
+    with perf.timer("reprocess_load"):
+        records = []
+        with results_path.open("r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    records.append(json.loads(line))
+
+        tasks = []
+        for r_idx, record in enumerate(records):
+            record["attachments_analyzed"] = []
+            for d in record["attachments_downloaded"]:
+                path = out_dir / d["saved_as"]
+                if not path.exists():
+                    perf.increment("reprocess_missing_files")
+                    continue
+                tasks.append({
+                    "index": len(tasks),
+                    "record": r_idx,
+                    "download": d,
+                    "path": str(path),
+                    "filename": d["filename"],
+                    "mime_type": d.get("mimeType", ""),
+                    "kind": d.get("kind"),
+                    "enable_ocr": enable_ocr,
+                    "ocr_max_pages": ocr_max_pages,
+                    "ocr_options": ocr_options or {},
+                    "profile": perf.profiling,
+                    "memory": None if not perf.memory else "tracemalloc" if perf.memory.trace_allocations else "rss",
+                    "prefilter_threshold": prefilter_threshold,
+                    "cost_key": (account_label, record["sender_key"], d["sha256"]),
+                })
+    logger.info(f"   Loaded {len(records)} messages, {len(tasks)} files to analyze ({workers} workers)")
+
+    results: Dict[int, Dict[str, Any]] = {}
+    with perf.timer("reprocess_analyze"):
+        worker_tasks = [{k: v for k, v in t.items() if k not in ("record", "download")} for t in tasks]
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for done, (index, result, snapshot) in enumerate(pool.map(_reprocess_worker, worker_tasks, chunksize=4), 1):
+                results[index] = result
+                perf.merge(snapshot)
+                if done % 100 == 0 or done == len(tasks):
+                    perf.log_progress(done, len(tasks), "files")
+
+    logger.info("📝 Writing output files...")
+    with perf.timer("reprocess_write"):
+        invoices_by_record: Dict[int, List[Dict[str, Any]]] = defaultdict(list)
+        for task in tasks:
+            record = records[task["record"]]
+            result = results[task["index"]]
+            analyzed_item = {"file": task["download"]["saved_as"], "analysis": result["analysis"]}
+            if "prefilter" in result:
+                analyzed_item["prefilter"] = result["prefilter"]
+            record["attachments_analyzed"].append(analyzed_item)
+
+            best = (result["analysis"] or {}).get("best_total")
+            if best:
+                perf.increment("invoices_detected")
+                perf.charge(account_label, record["sender_key"], task["download"]["sha256"], invoices=1)
+                row = invoice_row(account_label, record["date_utc"], record["sender_key"], record["subject"],
+                                  task["download"]["saved_as"], best)
+                invoices_by_record[task["record"]].append(dict(row, sha256=task["download"]["sha256"]))
+
+        tmp = results_path.with_suffix(".jsonl.tmp")
+        with tmp.open("w", encoding="utf-8") as f_out:
+            for record in records:
+                f_out.write(json.dumps(record, ensure_ascii=False) + "\n")
+        os.replace(tmp, results_path)
+
+        with ResultsStore(out_dir / "results.sqlite", logger) as store:
+            store.reset_account(account_label)
+            for r_idx, record in enumerate(records):
+                store.add_message(record, invoices_by_record.get(r_idx, []))
+            store.commit()
+            invoice_rows = export_csvs_from_store(store, account_label, out_dir, logger)
+            if parquet or (out_dir / "invoices.parquet").exists() or (out_dir / "messages.parquet").exists():
+                export_parquet_from_store(store, account_label, out_dir, logger)
+            write_cost_report(out_dir, account_label, perf, logger)
+            write_account_dashboard(out_dir, account_label, invoice_rows, dashboard_mode, logger, perf)
+
+    if create_zip:
+        zip_path = create_zip_archive(out_dir, account_label, logger, perf)
+        logger.info(f"   ✅ {zip_path.name}")
 
-    seen_hashes = set()
+    logger.info(f"   Invoices detected: {perf.get_count('invoices_detected')}")
 
-    logger.info("")
-    logger.info(f"📧 Processing {len(msg_ids)} messages...")
-    logger.info("")
 
-    with results_path.open("w", encoding="utf-8") as f_out:
-        for i, msg_id in enumerate(msg_ids, 1):
-            perf.increment("messages_processed")
+def _add_ocr_tuning_args(p: argparse.ArgumentParser) -> None:
+    p.add_argument("--ocr-dpi", type=int, default=OCR_DEFAULT_DPI, help="Rasterization DPI for OCR of scanned PDFs")
+    p.add_argument("--ocr-fast", action="store_true",
+                   help="Grayscale, downscaled, single-block tesseract mode (faster, may miss totals on busy layouts)")
+    p.add_argument("--ocr-early-exit", action="store_true",
+                   help="Stop OCR-ing a PDF's pages once a total has been found")
+    p.add_argument("--ocr-workers", type=int, default=1,
+                   help="Threads OCR-ing a scanned PDF's pages while the next ones are rendered")
+    p.add_argument("--ocr-memory-mb", type=int, default=OCR_MEMORY_CEILING_MB,
+                   help="Ceiling on page rasters held at once per PDF; bigger pages are rendered at a lower DPI")
 
-            # Progress logging
-            if i == 1 or i % 25 == 0 or i == len(msg_ids):
-                perf.log_progress(i, len(msg_ids), "messages")
 
-            logger.debug(f"")
-            logger.debug(f"--- Message {i}/{len(msg_ids)}: {msg_id} ---")
+def _add_logging_args(p: argparse.ArgumentParser) -> None:
+    p.add_argument("--log-format", choices=["text", "json"], default="text",
+                   help="Console/log file format (json: one JSON object per line)")
+    p.add_argument("--log-async", action="store_true",
+                   help="Format and write log records on a background thread")
 
-            with perf.timer("fetch_message"):
-                try:
-                    msg = service.users().messages().get(userId="me", id=msg_id, format="full").execute()
-                except HttpError as e:
-                    logger.error(f"   Failed to fetch message {msg_id}: {e}")
-                    perf.increment("messages_failed")
-                    continue
 
-            payload = msg.get("payload", {}) or {}
-            headers = payload.get("headers", []) or []
+def _add_metrics_args(p: argparse.ArgumentParser) -> None:
+    p.add_argument("--prometheus-textfile", default=None,
+                   help="Also write run metrics here in node-exporter textfile format (e.g. .../textfile/invoices.prom)")
 
-            from_raw = get_header(headers, "From")
-            sender_name, sender_email = parseaddr(from_raw)
-            sender_email = (sender_email or "").lower().strip()
-            sender_key = sender_email or sanitize_filename(from_raw or "unknown_sender")
 
-            subject = get_header(headers, "Subject")
-            date_utc = parse_gmail_internal_date(msg.get("internalDate", ""))
+def _add_profile_args(p: argparse.ArgumentParser) -> None:
+    p.add_argument("--profile", nargs="+", default=None, choices=sorted(PROFILE_STAGES) + ["all"],
+                   help="cProfile these stages; writes profiles/<stage>.pstats and a hot-function table")
+    p.add_argument("--profile-rate", type=float, default=1.0,
+                   help="Fraction of stage blocks to profile (e.g. 0.05 for low overhead)")
 
-            logger.debug(f"   From: {sender_email or from_raw[:50]}")
-            logger.debug(f"   Subject: {subject[:60]}...")
-            logger.debug(f"   Date: {date_utc[:10] if date_utc else 'unknown'}")
 
-            plain, html = extract_text_parts(payload)
-            links = list(dict.fromkeys(extract_links(plain) + extract_links(html)))
+def _enable_profiling(perf: PerformanceTracker, args) -> None:
+    if args.profile:
+        stages = sorted(PROFILE_STAGES) if "all" in args.profile else args.profile
+        perf.enable_profiling(stages, rate=args.profile_rate)
 
-            attachments_meta = iter_attachments(payload)
-            logger.debug(f"   Attachments found: {len(attachments_meta)}")
 
-            downloaded = []
-            analyzed = []
+def _add_memory_args(p: argparse.ArgumentParser) -> None:
+    p.add_argument("--memory-interval", type=float, default=MEMORY_SAMPLE_INTERVAL,
+                   help="Seconds between background RSS samples (0 disables memory tracking)")
+    p.add_argument("--tracemalloc", action="store_true",
+                   help="Also track Python heap peaks per stage and file (slows the run noticeably)")
 
-            sender_folder = downloads_dir / sanitize_filename(sender_key)
-            ensure_dir(sender_folder)
 
-            for att in attachments_meta:
-                filename = att["filename"]
-                ext = Path(filename).suffix.lower()
+def _enable_memory_tracking(perf: PerformanceTracker, args) -> None:
+    if args.memory_interval > 0:
+        perf.enable_memory_tracking(args.memory_interval, trace_allocations=args.tracemalloc)
 
-                if ext not in ALLOWED_EXTS:
-                    logger.debug(f"      Skipping {filename} (unsupported extension: {ext})")
-                    perf.increment("attachments_skipped_ext")
-                    continue
 
-                size = int(att.get("size") or 0)
-                if size > max_attachment_mb * 1024 * 1024:
-                    logger.debug(f"      Skipping {filename} (too large: {format_bytes(size)})")
-                    perf.increment("attachments_skipped_size")
-                    continue
+def _add_blob_store_args(p: argparse.ArgumentParser) -> None:
+    p.add_argument("--no-blob-store", action="store_true",
+                   help="Save each account's attachments separately instead of linking them from <out>/blobs")
 
-                safe_name = sanitize_filename(filename)
-                target = sender_folder / f"{msg_id}_{safe_name}"
 
-                try:
-                    logger.debug(f"      Downloading: {filename} ({format_bytes(size)})")
+def _open_blob_store(base_out: Path, args, logger: logging.Logger) -> Optional[BlobStore]:
+    return None if args.no_blob_store else BlobStore(base_out / "blobs", logger)
 
-                    with perf.timer("download_attachment"):
-                        data = download_attachment(service, msg_id, att["attachmentId"])
 
-                    h = sha256_bytes(data)
-                    if (not allow_duplicates) and (h in seen_hashes):
-                        logger.debug(f"      Skipping duplicate (sha256: {h[:16]}...)")
-                        perf.increment("attachments_skipped_duplicate")
-                        continue
-                    seen_hashes.add(h)
-
-                    target.write_bytes(data)
-                    total_bytes_downloaded += len(data)
-                    perf.increment("attachments_downloaded")
-                    perf.increment("bytes_downloaded", len(data))
-
-                    logger.debug(f"      Saved: {target.relative_to(out_dir)}")
-
-                    downloaded.append({
-                        "filename": filename,
-                        "saved_as": str(target.relative_to(out_dir)),
-                        "mimeType": att.get("mimeType", ""),
-                        "size": len(data),
-                        "sha256": h,
-                    })
-
-                    # Analyze the file
-                    logger.debug(f"      Analyzing content...")
-                    analysis = analyze_file(target, enable_ocr, ocr_max_pages, logger, perf)
-                    best = analysis["best_total"]
-
-                    analyzed_item = {
-                        "file": str(target.relative_to(out_dir)),
-                        "analysis": analysis,
-                    }
-                    analyzed.append(analyzed_item)
-
-                    if best:
-                        amt = float(best["amount"])
-                        curr = best["currency"]
-                        total_by_currency[curr] += amt
-                        total_by_sender_currency[(sender_key, curr)] += amt
-                        perf.increment("invoices_detected")
-
-                        file_rows.append({
-                            "account": account_label,
-                            "date_utc": date_utc,
-                            "sender": sender_key,
-                            "subject": subject,
-                            "file": str(target.relative_to(out_dir)),
-                            "currency": curr,
-                            "amount": f"{amt:.2f}",
-                            "evidence": best["context"].replace("\n", " ")[:180],
-                            "method": best["source"],
-                        })
-
-                        logger.info(f"   💰 Found: {CURRENCY_SYMBOLS.get(curr, '')}{amt:,.2f} {curr} from {sender_key[:30]}")
-
-                except HttpError as e:
-                    logger.error(f"      Download failed: {e}")
-                    perf.increment("attachments_failed")
-                except Exception as e:
-                    logger.error(f"      Processing failed: {e}")
-                    perf.increment("attachments_failed")
-
-            record = {
-                "account": account_label,
-                "message_id": msg_id,
-                "date_utc": date_utc,
-                "from_raw": from_raw,
-                "sender_email": sender_email,
-                "sender_name": sender_name,
-                "sender_key": sender_key,
-                "subject": subject,
-                "links": links,
-                "attachments_downloaded": downloaded,
-                "attachments_analyzed": analyzed,
-            }
-            f_out.write(json.dumps(record, ensure_ascii=False) + "\n")
+def _prometheus_path(args) -> Optional[Path]:
+    return Path(args.prometheus_textfile).expanduser().resolve() if args.prometheus_textfile else None
 
-    # Write CSVs
-    logger.info("")
-    logger.info("📝 Writing output files...")
 
-    with perf.timer("write_csvs"):
-        with totals_csv.open("w", encoding="utf-8", newline="") as f:
-            w = csv.DictWriter(f, fieldnames=[
-                "account", "date_utc", "sender", "subject", "file",
-                "currency", "amount", "evidence", "method"
-            ])
-            w.writeheader()
-            for r in file_rows:
-                w.writerow(r)
-        logger.info(f"   ✅ {totals_csv.name}: {len(file_rows)} rows")
-
-        with by_sender_csv.open("w", encoding="utf-8", newline="") as f:
-            w = csv.writer(f)
-            w.writerow(["sender", "currency", "sum_amount"])
-            sender_rows = 0
-            for (sender, curr), amt in sorted(total_by_sender_currency.items(), key=lambda x: (-x[1], x[0][0], x[0][1])):
-                w.writerow([sender, curr, f"{amt:.2f}"])
-                sender_rows += 1
-        logger.info(f"   ✅ {by_sender_csv.name}: {sender_rows} rows")
+def _ocr_options(args) -> Dict[str, Any]:
+    return {"ocr_dpi": args.ocr_dpi, "ocr_fast": args.ocr_fast, "ocr_early_exit": args.ocr_early_exit,
+            "ocr_workers": args.ocr_workers, "ocr_memory_mb": args.ocr_memory_mb}
 
-        with by_currency_csv.open("w", encoding="utf-8", newline="") as f:
-            w = csv.writer(f)
-            w.writerow(["currency", "sum_amount"])
-            for curr, amt in sorted(total_by_currency.items(), key=lambda x: -x[1]):
-                w.writerow([curr, f"{amt:.2f}"])
-        logger.info(f"   ✅ {by_currency_csv.name}: {len(total_by_currency)} rows")
 
-    # Generate dashboard
-    logger.info("   Generating dashboard...")
+def main_reprocess(argv: List[str]) -> None:
+    p = argparse.ArgumentParser(
+        prog="invoice_expenses.py reprocess",
+        description="Re-analyze already-downloaded attachments offline and regenerate CSVs + dashboard.",
+    )
+    p.add_argument("--out", default="out", help="Output directory of an earlier run")
+    p.add_argument("--accounts", nargs="+", required=True, help="Account labels to reprocess")
+    p.add_argument("--ocr", action="store_true", help="Enable OCR for PDFs/images")
+    p.add_argument("--ocr-max-pages", type=int, default=3, help="OCR first N pages of PDFs")
+    _add_ocr_tuning_args(p)
+    p.add_argument("--prefilter-threshold", type=float, default=None,
+                   help="Opt in to skipping OCR of attachments that score below this (e.g. 0; higher = stricter)")
+    p.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Parallel analysis processes")
+    p.add_argument("--dashboard-mode", choices=["auto", "inline", "paged"], default="auto")
+    p.add_argument("--no-zip", action="store_true", help="Skip updating the zip archive")
+    p.add_argument("--parquet", action="store_true",
+                   help="Also write invoices.parquet / messages.parquet (regenerated anyway if they exist; requires pyarrow)")
+    _add_metrics_args(p)
+    _add_profile_args(p)
+    _add_memory_args(p)
+    p.add_argument("-v", "--verbose", action="store_true", help="Enable verbose/debug logging")
+    _add_logging_args(p)
+    args = p.parse_args(argv)
 
-    with perf.timer("generate_dashboard"):
-        generated_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    base_out = Path(args.out).expanduser().resolve()
+    logger = setup_logging(verbose=args.verbose, log_file=base_out / "reprocess.log",
+                           log_format=args.log_format, async_logging=args.log_async)
+    perf = PerformanceTracker(logger)
+    _enable_profiling(perf, args)
+    _enable_memory_tracking(perf, args)
 
-        # Prepare perf summary for dashboard
-        total_time = time.time() - perf.start_time
-        perf_summary = {
-            "messages_processed": perf.get_count("messages_processed"),
-            "attachments_downloaded": perf.get_count("attachments_downloaded"),
-            "total_bytes": format_bytes(perf.get_count("bytes_downloaded")),
-            "ocr_performed": perf.get_count("ocr_attempts"),
-            "processing_time": perf._format_duration(total_time),
-        }
+    if args.parquet and not module_available("pyarrow"):
+        logger.error("❌ --parquet requires pyarrow (pip install pyarrow)")
+        sys.exit(1)
 
-        dashboard_html = generate_dashboard_html(
-            account_label,
-            file_rows,
-            dict(total_by_currency),
-            dict(total_by_sender_currency),
-            generated_at,
-            perf_summary
+    for label in args.accounts:
+        try:
+            reprocess_account(
+                account_label=label,
+                out_dir=base_out / sanitize_filename(label),
+                enable_ocr=args.ocr,
+                ocr_max_pages=args.ocr_max_pages,
+                prefilter_threshold=args.prefilter_threshold,
+                workers=max(1, args.workers),
+                dashboard_mode=args.dashboard_mode,
+                create_zip=not args.no_zip,
+                logger=logger,
+                perf=perf,
+                ocr_options=_ocr_options(args),
+                parquet=args.parquet,
+            )
+        except Exception as e:
+            logger.error(f"❌ Failed reprocessing account '{label}': {e}")
+            if args.verbose:
+                import traceback
+                logger.error(traceback.format_exc())
+
+    perf.print_summary()
+    perf.export(base_out, _prometheus_path(args))
+
+
+def main_ingest(argv: List[str]) -> None:
+    p = argparse.ArgumentParser(
+        prog="invoice_expenses.py ingest",
+        description="Process mbox files (e.g. Google Takeout) and .eml files offline instead of the Gmail API.",
+    )
+    p.add_argument("--input", nargs="+", required=True,
+                   help="mbox / .eml files, or directories searched for *.mbox and *.eml")
+    p.add_argument("--account", required=True, help="Account label to file the results under")
+    p.add_argument("--out", default="out", help="Output directory")
+    p.add_argument("--after", default=None, help="Only messages dated after YYYY-MM-DD (default: all)")
+    p.add_argument("--max", type=int, default=0, help="Max matching messages (0 = no limit)")
+    p.add_argument("--max-attachment-mb", type=int, default=25, help="Skip attachments bigger than this")
+    p.add_argument("--keywords", nargs="*", default=None,
+                   help="Override keywords list (pass with no values to ingest every message with an attachment)")
+    p.add_argument("--ocr", action="store_true", help="Enable OCR for PDFs/images")
+    p.add_argument("--ocr-max-pages", type=int, default=3, help="OCR first N pages of PDFs")
+    _add_ocr_tuning_args(p)
+    p.add_argument("--prefilter-threshold", type=float, default=None,
+                   help="Opt in to skipping OCR of attachments that score below this (e.g. 0; higher = stricter)")
+    p.add_argument("--allow-duplicates", action="store_true", help="Count identical files multiple times")
+    p.add_argument("--no-zip", action="store_true", help="Skip creating zip archive")
+    p.add_argument("--parquet", action="store_true",
+                   help="Also write typed invoices.parquet / messages.parquet (requires pyarrow)")
+    p.add_argument("--dashboard-mode", choices=["auto", "inline", "paged"], default="auto")
+    p.add_argument("--resume", action="store_true",
+                   help="Continue an interrupted ingest from its checkpoint.journal instead of starting over")
+    p.add_argument("--incremental", action="store_true",
+                   help="Reopen results.sqlite and skip messages processed by earlier runs")
+    _add_blob_store_args(p)
+    _add_metrics_args(p)
+    _add_profile_args(p)
+    _add_memory_args(p)
+    p.add_argument("-v", "--verbose", action="store_true", help="Enable verbose/debug logging")
+    _add_logging_args(p)
+    args = p.parse_args(argv)
+
+    base_out = Path(args.out).expanduser().resolve()
+    ensure_dir(base_out)
+    logger = setup_logging(verbose=args.verbose, log_file=base_out / "ingest.log",
+                           log_format=args.log_format, async_logging=args.log_async)
+    perf = PerformanceTracker(logger)
+    _enable_profiling(perf, args)
+    _enable_memory_tracking(perf, args)
+
+    inputs = [Path(i).expanduser().resolve() for i in args.input]
+    missing = [i for i in inputs if not i.exists()]
+    if missing:
+        logger.error(f"❌ Missing input: {', '.join(str(m) for m in missing)}")
+        sys.exit(1)
+
+    if args.parquet and not module_available("pyarrow"):
+        logger.error("❌ --parquet requires pyarrow (pip install pyarrow)")
+        sys.exit(1)
+
+    after = datetime.strptime(args.after, "%Y-%m-%d").date() if args.after else None
+    keywords = DEFAULT_KEYWORDS if args.keywords is None else args.keywords
+    source = MailboxSource(inputs, keywords, after, args.max or None, logger, perf)
+    blob_store = _open_blob_store(base_out, args, logger)
+
+    logger.info(f"📋 Configuration:")
+    logger.info(f"   Inputs: {len(source.files)} files, {format_bytes(source.total_bytes)}")
+    logger.info(f"   Date filter: {f'after {after}' if after else 'none'}")
+    logger.info(f"   Keywords: {f'{len(keywords)} terms' if keywords else 'none (all messages with attachments)'}")
+    logger.info(f"   OCR enabled: {args.ocr}")
+    logger.info(f"   Output directory: {base_out}")
+
+    try:
+        process_source(
+            source,
+            account_label=args.account,
+            out_dir=base_out / sanitize_filename(args.account),
+            max_attachment_mb=args.max_attachment_mb,
+            enable_ocr=args.ocr,
+            ocr_max_pages=args.ocr_max_pages,
+            allow_duplicates=args.allow_duplicates,
+            create_zip=not args.no_zip,
+            logger=logger,
+            perf=perf,
+            prefilter_threshold=args.prefilter_threshold,
+            incremental=args.incremental,
+            parquet=args.parquet,
+            dashboard_mode=args.dashboard_mode,
+            resume=args.resume,
+            ocr_options=_ocr_options(args),
+            blob_store=blob_store,
         )
-        dashboard_path.write_text(dashboard_html, encoding="utf-8")
-    logger.info(f"   ✅ {dashboard_path.name}")
+    except Exception as e:
+        logger.error(f"❌ Failed ingesting into account '{args.account}': {e}")
+        if args.verbose:
+            import traceback
+            logger.error(traceback.format_exc())
+    if blob_store:
+        blob_store.close()
 
-    # Create zip archive
-    if create_zip:
-        zip_path = create_zip_archive(out_dir, account_label, logger, perf)
-        logger.info(f"   ✅ {zip_path.name}")
+    perf.print_summary()
+    perf.export(base_out, _prometheus_path(args))
 
-    # Summary
-    logger.info("")
-    logger.info("=" * 60)
-    logger.info(f"📊 ACCOUNT SUMMARY: {account_label}")
-    logger.info("=" * 60)
-    logger.info(f"   Messages processed: {perf.get_count('messages_processed')}")
-    logger.info(f"   Attachments downloaded: {perf.get_count('attachments_downloaded')}")
-    logger.info(f"   Data downloaded: {format_bytes(total_bytes_downloaded)}")
-    logger.info(f"   Invoices detected: {perf.get_count('invoices_detected')}")
-    logger.info("")
-    logger.info("   💰 TOTALS BY CURRENCY:")
-    for curr, amt in sorted(total_by_currency.items(), key=lambda x: -x[1]):
-        logger.info(f"      {curr}: {CURRENCY_SYMBOLS.get(curr, '')}{amt:,.2f}")
-    logger.info("")
-    logger.info(f"   📁 Output directory: {out_dir}")
-    logger.info("=" * 60)
 
-    # Remove file handler
-    logger.removeHandler(file_handler)
-    file_handler.close()
+# ============== FAKE GMAIL SERVER (LOAD TESTING) ==============
+
+FAKE_GMAIL_SENDERS = [
+    ("Electric Co", "billing@electric.example"),
+    ("Cloud Hosting", "invoices@cloud.example"),
+    ("חברת החשמל", "noreply@iec.example"),
+    ("Office Supplies", "receipts@office.example"),
+    ("Telecom", "bill@telecom.example"),
+]
+
+
+def _b64url(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode("ascii")
+
+
+def _fake_gmail_message(msg_id: str, internal_ms: int, from_raw: str, subject: str, plain: str, html: str,
+                        attachments: List[Tuple[str, str, str, int]]) -> Dict[str, Any]:
+    """Gmail 'full' format message; attachments are (attachmentId, filename, mimeType, size)."""
+    parts = [{"partId": "0", "mimeType": "text/plain", "filename": "",
+              "body": {"size": len(plain), "data": _b64url(plain.encode("utf-8"))}}]
+    if html:
+        parts.append({"partId": "1", "mimeType": "text/html", "filename": "",
+                      "body": {"size": len(html), "data": _b64url(html.encode("utf-8"))}})
+    for att_id, filename, mime, size in attachments:
+        parts.append({"partId": str(len(parts)), "mimeType": mime, "filename": filename,
+                      "body": {"attachmentId": att_id, "size": size}})
+    return {
+        "id": msg_id,
+        "threadId": msg_id,
+        "labelIds": ["INBOX"],
+        "internalDate": str(internal_ms),
+        "payload": {
+            "mimeType": "multipart/mixed",
+            "filename": "",
+            "headers": [{"name": "From", "value": from_raw}, {"name": "Subject", "value": subject}],
+            "body": {"size": 0},
+            "parts": parts,
+        },
+    }
+
+
+def synthetic_gmail_corpus(n_messages: int, seed: int = 0) -> Tuple[List[Dict[str, Any]], Dict[Tuple[str, str], bytes]]:
+    """n messages with a native-text PDF invoice each, and every 4th with an extra non-invoice PDF."""
+    rng = random.Random(seed)
+    messages: List[Dict[str, Any]] = []
+    blobs: Dict[Tuple[str, str], bytes] = {}
+    start_ms = int((time.time() - 330 * 86400) * 1000)
+
+    for i in range(n_messages):
+        msg_id = f"{i:016x}"
+        name, email_addr = FAKE_GMAIL_SENDERS[i % len(FAKE_GMAIL_SENDERS)]
+        amount = rng.randint(10, 5000) + rng.randint(0, 99) / 100
+        doc = fitz.open()
+        page = doc.new_page()
+        page.insert_text((72, 72), f"{name}\nTax Invoice #{10000 + i}\nDate: 2024-{i % 12 + 1:02d}-15\n\n"
+                                   f"Service fee        {amount * 0.83:,.2f}\nVAT 17%            {amount * 0.17:,.2f}\n"
+                                   f"Total due: ${amount:,.2f}\n")
+        blobs[(msg_id, "a0")] = doc.tobytes()
+        doc.close()
+        atts = [("a0", f"invoice_{10000 + i}.pdf", "application/pdf", len(blobs[(msg_id, "a0")]))]
+
+        if i % 4 == 3:
+            doc = fitz.open()
+            doc.new_page().insert_text((72, 72), "Terms and conditions\n" + "Lorem ipsum dolor sit amet.\n" * 20)
+            blobs[(msg_id, "a1")] = doc.tobytes()
+            doc.close()
+            atts.append(("a1", "terms.pdf", "application/pdf", len(blobs[(msg_id, "a1")])))
+
+        messages.append(_fake_gmail_message(
+            msg_id, start_ms + i * 3600 * 1000, f"{name} <{email_addr}>", f"Your invoice #{10000 + i}",
+            f"Hi,\nyour invoice is attached.\nView online: https://billing.example/{10000 + i}\n", "", atts,
+        ))
+    return messages, blobs
+
+
+def gmail_corpus_from_mailbox(paths: List[Path], logger: logging.Logger,
+                              perf: PerformanceTracker) -> Tuple[List[Dict[str, Any]], Dict[Tuple[str, str], bytes]]:
+    """Replay recorded mail: every mbox/.eml message with an attachment, in Gmail 'full' format."""
+    source = MailboxSource(paths, [], None, None, logger, perf)
+    messages: List[Dict[str, Any]] = []
+    blobs: Dict[Tuple[str, str], bytes] = {}
+
+    for message in source.messages(set()):
+        atts = []
+        for n, att in enumerate(message["attachments"]):
+            att_id = f"a{n}"
+            blobs[(message["id"], att_id)] = source.download_attachment(message["id"], att["attachmentId"])
+            atts.append((att_id, att["filename"], att["mimeType"], len(blobs[(message["id"], att_id)])))
+        try:
+            internal_ms = int(datetime.fromisoformat(message["date_utc"].rstrip("Z")).replace(
+                tzinfo=timezone.utc).timestamp() * 1000)
+        except ValueError:
+            internal_ms = 0
+        messages.append(_fake_gmail_message(message["id"], internal_ms, message["from_raw"], message["subject"],
+                                            message["plain"], message["html"], atts))
+    return messages, blobs
+
+
+class FakeGmailServer:
+    """
+    Local stand-in for the Gmail v1 endpoints the script calls: messages.list,
+    messages.get, messages.attachments.get and the batch endpoint. Point
+    gmail_service() at `url`. The search query is ignored (every message matches).
+    Latency, page size and 429/500 rates are injected per request.
+    """
+
+    ROUTES = [
+        ("attachments", re.compile(r"^/gmail/v1/users/[^/]+/messages/([^/]+)/attachments/([^/]+)$")),
+        ("get", re.compile(r"^/gmail/v1/users/[^/]+/messages/([^/]+)$")),
+        ("list", re.compile(r"^/gmail/v1/users/[^/]+/messages$")),
+    ]
+
+    def __init__(
+        self,
+        messages: List[Dict[str, Any]],
+        blobs: Dict[Tuple[str, str], bytes],
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency_ms: float = 0.0,
+        jitter_ms: float = 0.0,
+        page_size: int = 100,
+        rate_429: float = 0.0,
+        rate_500: float = 0.0,
+        seed: int = 0,
+    ):
+        self.messages = messages
+        self.by_id = {m["id"]: m for m in messages}
+        self.attachments = {key: _b64url(data) for key, data in blobs.items()}
+        self.sizes = {key: len(data) for key, data in blobs.items()}
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.page_size = page_size
+        self.rate_429 = rate_429
+        self.rate_500 = rate_500
+        self.stats: Dict[str, int] = defaultdict(int)
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                self._reply(*fake.handle("GET", self.path))
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                if urlsplit(self.path).path.startswith("/batch"):
+                    self._reply(*fake.handle_batch(self.headers.get("Content-Type", ""), body))
+                else:
+                    self._reply(404, "application/json", b'{"error": {"code": 404}}')
+
+            def _reply(self, status: int, content_type: str, body: bytes):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def start(self) -> "FakeGmailServer":
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="fake-gmail", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self) -> "FakeGmailServer":
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.stop()
+
+    def _error(self, code: int, status: str, message: str) -> Tuple[int, str, bytes]:
+        body = {"error": {"code": code, "message": message, "status": status}}
+        return code, "application/json", json.dumps(body).encode("utf-8")
+
+    def handle(self, method: str, raw_path: str) -> Tuple[int, str, bytes]:
+        """Serve one API call; returns (status, content type, body)."""
+        url = urlsplit(raw_path)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+
+        with self._lock:
+            delay = max(0.0, self._rng.gauss(self.latency_ms, self.jitter_ms)) / 1000 if self.latency_ms else 0.0
+            roll = self._rng.random()
+            self.stats["requests"] += 1
+        if delay:
+            time.sleep(delay)
+
+        if roll < self.rate_429:
+            with self._lock:
+                self.stats["injected_429"] += 1
+            return self._error(429, "RESOURCE_EXHAUSTED", "Rate Limit Exceeded")
+        if roll < self.rate_429 + self.rate_500:
+            with self._lock:
+                self.stats["injected_500"] += 1
+            return self._error(500, "INTERNAL", "Backend Error")
+
+        for name, pattern in self.ROUTES:
+            m = pattern.match(url.path)
+            if not m or method != "GET":
+                continue
+            with self._lock:
+                self.stats[name] += 1
+
+            if name == "list":
+                start = int(params.get("pageToken") or 0)
+                end = start + min(int(params.get("maxResults") or 100), self.page_size)
+                body = {
+                    "messages": [{"id": msg["id"], "threadId": msg["threadId"]} for msg in self.messages[start:end]],
+                    "resultSizeEstimate": len(self.messages),
+                }
+                if end < len(self.messages):
+                    body["nextPageToken"] = str(end)
+            elif name == "get":
+                if m.group(1) not in self.by_id:
+                    return self._error(404, "NOT_FOUND", "Requested entity was not found.")
+                body = self.by_id[m.group(1)]
+            else:
+                key = (m.group(1), m.group(2))
+                if key not in self.attachments:
+                    return self._error(404, "NOT_FOUND", "Requested entity was not found.")
+                body = {"attachmentId": key[1], "size": self.sizes[key], "data": self.attachments[key]}
+            return 200, "application/json", json.dumps(body, ensure_ascii=False).encode("utf-8")
+
+        return self._error(404, "NOT_FOUND", f"No fake for {method} {url.path}")
+
+    def handle_batch(self, content_type: str, body: bytes) -> Tuple[int, str, bytes]:
+        """multipart/mixed batch of GETs, answered part by part (errors are injected per part)."""
+        with self._lock:
+            self.stats["batch"] += 1
+        envelope = BytesParser(policy=email_policy.default).parsebytes(
+            b"Content-Type: " + content_type.encode("latin-1") + b"\r\n\r\n" + body
+        )
+        boundary = f"batch_{random.getrandbits(64):016x}"
+        out = []
+        for part in envelope.iter_parts():
+            request_line = part.get_payload(decode=True).decode("utf-8").split("\r\n", 1)[0].split("\n", 1)[0]
+            method, path = request_line.split(" ")[:2]
+            status, part_type, part_body = self.handle(method, path)
+            content_id = (part.get("Content-ID") or "").strip("<>")
+            out.append(
+                f"--{boundary}\r\nContent-Type: application/http\r\nContent-ID: <response-{content_id}>\r\n\r\n"
+                f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\nContent-Type: {part_type}\r\n"
+                f"Content-Length: {len(part_body)}\r\n\r\n".encode("utf-8") + part_body + b"\r\n"
+            )
+        out.append(f"--{boundary}--\r\n".encode("utf-8"))
+        return 200, f"multipart/mixed; boundary={boundary}", b"".join(out)
+
+
+def _load_fake_corpus(args, logger: logging.Logger, perf: PerformanceTracker):
+    with perf.timer("build_corpus"):
+        if args.corpus:
+            messages, blobs = gmail_corpus_from_mailbox([Path(c).expanduser().resolve() for c in args.corpus], logger, perf)
+        else:
+            messages, blobs = synthetic_gmail_corpus(args.messages, seed=args.seed)
+    logger.info(f"📦 Corpus: {len(messages)} messages, {len(blobs)} attachments, "
+                f"{format_bytes(sum(len(b) for b in blobs.values()))}")
+    return messages, blobs
+
+
+def _add_fake_gmail_args(p: argparse.ArgumentParser) -> None:
+    p.add_argument("--corpus", nargs="+", default=None,
+                   help="Replay recorded mbox/.eml files instead of a synthetic corpus")
+    p.add_argument("--messages", type=int, default=200, help="Synthetic corpus size")
+    p.add_argument("--seed", type=int, default=0, help="Seed for the synthetic corpus and injected faults")
+    p.add_argument("--latency-ms", type=float, default=20.0, help="Mean added latency per API call")
+    p.add_argument("--jitter-ms", type=float, default=5.0, help="Std deviation of the added latency")
+    p.add_argument("--page-size", type=int, default=100, help="Max messages per messages.list page")
+    p.add_argument("--rate-429", type=float, default=0.0, help="Fraction of calls answered 429")
+    p.add_argument("--rate-500", type=float, default=0.0, help="Fraction of calls answered 500")
+
+
+def main_fake_gmail(argv: List[str]) -> None:
+    p = argparse.ArgumentParser(
+        prog="invoice_expenses.py fake-gmail",
+        description="Serve a synthetic or recorded corpus on a local Gmail-compatible endpoint "
+                    "(use with --gmail-endpoint).",
+    )
+    p.add_argument("--port", type=int, default=8085)
+    _add_fake_gmail_args(p)
+    p.add_argument("-v", "--verbose", action="store_true", help="Enable verbose/debug logging")
+    args = p.parse_args(argv)
+
+    logger = setup_logging(verbose=args.verbose)
+    perf = PerformanceTracker(logger)
+    messages, blobs = _load_fake_corpus(args, logger, perf)
+    server = FakeGmailServer(messages, blobs, port=args.port, latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+                             page_size=args.page_size, rate_429=args.rate_429, rate_500=args.rate_500, seed=args.seed)
+    logger.info(f"🔌 Fake Gmail listening on {server.url} (Ctrl+C to stop)")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+        logger.info(f"   Served: {dict(server.stats)}")
+
+
+def main_loadtest(argv: List[str]) -> None:
+    p = argparse.ArgumentParser(
+        prog="invoice_expenses.py loadtest",
+        description="Run the full Gmail pipeline end to end against a local fake Gmail server and report throughput.",
+    )
+    _add_fake_gmail_args(p)
+    p.add_argument("--ocr", action="store_true", help="Enable OCR for PDFs/images")
+    p.add_argument("--zip", action="store_true", help="Include zip creation in the measured run")
+    p.add_argument("--workdir", default=None, help="Keep outputs here (default: a temp dir that is removed)")
+    p.add_argument("--report", default=None, help="Write the result as JSON to this file")
+    p.add_argument("--baseline", default=None, help="Earlier --report to compare against")
+    p.add_argument("--max-regression", type=float, default=0.15,
+                   help="Fail if messages/sec drops more than this fraction below --baseline")
+    p.add_argument("-v", "--verbose", action="store_true", help="Enable verbose/debug logging")
+    args = p.parse_args(argv)
+
+    logger = setup_logging(verbose=args.verbose)
+    perf = PerformanceTracker(logger)
+    messages, blobs = _load_fake_corpus(args, logger, perf)
+    workdir = Path(args.workdir).expanduser().resolve() if args.workdir else Path(tempfile.mkdtemp(prefix="loadtest_"))
+
+    try:
+        with FakeGmailServer(messages, blobs, latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+                             page_size=args.page_size, rate_429=args.rate_429, rate_500=args.rate_500,
+                             seed=args.seed) as server:
+            started = time.perf_counter()
+            run_account(
+                account_label="loadtest",
+                creds_path=workdir / "credentials.json",
+                token_path=workdir / "token.json",
+                out_dir=workdir / "loadtest",
+                keywords=DEFAULT_KEYWORDS,
+                after_yyyy_mm_dd="1970/01/01",
+                max_messages=len(messages),
+                max_attachment_mb=25,
+                enable_ocr=args.ocr,
+                ocr_max_pages=3,
+                allow_duplicates=False,
+                create_zip=args.zip,
+                logger=logger,
+                perf=perf,
+                api_endpoint=server.url,
+            )
+            wall = time.perf_counter() - started
+            server_stats = dict(server.stats)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    result = {
+        "messages": perf.get_count("messages_processed"),
+        "messages_failed": perf.get_count("messages_failed"),
+        "attachments": perf.get_count("attachments_downloaded"),
+        "bytes": perf.get_count("bytes_downloaded"),
+        "invoices": perf.get_count("invoices_detected"),
+        "wall_seconds": round(wall, 3),
+        "messages_per_sec": round(perf.get_count("messages_processed") / wall, 2) if wall else 0.0,
+        "attachments_per_sec": round(perf.get_count("attachments_downloaded") / wall, 2) if wall else 0.0,
+        "mb_per_sec": round(perf.get_count("bytes_downloaded") / wall / 1e6, 3) if wall else 0.0,
+        "config": {k: getattr(args, k) for k in ("messages", "seed", "latency_ms", "jitter_ms", "page_size",
+                                                  "rate_429", "rate_500", "ocr", "zip")},
+        "server": server_stats,
+    }
+    perf.print_summary()
+
+    logger.info("🏁 LOAD TEST RESULT")
+    for key in ("messages", "messages_failed", "attachments", "invoices", "wall_seconds",
+                "messages_per_sec", "attachments_per_sec", "mb_per_sec"):
+        logger.info(f"   {key}: {result[key]}")
+    logger.info(f"   server: {server_stats}")
+
+    if args.report:
+        Path(args.report).write_text(json.dumps(result, indent=2), encoding="utf-8")
+        logger.info(f"   ✅ {args.report}")
+
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text(encoding="utf-8"))
+        floor = baseline["messages_per_sec"] * (1 - args.max_regression)
+        if result["messages_per_sec"] < floor:
+            logger.error(f"❌ Regression: {result['messages_per_sec']} messages/sec < {floor:.2f} "
+                         f"(baseline {baseline['messages_per_sec']}, allowed -{args.max_regression:.0%})")
+            sys.exit(1)
+        logger.info(f"   ✅ Within {args.max_regression:.0%} of baseline ({baseline['messages_per_sec']} messages/sec)")
+
+
+# ============== SYNTHETIC CORPUS & BENCHMARKS ==============
+
+CORPUS_FORMATS = ["native_pdf", "scanned_pdf", "photo", "docx_table", "statement"]
+
+# Fonts with Hebrew glyphs; without one, Hebrew invoices fall back to English with NIS amounts
+CORPUS_FONT_CANDIDATES = [
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+    "/usr/share/fonts/dejavu/DejaVuSans.ttf",
+    "/usr/share/fonts/truetype/noto/NotoSansHebrew-Regular.ttf",
+    "/usr/share/fonts/truetype/freefont/FreeSans.ttf",
+    "/usr/share/fonts/truetype/culmus/DavidCLM-Medium.ttf",
+    "/Library/Fonts/Arial Unicode.ttf",
+    "/System/Library/Fonts/Supplemental/Arial Unicode.ttf",
+    "C:/Windows/Fonts/arial.ttf",
+]
+
+CORPUS_VENDORS_EN = ["Cloud Hosting Ltd", "Office Supplies Inc", "Telecom Services", "Design Studio", "Travel Agency"]
+CORPUS_VENDORS_HE = ["חברת החשמל לישראל", "בזק בינלאומי", "סופר פארם", "משרד רואי חשבון כהן", "מי אביבים"]
+CORPUS_ITEMS_EN = ["Monthly subscription", "Consulting hours", "Printer paper A4", "Domain renewal", "Support plan"]
+CORPUS_ITEMS_HE = ["מנוי חודשי", "שעות ייעוץ", "נייר למדפסת", "חידוש דומיין", "חבילת תמיכה"]
+
+BENCH_AMOUNT_STRINGS = [
+    "1,234.56", "1.234,56", "₪ 12 345", "$99.00", "€ 1.000,00", "45", "3,500", "12.5", "£7,890.10", "ש\"ח 250.00",
+]
+BENCH_BASELINE_FILE = "bench_baseline.json"
+BENCH_MIN_BATCH_SECONDS = 0.01  # calls per timed batch grow until a batch takes this long
+BENCH_MICRO_MS = 0.01  # benchmarks faster than this per call are gated on ops/sec with a wider tolerance
+
+
+def find_unicode_font() -> Optional[str]:
+    for candidate in CORPUS_FONT_CANDIDATES:
+        if Path(candidate).exists():
+            return candidate
+    return None
+
+
+def _fmt_amount(value: float, european: bool = False) -> str:
+    text = f"{value:,.2f}"
+    return text.replace(",", "_").replace(".", ",").replace("_", ".") if european else text
+
+
+def synthetic_invoice(rng: random.Random, number: int, hebrew: bool, n_items: int) -> Dict[str, Any]:
+    """Line items, VAT and a total, laid out as text lines in English or Hebrew."""
+    currency, symbol, european = ("ILS", "₪", False) if hebrew else rng.choice(
+        [("USD", "$", False), ("EUR", "€", True), ("GBP", "£", False), ("ILS", "NIS ", False)])
+    items = [(rng.choice(CORPUS_ITEMS_HE if hebrew else CORPUS_ITEMS_EN), rng.randint(1, 5),
+              rng.randint(5, 900) + rng.randint(0, 99) / 100) for _ in range(n_items)]
+    subtotal = round(sum(q * price for _, q, price in items), 2)
+    vat = round(subtotal * 0.17, 2)
+    total = round(subtotal + vat, 2)
+
+    def money(value: float) -> str:
+        return f"{_fmt_amount(value)} ₪" if hebrew else f"{symbol}{_fmt_amount(value, european)}"
+
+    if hebrew:
+        vendor = rng.choice(CORPUS_VENDORS_HE)
+        header = [vendor, f"חשבונית מס קבלה מס' {number}", f"תאריך: {rng.randint(1, 28):02d}/{rng.randint(1, 12):02d}/2024", ""]
+        footer = ["", f"סה\"כ לפני מע\"מ: {money(subtotal)}", f"מע\"מ 17%: {money(vat)}", f"סה\"כ לתשלום: {money(total)}"]
+    else:
+        vendor = rng.choice(CORPUS_VENDORS_EN)
+        header = [vendor, f"Tax Invoice #{number}", f"Date: 2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+                  "Bill to: Example Ltd", ""]
+        footer = ["", f"Subtotal: {money(subtotal)}", f"VAT 17%: {money(vat)}", f"Total due: {money(total)}"]
+
+    return {
+        "vendor": vendor,
+        "language": "he" if hebrew else "en",
+        "currency": currency,
+        "amount": total,
+        "items": [(desc, q, money(price), money(q * price)) for desc, q, price in items],
+        "header": header,
+        "footer": footer,
+    }
+
+
+def _invoice_lines(inv: Dict[str, Any]) -> List[str]:
+    return inv["header"] + [f"{desc}   x{q}   {price}   {line_total}" for desc, q, price, line_total in inv["items"]] + inv["footer"]
+
+
+def render_invoice_pdf(inv: Dict[str, Any], font: Optional[str], lines_per_page: int = 45) -> bytes:
+    lines = _invoice_lines(inv)
+    doc = fitz.open()
+    for start in range(0, len(lines), lines_per_page):
+        page = doc.new_page()
+        kwargs = {"fontname": "uni", "fontfile": font} if font else {}
+        page.insert_text((56, 64), "\n".join(lines[start:start + lines_per_page]), fontsize=10, **kwargs)
+    if font:
+        doc.subset_fonts()
+    data = doc.tobytes(garbage=3, deflate=True)
+    doc.close()
+    return data
+
+
+def _pdf_page_images(pdf_bytes: bytes, dpi: int) -> List["Image.Image"]:
+    images = []
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+        for page in doc:
+            pix = page.get_pixmap(dpi=dpi, colorspace=fitz.csGRAY)
+            images.append(Image.frombytes("L", (pix.width, pix.height), pix.samples))
+    return images
+
+
+def _degrade(img: "Image.Image", rng: random.Random, angle: float, blur: float) -> "Image.Image":
+    img = img.rotate(rng.uniform(-angle, angle), resample=Image.BICUBIC, expand=True, fillcolor=235)
+    if blur:
+        img = img.filter(ImageFilter.GaussianBlur(blur))
+    # Sensor/scanner grain: gaussian noise centred on mid-grey, lightly blended in
+    return Image.blend(img, Image.effect_noise(img.size, 40), 0.08)
+
+
+def render_scanned_pdf(inv: Dict[str, Any], font: Optional[str], rng: random.Random, dpi: int = 150) -> bytes:
+    """Image-only PDF, as a flatbed scanner would produce (no text layer)."""
+    doc = fitz.open()
+    for img in _pdf_page_images(render_invoice_pdf(inv, font), dpi):
+        buf = io.BytesIO()
+        _degrade(img, rng, angle=1.0, blur=0.0).save(buf, format="JPEG", quality=80)
+        page = doc.new_page()
+        page.insert_image(page.rect, stream=buf.getvalue())
+    data = doc.tobytes(garbage=3, deflate=True)
+    doc.close()
+    return data
+
+
+def render_photo(inv: Dict[str, Any], font: Optional[str], rng: random.Random) -> bytes:
+    """First page as a skewed, blurred, noisy phone snapshot (JPEG)."""
+    img = _pdf_page_images(render_invoice_pdf(inv, font), 200)[0]
+    img = _degrade(img, rng, angle=4.0, blur=0.8).convert("RGB")
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=65)
+    return buf.getvalue()
+
+
+def render_docx_table(inv: Dict[str, Any]) -> bytes:
+    d = docx.Document()
+    for line in inv["header"]:
+        d.add_paragraph(line)
+    table = d.add_table(rows=1, cols=4)
+    for cell, title in zip(table.rows[0].cells, ["Item", "Qty", "Price", "Amount"]):
+        cell.text = title
+    for desc, q, price, line_total in inv["items"]:
+        for cell, value in zip(table.add_row().cells, [desc, str(q), price, line_total]):
+            cell.text = value
+    for line in inv["footer"][1:]:
+        label, _, value = line.rpartition(": ")
+        cells = table.add_row().cells
+        cells[0].text = label
+        cells[3].text = value
+    buf = io.BytesIO()
+    d.save(buf)
+    return buf.getvalue()
+
+
+def write_corpus(out_dir: Path, per_format: int, seed: int, font: Optional[str], logger: logging.Logger) -> List[Dict[str, Any]]:
+    """Write per_format documents of each CORPUS_FORMATS kind plus a manifest.json with the true totals."""
+    ensure_dir(out_dir)
+    rng = random.Random(seed)
+    manifest = []
+
+    for fmt in CORPUS_FORMATS:
+        for i in range(per_format):
+            number = 20000 + len(manifest)
+            hebrew = bool(font) and i % 2 == 1
+            inv = synthetic_invoice(rng, number, hebrew, rng.randint(40, 160) if fmt == "statement" else rng.randint(2, 8))
+            if fmt == "native_pdf":
+                name, data = f"native_{i:03d}.pdf", render_invoice_pdf(inv, font)
+            elif fmt == "scanned_pdf":
+                name, data = f"scanned_{i:03d}.pdf", render_scanned_pdf(inv, font, rng)
+            elif fmt == "photo":
+                name, data = f"photo_{i:03d}.jpg", render_photo(inv, font, rng)
+            elif fmt == "docx_table":
+                name, data = f"table_{i:03d}.docx", render_docx_table(inv)
+            else:
+                name, data = f"statement_{i:03d}.pdf", render_invoice_pdf(inv, font)
+            (out_dir / name).write_bytes(data)
+            manifest.append({"file": name, "format": fmt, "language": inv["language"],
+                             "currency": inv["currency"], "amount": inv["amount"], "size": len(data)})
+
+    (out_dir / "manifest.json").write_text(json.dumps(manifest, indent=2, ensure_ascii=False), encoding="utf-8")
+    logger.info(f"✅ Wrote {len(manifest)} documents to {out_dir} "
+                f"({format_bytes(sum(m['size'] for m in manifest))}, Hebrew font: {font or 'none - English only'})")
+    return manifest
+
+
+def main_gen_corpus(argv: List[str]) -> None:
+    p = argparse.ArgumentParser(
+        prog="invoice_expenses.py gen-corpus",
+        description="Generate synthetic Hebrew/English invoices in every supported format, with ground truth.",
+    )
+    p.add_argument("--out", default="corpus", help="Output directory")
+    p.add_argument("--count", type=int, default=10, help="Documents per format")
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--font", default=None, help="TTF with Hebrew glyphs (default: first known system font)")
+    p.add_argument("-v", "--verbose", action="store_true", help="Enable verbose/debug logging")
+    args = p.parse_args(argv)
+
+    logger = setup_logging(verbose=args.verbose)
+    font = args.font or find_unicode_font()
+    if not font:
+        logger.warning("⚠️  No font with Hebrew glyphs found (use --font); generating English invoices only")
+    write_corpus(Path(args.out).expanduser().resolve(), args.count, args.seed, font, logger)
+
+
+def run_benchmark(fn, inputs: List[Any], min_time: float = 1.0, min_batches: int = 20,
+                  max_iters: int = 1_000_000) -> Dict[str, Any]:
+    """
+    Time fn over inputs (cycling) in batches of calls, timeit-style: the batch
+    size grows until one batch takes BENCH_MIN_BATCH_SECONDS, so microsecond
+    functions are not measured as timer overhead. Batches run for at least
+    min_time seconds / min_batches batches; p50/p95 are per-call times over the
+    batches. Peak memory is a separate single pass under tracemalloc, so it only
+    sees Python allocations (not MuPDF/Tesseract buffers) and does not slow the timed loop.
+    """
+    i = 0
+
+    def batch(size: int) -> float:
+        nonlocal i
+        args = [inputs[(i + k) % len(inputs)] for k in range(size)]
+        i += size
+        t0 = time.perf_counter()
+        for arg in args:
+            fn(arg)
+        return time.perf_counter() - t0
+
+    for arg in inputs[:3]:
+        fn(arg)
+
+    size = 1
+    while batch(size) < BENCH_MIN_BATCH_SECONDS and size < max_iters // min_batches:
+        size = size * 10 if size < 10 else size * 2
+    if size > len(inputs):
+        size = -(-size // len(inputs)) * len(inputs)  # whole passes, so every batch times the same mix
+
+    per_call: List[float] = []
+    budget_end = time.perf_counter() + min_time
+    while (time.perf_counter() < budget_end or len(per_call) < min_batches) and len(per_call) * size < max_iters:
+        per_call.append(batch(size) / size)
+
+    tracemalloc.start()
+    try:
+        for arg in inputs:
+            fn(arg)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    per_call.sort()
+    mean = sum(per_call) / len(per_call)
+    return {
+        "iterations": len(per_call) * size,
+        "batch_size": size,
+        "ops_per_sec": round(1 / mean, 2) if mean else 0.0,
+        "p50_ms": round(per_call[len(per_call) // 2] * 1000, 6),
+        "p95_ms": round(per_call[min(len(per_call) - 1, int(len(per_call) * 0.95))] * 1000, 6),
+        "peak_kb": round(peak / 1024, 1),
+    }
+
+
+def tesseract_available() -> bool:
+    try:
+        pytesseract.get_tesseract_version()
+        return True
+    except Exception:
+        return False
+
+
+def main_bench(argv: List[str]) -> None:
+    p = argparse.ArgumentParser(
+        prog="invoice_expenses.py bench",
+        description="Micro-benchmark the amount-extraction and text-extraction hot paths against a stored baseline.",
+    )
+    p.add_argument("--corpus", default=None, help="Directory from gen-corpus (default: generate a small one)")
+    p.add_argument("--min-time", type=float, default=1.0, help="Seconds per benchmark")
+    p.add_argument("--only", nargs="*", default=None, help="Run only these benchmarks")
+    p.add_argument("--baseline", default=BENCH_BASELINE_FILE, help="Baseline JSON to compare against (if it exists)")
+    p.add_argument("--save-baseline", action="store_true", help="Write this run's results to --baseline")
+    p.add_argument("--records", type=int, default=100_000, help="Invoice rows for the in-memory record benchmark")
+    p.add_argument("--max-regression", type=float, default=0.25,
+                   help="Fail if p50 latency or peak memory grows more than this fraction over the baseline "
+                        "(sub-10µs benchmarks: if ops/sec drops more than twice this)")
+    p.add_argument("-v", "--verbose", action="store_true", help="Enable verbose/debug logging")
+    args = p.parse_args(argv)
+    if args.records < 1:
+        p.error("--records must be at least 1")
+
+    logger = setup_logging(verbose=args.verbose)
+    quiet = logging.getLogger("invoice_tracker.bench")
+    quiet.addHandler(logging.NullHandler())
+    quiet.propagate = False
+    quiet_perf = PerformanceTracker(quiet)
+
+    tmp_corpus = None
+    if args.corpus:
+        corpus = Path(args.corpus).expanduser().resolve()
+    else:
+        tmp_corpus = corpus = Path(tempfile.mkdtemp(prefix="bench_corpus_"))
+        write_corpus(corpus, 4, 0, find_unicode_font(), logger)
+    manifest = json.loads((corpus / "manifest.json").read_text(encoding="utf-8"))
+
+    def files(fmt: str) -> List[Path]:
+        return [corpus / m["file"] for m in manifest if m["format"] == fmt]
+
+    native = files("native_pdf") + files("statement")
+    texts = [extract_text_from_pdf(f, False, 0, quiet, quiet_perf) for f in native]
+    contexts = [ln for t in texts for ln in t.splitlines() if AMOUNT_REGEX.search(ln)][:200]
+    ocr_ok = tesseract_available()
+
+    benchmarks = [
+        ("normalize_amount_str", normalize_amount_str, BENCH_AMOUNT_STRINGS, True),
+        ("detect_currency", detect_currency, contexts, True),
+        ("extract_best_total", lambda t: extract_best_total(t, quiet), texts, True),
+        ("extract_text_from_pdf[native]", lambda f: extract_text_from_pdf(f, False, 3, quiet, quiet_perf), native, True),
+        ("extract_text_from_pdf[ocr]", lambda f: extract_text_from_pdf(f, True, 3, quiet, quiet_perf),
+         files("scanned_pdf"), ocr_ok),
+        ("extract_text_from_image", lambda f: extract_text_from_image(f, quiet, quiet_perf), files("photo"), ocr_ok),
+        ("extract_text_from_docx", lambda f: extract_text_from_docx(f, quiet, quiet_perf), files("docx_table"), True),
+    ]
+
+    results: Dict[str, Dict[str, Any]] = {}
+    logger.info(f"🏋️  Benchmarks ({args.min_time:.1f}s each)")
+    for name, fn, inputs, runnable in benchmarks:
+        if args.only and name.split("[")[0] not in args.only and name not in args.only:
+            continue
+        if not runnable or not inputs:
+            logger.info(f"   • {name}: skipped ({'tesseract not installed' if not runnable else 'no inputs'})")
+            continue
+        results[name] = r = run_benchmark(fn, inputs, min_time=args.min_time)
+        logger.info(f"   • {name}: {r['ops_per_sec']:,.1f} ops/s | p50 {r['p50_ms']:.3f}ms | "
+                    f"p95 {r['p95_ms']:.3f}ms | peak {r['peak_kb']:,.1f}KB | {r['iterations']} calls "
+                    f"in batches of {r['batch_size']}")
+
+    if not args.only or "invoice_records" in args.only:
+        results["invoice_records"] = r = measure_record_memory(args.records)
+        logger.info(f"   • invoice_records: {r['table_mb_per_100k']:.1f}MB per 100k rows "
+                    f"(dicts {r['dict_rows_mb_per_100k']:.1f}MB) | hashes {r['digests_mb_per_100k']:.1f}MB "
+                    f"(hex {r['hex_hashes_mb_per_100k']:.1f}MB)")
+
+    if tmp_corpus:
+        shutil.rmtree(tmp_corpus, ignore_errors=True)
+
+    baseline_path = Path(args.baseline)
+    regressions = []
+    if baseline_path.exists() and not args.save_baseline:
+        baseline = json.loads(baseline_path.read_text(encoding="utf-8"))["results"]
+        for name, r in results.items():
+            base = baseline.get(name)
+            if not base:
+                continue
+            if base.get("p50_ms") and base["p50_ms"] < BENCH_MICRO_MS and base.get("ops_per_sec"):
+                # a few microseconds per call: gate throughput, with twice the tolerance
+                if r["ops_per_sec"] < base["ops_per_sec"] * (1 - min(0.9, 2 * args.max_regression)):
+                    regressions.append(f"{name} ops_per_sec: {r['ops_per_sec']} vs baseline {base['ops_per_sec']}")
+                metrics = ("peak_kb",)
+            else:
+                metrics = ("p50_ms", "peak_kb")
+            for metric in metrics:
+                if base.get(metric) and r[metric] > base[metric] * (1 + args.max_regression):
+                    regressions.append(f"{name} {metric}: {r[metric]} vs baseline {base[metric]}")
+        logger.info(f"   Compared with {baseline_path} (allowed +{args.max_regression:.0%})")
+
+    if args.save_baseline:
+        baseline_path.write_text(json.dumps({
+            "meta": {"python": platform.python_version(), "machine": platform.machine(),
+                     "platform": platform.platform(), "created": datetime.now().isoformat(timespec="seconds")},
+            "results": results,
+        }, indent=2), encoding="utf-8")
+        logger.info(f"   ✅ Baseline saved to {baseline_path}")
+
+    if regressions:
+        for line in regressions:
+            logger.error(f"❌ Regression: {line}")
+        sys.exit(1)
+
+
+# ============== STARTUP IMPORT BUDGET ==============
+
+IMPORT_BUDGET_MS = 150.0  # -X importtime total for `--help`, excluding interpreter startup (site and before)
+IMPORT_BUDGET_COMMANDS = [["--help"], ["reprocess", "--help"], ["ingest", "--help"]]
+# Must stay behind LazyModule / function-local imports
+STARTUP_FORBIDDEN_MODULES = (
+    "googleapiclient", "google_auth_oauthlib", "google.oauth2", "fitz", "pymupdf",
+    "PIL", "pytesseract", "docx", "pyarrow",
+)
+
+
+def measure_import_time(argv: List[str], runs: int) -> Dict[str, Any]:
+    """
+    Run this script with `python -X importtime` `runs` times and keep the fastest
+    run: total import microseconds (sum of the top-level cumulative times after
+    interpreter startup), wall time, the slowest top-level imports and any
+    STARTUP_FORBIDDEN_MODULES that loaded.
+    """
+    best = None
+    for _ in range(runs):
+        started = time.perf_counter()
+        proc = subprocess.run([sys.executable, "-X", "importtime", str(Path(__file__).resolve()), *argv],
+                              capture_output=True, text=True)
+        wall = time.perf_counter() - started
+        top_level: List[Tuple[str, int]] = []
+        modules = set()
+        for line in proc.stderr.splitlines():
+            if not line.startswith("import time:") or "cumulative" in line:
+                continue
+            _, cumulative, name = line[len("import time:"):].split("|")
+            modules.add(name.strip())
+            if name.startswith("  "):  # depth is encoded as indentation after one leading space
+                continue
+            if name.strip() == "site":
+                top_level = []  # site is the last import of interpreter startup; ours come after it
+            else:
+                top_level.append((name.strip(), int(cumulative)))
+        total_us = sum(us for _, us in top_level)
+        if best is None or total_us < best["import_us"]:
+            best = {
+                "command": argv,
+                "exit_code": proc.returncode,
+                "import_us": total_us,
+                "wall_ms": round(wall * 1000, 1),
+                "modules": len(modules),
+                "slowest": sorted(top_level, key=lambda x: -x[1])[:10],
+                "forbidden": sorted(m for m in modules
+                                    if any(m == f or m.startswith(f + ".") for f in STARTUP_FORBIDDEN_MODULES)),
+            }
+    return best
+
+
+def main_importtime(argv: List[str]) -> None:
+    p = argparse.ArgumentParser(
+        prog="invoice_expenses.py importtime",
+        description="Guard CLI startup latency: measure -X importtime for cheap commands against a budget.",
+    )
+    p.add_argument("--budget-ms", type=float, default=IMPORT_BUDGET_MS, help="Maximum total import time per command")
+    p.add_argument("--runs", type=int, default=5, help="Runs per command (the fastest is kept)")
+    p.add_argument("--command", action="append", default=None,
+                   help='Arguments to measure instead of the defaults (repeatable), e.g. --command "reprocess --help"')
+    p.add_argument("--report", default=None, help="Write the measurements as JSON here")
+    p.add_argument("-v", "--verbose", action="store_true", help="Enable verbose/debug logging")
+    args = p.parse_args(argv)
+
+    logger = setup_logging(verbose=args.verbose)
+    failures = []
+    results = []
+    logger.info(f"⏱️  Import time (best of {args.runs}, budget {args.budget_ms:.0f}ms)")
+    for command in [c.split() for c in args.command] if args.command else IMPORT_BUDGET_COMMANDS:
+        r = measure_import_time(command, args.runs)
+        results.append(r)
+        label = " ".join(command)
+        logger.info(f"   • {label}: imports {r['import_us'] / 1000:.1f}ms | wall {r['wall_ms']:.1f}ms | "
+                    f"{r['modules']} modules")
+        for name, us in r["slowest"][:5]:
+            logger.debug(f"      {us / 1000:8.1f}ms {name}")
+        if r["exit_code"] != 0:
+            failures.append(f"{label}: exited with {r['exit_code']}")
+        if r["import_us"] / 1000 > args.budget_ms:
+            failures.append(f"{label}: {r['import_us'] / 1000:.1f}ms of imports exceeds {args.budget_ms:.0f}ms")
+        if r["forbidden"]:
+            failures.append(f"{label}: imports heavy modules at startup: {', '.join(r['forbidden'])}")
+
+    if args.report:
+        Path(args.report).write_text(json.dumps(results, indent=2), encoding="utf-8")
+        logger.info(f"   ✅ {args.report}")
+
+    if failures:
+        for line in failures:
+            logger.error(f"❌ {line}")
+        sys.exit(1)
+
+
+# ============== ACCURACY / SPEED EVALUATION ==============
+
+EVAL_CONFIG_FIELDS = [
+    "config", "ocr", "ocr_max_pages", "ocr_dpi", "ocr_fast", "ocr_early_exit",
+    "files", "predicted", "correct", "precision", "recall",
+    "wall_mean_ms", "wall_p95_ms", "cpu_mean_ms", "wall_total_s", "recall_by_format",
+]
+EVAL_FILE_FIELDS = [
+    "config", "file", "format", "expected_currency", "expected_amount",
+    "got_currency", "got_amount", "correct", "wall_ms", "cpu_ms",
+]
+
+
+def evaluation_matrix(ocr_modes: List[bool], max_pages: List[int], dpis: List[int],
+                      fast_modes: List[bool], early_exit_modes: List[bool]) -> List[Dict[str, Any]]:
+    """All setting combinations; OCR knobs are collapsed when OCR is off."""
+    configs = []
+    seen = set()
+    for ocr in ocr_modes:
+        for pages in max_pages:
+            for dpi in dpis:
+                for fast in fast_modes:
+                    for early in early_exit_modes:
+                        cfg = {"ocr": ocr, "ocr_max_pages": pages, "ocr_dpi": dpi,
+                               "ocr_fast": fast, "ocr_early_exit": early} if ocr else \
+                              {"ocr": False, "ocr_max_pages": 0, "ocr_dpi": 0, "ocr_fast": False, "ocr_early_exit": False}
+                        key = tuple(cfg.values())
+                        if key in seen:
+                            continue
+                        seen.add(key)
+                        cfg["config"] = "no-ocr" if not ocr else \
+                            f"ocr p{pages} {dpi}dpi{' fast' if fast else ''}{' early' if early else ''}"
+                        configs.append(cfg)
+    return configs
+
+
+def evaluate_config(cfg: Dict[str, Any], corpus: Path, labels: List[Dict[str, Any]],
+                    logger: logging.Logger, perf: PerformanceTracker) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+    """Run analyze_file over every labelled file; CPU includes tesseract child processes."""
+    file_rows = []
+    for label in labels:
+        c0 = os.times()
+        w0 = time.perf_counter()
+        analysis = analyze_file(corpus / label["file"], cfg["ocr"], cfg["ocr_max_pages"], logger, perf,
+                                ocr_dpi=cfg["ocr_dpi"] or OCR_DEFAULT_DPI, ocr_fast=cfg["ocr_fast"],
+                                ocr_early_exit=cfg["ocr_early_exit"])
+        wall = time.perf_counter() - w0
+        c1 = os.times()
+        cpu = (c1.user - c0.user) + (c1.system - c0.system) + \
+              (c1.children_user - c0.children_user) + (c1.children_system - c0.children_system)
+
+        best = analysis["best_total"] or {}
+        correct = bool(best) and best["currency"] == label["currency"] and \
+            abs(float(best["amount"]) - float(label["amount"])) < 0.005
+        file_rows.append({
+            "config": cfg["config"],
+            "file": label["file"],
+            "format": label.get("format", Path(label["file"]).suffix.lstrip(".")),
+            "expected_currency": label["currency"],
+            "expected_amount": f"{float(label['amount']):.2f}",
+            "got_currency": best.get("currency", ""),
+            "got_amount": f"{best['amount']:.2f}" if best else "",
+            "correct": int(correct),
+            "wall_ms": f"{wall * 1000:.1f}",
+            "cpu_ms": f"{cpu * 1000:.1f}",
+        })
+
+    walls = sorted(float(r["wall_ms"]) for r in file_rows)
+    predicted = sum(1 for r in file_rows if r["got_amount"])
+    correct = sum(r["correct"] for r in file_rows)
+    by_format: Dict[str, List[int]] = defaultdict(list)
+    for r in file_rows:
+        by_format[r["format"]].append(r["correct"])
+
+    summary = dict(cfg)
+    summary.update({
+        "files": len(file_rows),
+        "predicted": predicted,
+        "correct": correct,
+        "precision": round(correct / predicted, 3) if predicted else 0.0,
+        "recall": round(correct / len(file_rows), 3) if file_rows else 0.0,
+        "wall_mean_ms": round(sum(walls) / len(walls), 1) if walls else 0.0,
+        "wall_p95_ms": walls[min(len(walls) - 1, int(len(walls) * 0.95))] if walls else 0.0,
+        "cpu_mean_ms": round(sum(float(r["cpu_ms"]) for r in file_rows) / len(file_rows), 1) if file_rows else 0.0,
+        "wall_total_s": round(sum(walls) / 1000, 2),
+        "recall_by_format": " ".join(f"{fmt}={sum(v) / len(v):.2f}" for fmt, v in sorted(by_format.items())),
+    })
+    return summary, file_rows
+
+
+def main_evaluate(argv: List[str]) -> None:
+    p = argparse.ArgumentParser(
+        prog="invoice_expenses.py evaluate",
+        description="Run analyze_file under a matrix of extraction/OCR settings over a labelled corpus "
+                    "and report precision/recall of best_total against time and CPU per file.",
+    )
+    p.add_argument("--corpus", required=True,
+                   help="Directory with manifest.json (from gen-corpus, or a list of {file, currency, amount})")
+    p.add_argument("--out", default="evaluation", help="Directory for evaluation.csv / evaluation_files.csv")
+    p.add_argument("--ocr", nargs="+", choices=["off", "on"], default=["off", "on"])
+    p.add_argument("--max-pages", nargs="+", type=int, default=[1, 3])
+    p.add_argument("--dpi", nargs="+", type=int, default=[150, OCR_DEFAULT_DPI, 300])
+    p.add_argument("--fast", nargs="+", choices=["off", "on"], default=["off", "on"])
+    p.add_argument("--early-exit", nargs="+", choices=["off", "on"], default=["off", "on"])
+    p.add_argument("--tolerance", type=float, default=0.02,
+                   help="Recommend the fastest setting whose recall is within this of the best")
+    p.add_argument("-v", "--verbose", action="store_true", help="Enable verbose/debug logging")
+    args = p.parse_args(argv)
+
+    logger = setup_logging(verbose=args.verbose)
+    quiet = logging.getLogger("invoice_tracker.evaluate")
+    quiet.addHandler(logging.NullHandler())
+    quiet.propagate = False
+    perf = PerformanceTracker(quiet)
+
+    corpus = Path(args.corpus).expanduser().resolve()
+    labels = json.loads((corpus / "manifest.json").read_text(encoding="utf-8"))
+    if "on" in args.ocr and not tesseract_available():
+        logger.warning("⚠️  tesseract is not installed: OCR settings will be measured as failing")
+
+    configs = evaluation_matrix([m == "on" for m in args.ocr], args.max_pages, args.dpi,
+                                [m == "on" for m in args.fast], [m == "on" for m in args.early_exit])
+    logger.info(f"🧪 Evaluating {len(configs)} settings over {len(labels)} labelled files")
+
+    out_dir = Path(args.out).expanduser().resolve()
+    ensure_dir(out_dir)
+    summaries = []
+    with (out_dir / "evaluation_files.csv").open("w", encoding="utf-8", newline="") as f:
+        w = csv.DictWriter(f, fieldnames=EVAL_FILE_FIELDS)
+        w.writeheader()
+        for n, cfg in enumerate(configs, 1):
+            summary, file_rows = evaluate_config(cfg, corpus, labels, quiet, perf)
+            w.writerows(file_rows)
+            summaries.append(summary)
+            logger.info(f"   [{n}/{len(configs)}] {cfg['config']:<28} P {summary['precision']:.2f} | "
+                        f"R {summary['recall']:.2f} | {summary['wall_mean_ms']:,.1f}ms/file "
+                        f"(p95 {summary['wall_p95_ms']:,.1f}) | CPU {summary['cpu_mean_ms']:,.1f}ms/file")
+
+    with (out_dir / "evaluation.csv").open("w", encoding="utf-8", newline="") as f:
+        w = csv.DictWriter(f, fieldnames=EVAL_CONFIG_FIELDS)
+        w.writeheader()
+        w.writerows(summaries)
+
+    best_recall = max(s["recall"] for s in summaries)
+    eligible = [s for s in summaries if s["recall"] >= best_recall - args.tolerance]
+    pick = min(eligible, key=lambda s: (s["wall_mean_ms"], -s["recall"]))
+    logger.info("")
+    logger.info(f"🏆 Best recall {best_recall:.2f}; fastest within {args.tolerance:.2f}: {pick['config']} "
+                f"(R {pick['recall']:.2f}, {pick['wall_mean_ms']:,.1f}ms/file)")
+    logger.info(f"   Recall by format: {pick['recall_by_format']}")
+    logger.info(f"   ✅ {out_dir / 'evaluation.csv'}")
+
+
+SUBCOMMANDS = {
+    "reprocess": main_reprocess,
+    "ingest": main_ingest,
+    "fake-gmail": main_fake_gmail,
+    "loadtest": main_loadtest,
+    "gen-corpus": main_gen_corpus,
+    "bench": main_bench,
+    "evaluate": main_evaluate,
+    "importtime": main_importtime,
+}
 
 
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] in SUBCOMMANDS:
+        SUBCOMMANDS[sys.argv[1]](sys.argv[2:])
+        return
+
     p = argparse.ArgumentParser(
         description="Invoice expense tracker with dashboard & zip export (Gmail).",
         formatter_class=argparse.RawDescriptionHelpFormatter,
         epilog="""
 Examples:
   python invoice_expenses.py --accounts personal --ocr
+  python invoice_expenses.py reprocess --accounts personal --ocr
+  python invoice_expenses.py ingest --input Takeout/Mail --account archive --ocr
+  python invoice_expenses.py loadtest --messages 500 --latency-ms 30 --rate-429 0.02
+  python invoice_expenses.py bench --save-baseline
+  python invoice_expenses.py evaluate --corpus corpus --dpi 150 300 --fast off on
   python invoice_expenses.py --accounts work personal --ocr -v
   python invoice_expenses.py --accounts business --max 1000 --no-zip
 
@@ -1851,17 +6447,39 @@ Setup:
     p.add_argument("--keywords", nargs="*", default=None, help="Override keywords list")
     p.add_argument("--ocr", action="store_true", help="Enable OCR for PDFs/images")
     p.add_argument("--ocr-max-pages", type=int, default=3, help="OCR first N pages of PDFs")
+    _add_ocr_tuning_args(p)
+    p.add_argument("--prefilter-threshold", type=float, default=None,
+                   help="Opt in to skipping OCR of attachments that score below this (e.g. 0; higher = stricter)")
     p.add_argument("--allow-duplicates", action="store_true", help="Count identical files multiple times")
     p.add_argument("--no-zip", action="store_true", help="Skip creating zip archive")
+    p.add_argument("--parquet", action="store_true",
+                   help="Also write typed invoices.parquet / messages.parquet (requires pyarrow)")
+    p.add_argument("--dashboard-mode", choices=["auto", "inline", "paged"], default="auto",
+                   help=f"inline: rows embedded in dashboard.html; paged: rows in a dashboard_data.js sidecar "
+                        f"with a paginated table; auto: paged above {DASHBOARD_INLINE_MAX_ROWS} invoices")
+    p.add_argument("--resume", action="store_true",
+                   help="Continue an interrupted run from its checkpoint.journal instead of starting over")
+    p.add_argument("--incremental", action="store_true",
+                   help="Reopen results.sqlite and skip messages processed by earlier runs")
+    p.add_argument("--gmail-endpoint", default=None,
+                   help="Talk to this Gmail-compatible endpoint without OAuth (e.g. 'fake-gmail' at http://127.0.0.1:8085/)")
+    _add_blob_store_args(p)
+    _add_metrics_args(p)
+    _add_profile_args(p)
+    _add_memory_args(p)
     p.add_argument("-v", "--verbose", action="store_true", help="Enable verbose/debug logging")
+    _add_logging_args(p)
     args = p.parse_args()
 
     # Setup logging
     base_out = Path(args.out).expanduser().resolve()
     ensure_dir(base_out)
 
-    logger = setup_logging(verbose=args.verbose, log_file=base_out / "main.log")
+    logger = setup_logging(verbose=args.verbose, log_file=base_out / "main.log",
+                           log_format=args.log_format, async_logging=args.log_async)
     perf = PerformanceTracker(logger)
+    _enable_profiling(perf, args)
+    _enable_memory_tracking(perf, args)
 
     logger.info("")
     logger.info("╔════════════════════════════════════════════════════════════╗")
@@ -1871,7 +6489,7 @@ Setup:
     logger.info("")
 
     creds_path = Path(args.credentials).expanduser().resolve()
-    if not creds_path.exists():
+    if not creds_path.exists() and not args.gmail_endpoint:
         logger.error(f"❌ Missing credentials file: {creds_path}")
         logger.error("")
         logger.error("To get credentials.json:")
@@ -1890,6 +6508,10 @@ Setup:
         logger.error("")
         sys.exit(1)
 
+    if args.parquet and not module_available("pyarrow"):
+        logger.error("❌ --parquet requires pyarrow (pip install pyarrow)")
+        sys.exit(1)
+
     keywords = args.keywords if args.keywords else DEFAULT_KEYWORDS
 
     after_date = date.today() - timedelta(days=365)
@@ -1900,10 +6522,12 @@ Setup:
     logger.info(f"   Date range: {after_str} to today")
     logger.info(f"   Max messages per account: {args.max}")
     logger.info(f"   OCR enabled: {args.ocr}")
+    logger.info(f"   Prefilter: {'off' if args.prefilter_threshold is None else f'threshold {args.prefilter_threshold:+.1f}'}")
     logger.info(f"   Verbose mode: {args.verbose}")
     logger.info(f"   Output directory: {base_out}")
     logger.info("")
 
+    blob_store = _open_blob_store(base_out, args, logger)
     for label in args.accounts:
         token_path = base_out / "tokens" / f"token_{sanitize_filename(label)}.json"
         out_dir = base_out / sanitize_filename(label)
@@ -1924,15 +6548,26 @@ Setup:
                 create_zip=not args.no_zip,
                 logger=logger,
                 perf=perf,
+                prefilter_threshold=args.prefilter_threshold,
+                incremental=args.incremental,
+                parquet=args.parquet,
+                dashboard_mode=args.dashboard_mode,
+                resume=args.resume,
+                api_endpoint=args.gmail_endpoint,
+                ocr_options=_ocr_options(args),
+                blob_store=blob_store,
             )
         except Exception as e:
             logger.error(f"❌ Failed processing account '{label}': {e}")
             if args.verbose:
                 import traceback
                 logger.error(traceback.format_exc())
+    if blob_store:
+        blob_store.close()
 
     # Final summary
     perf.print_summary()
+    perf.export(base_out, _prometheus_path(args))
 
     logger.info("")
     logger.info("✅ All done! Open dashboard.html in your browser to view results.")